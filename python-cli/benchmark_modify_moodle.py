@@ -0,0 +1,313 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import pathlib
+import platform
+import random
+import sys
+import tarfile
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import modify_moodle_backup as mmb
+
+# --- Configuration ---
+SCRIPT_DIR = pathlib.Path(__file__).resolve().parent
+DEFAULT_TEMPLATE = SCRIPT_DIR.parent / "src" / "assets" / "mbz-templates" / "moodle-4.5-2024100700.mbz"
+SCALE_COUNTS = [100, 1000, 3000] # Values of -n for the scale benchmark
+
+# Stages timed by the stage benchmark, in pipeline order (see modify_backup())
+STAGES = ['extract_mbz', 'extract_ids', 'modification', 'update_moodle_backup_xml', 'validate', 'create_mbz']
+
+# Synthetic backups of the stage benchmark: existing assignments, size of the
+# files/ pool, size of moodle_backup.xml and the number of assignments built.
+SCENARIOS = [
+    {'name': 'bundled-template', 'assignments': 2, 'files_mb': 0, 'manifest_kb': 0, 'target': 7},
+    {'name': 'many-assignments', 'assignments': 300, 'files_mb': 0, 'manifest_kb': 0, 'target': 400},
+    {'name': 'large-files-pool', 'assignments': 20, 'files_mb': 64, 'manifest_kb': 0, 'target': 30},
+    {'name': 'large-manifest', 'assignments': 20, 'files_mb': 0, 'manifest_kb': 4096, 'target': 30},
+]
+
+# A stage counts as slower than the baseline if it takes this factor longer
+# and at least REGRESSION_MIN_SECONDS more (short stages are noisy).
+REGRESSION_FACTOR = 1.25
+REGRESSION_MIN_SECONDS = 0.02
+
+FILES_POOL_FILE_SIZE = 256 * 1024
+
+# Latency benchmark: extraction of a backup with this many assignments (7
+# files each) to a stand-in for a high-latency temporary directory, e.g. on a
+# network drive, that delays every file write by --latency-ms.
+LATENCY_ASSIGNMENTS = 150
+DEFAULT_LATENCY_MS = 5
+
+# Arguments of a build, as parsed by modify_moodle_backup.py (one assignment per day)
+BASE_ARGS = dict(
+    output_mbz="benchmark.mbz",
+    num_assignments=None,
+    first_submission_date="2025-04-25",
+    num_consecutive_weeks=None,
+    submission_dates=None,
+    submission_time="19:59:59",
+    extra_time=5,
+    section_title="Exam Booklet",
+    assignment_name_prefix="Page",
+    target_start_date="2025-04-22",
+    compression_level=1,
+    compress_threads=None,
+    scale=False,
+    verbosity=2,
+    deterministic=False,
+    incremental=False,
+)
+
+# --- Helper Functions ---
+
+def build_args(num_assignments, output_mbz, scale):
+    """Returns build arguments for num_assignments assignments, one day apart."""
+    args = argparse.Namespace(**copy.deepcopy(BASE_ARGS))
+    args.num_assignments = num_assignments
+    args.first_submission_date = None
+    dates = [datetime(2025, 4, 25) + timedelta(days=i) for i in range(num_assignments)]
+    args.submission_dates = ",".join(date.strftime("%Y-%m-%d") for date in dates)
+    args.output_mbz = str(output_mbz)
+    args.scale = scale
+    return args
+
+def files_pool_content(rng, size):
+    """Returns size bytes for a files/ pool entry: alternately random (like images) and text-like."""
+    if rng.random() < 0.5:
+        return rng.getrandbits(size * 8).to_bytes(size, 'little')
+    words = [b"Klausur", b"Booklet", b"Seite", b"Aufgabe", b"Moodle", b"PDF", b"\n"]
+    text = b" ".join(rng.choice(words) for _ in range(size // 6 + 1))
+    return text[:size]
+
+def padding_settings(indent, size):
+    """Returns root <setting> blocks of about size characters for padding moodle_backup.xml."""
+    blocks = []
+    total = 0
+    number = 0
+    while total < size:
+        block = (f"\n{indent}<setting>\n{indent}  <level>root</level>\n"
+                 f"{indent}  <name>benchmark_padding_{number}</name>\n{indent}  <value>0</value>\n{indent}</setting>")
+        blocks.append(block)
+        total += len(block)
+        number += 1
+    return "".join(blocks)
+
+def generate_synthetic_mbz(output_path, template, assignments, files_mb=0, manifest_kb=0, seed=0):
+    """Builds a synthetic .mbz from the template.
+
+    The backup has the given number of assignments (created with this tool
+    from the template's first assignment), a files/ pool of files_mb MiB of
+    mixed random and text content, and moodle_backup.xml padded with extra
+    settings by about manifest_kb KiB.
+    """
+    rng = random.Random(seed)
+    args = build_args(assignments, output_path, scale=True)
+    # Different names and title than the benchmark builds, so that those change every assignment
+    args.assignment_name_prefix = "Synthetic"
+    args.section_title = None
+    args.target_start_date = None
+    with contextlib.redirect_stdout(io.StringIO()) as log:
+        assignment_base_data, target_assignment_count, target_start_timestamp = mmb.plan_assignments(args)
+        with mmb.BackupTree.from_archive(template) as tree:
+            if not mmb.apply_assignment_changes(tree, assignment_base_data, target_assignment_count,
+                                                pathlib.Path(output_path).name, args.section_title,
+                                                target_start_timestamp, verbose=False):
+                raise RuntimeError(f"Could not generate {output_path}:\n{log.getvalue()}")
+            for number in range(files_mb * 1024 * 1024 // FILES_POOL_FILE_SIZE):
+                content_hash = f"{rng.getrandbits(160):040x}"
+                tree.write_bytes(f"files/{content_hash[:2]}/{content_hash}", files_pool_content(rng, FILES_POOL_FILE_SIZE))
+            if manifest_kb:
+                content = tree.read_text("moodle_backup.xml")
+                insertion_point = content.rfind("</setting>") + len("</setting>")
+                indent = mmb.extract_moodle_backup_layout(content)['setting_indent'].lstrip("\n")
+                padding = padding_settings(indent, manifest_kb * 1024)
+                tree.write_text("moodle_backup.xml", content[:insertion_point] + padding + content[insertion_point:])
+            mmb.create_mbz(tree, output_path, compression_level=6)
+    return output_path
+
+def time_build(snapshot, args):
+    """Builds one backup from a template snapshot. Returns (seconds, lines printed)."""
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        success = mmb.build_from_snapshot(snapshot, args)
+    elapsed = time.perf_counter() - start
+    if not success:
+        raise RuntimeError(f"Build of {args.output_mbz} failed:\n{log.getvalue()}")
+    return elapsed, log.getvalue().count("\n")
+
+def time_stages(input_path, args):
+    """Runs the extract/modify/re-pack pipeline once. Returns the seconds per stage."""
+    stats = mmb.PipelineStats(trace_memory=False) # Tracing memory would distort the timings
+    with contextlib.redirect_stdout(io.StringIO()) as log:
+        assignment_base_data, target_assignment_count, target_start_timestamp = mmb.plan_assignments(args)
+        success = mmb.modify_backup(input_path, args.output_mbz, assignment_base_data, target_assignment_count,
+                                    args.section_title, target_start_timestamp,
+                                    compression_level=args.compression_level, verbose=False, stats=stats)
+    if not success:
+        raise RuntimeError(f"Build of {args.output_mbz} failed:\n{log.getvalue()}")
+    return stats.seconds()
+
+def run_stage_benchmark(template, scenarios, repeat):
+    """Times each pipeline stage on synthetic backups. Returns {scenario: {stage: seconds}} (best of repeat runs)."""
+    print(f"Stage benchmark with template {template} (best of {repeat})")
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="mbz_benchmark_") as work_dir:
+        work_path = pathlib.Path(work_dir)
+        for scenario in scenarios:
+            input_path = work_path / f"{scenario['name']}.mbz"
+            generate_synthetic_mbz(input_path, template, scenario['assignments'],
+                                   scenario['files_mb'], scenario['manifest_kb'])
+            args = build_args(scenario['target'], work_path / f"{scenario['name']}-out.mbz", scale=True)
+            best = {}
+            for _ in range(repeat):
+                for stage, seconds in time_stages(input_path, args).items():
+                    best[stage] = min(seconds, best.get(stage, seconds))
+            results[scenario['name']] = best
+            size_mb = input_path.stat().st_size / (1024 * 1024)
+            print(f"\n{scenario['name']} ({scenario['assignments']} assignments -> {scenario['target']}, {size_mb:.1f} MiB):")
+            for stage in STAGES:
+                print(f"  {stage:<26} {best.get(stage, 0.0):>8.3f} s")
+    return results
+
+def compare_with_baseline(results, baseline):
+    """Prints the change of each stage against a baseline result file. Returns the list of regressions."""
+    print("\nComparison with baseline:")
+    regressions = []
+    for scenario, stages in results.items():
+        baseline_stages = baseline.get('stages', {}).get(scenario)
+        if baseline_stages is None:
+            print(f"  {scenario}: not in baseline")
+            continue
+        for stage in STAGES:
+            if stage not in stages or stage not in baseline_stages:
+                continue
+            current, previous = stages[stage], baseline_stages[stage]
+            ratio = current / previous if previous else float('inf')
+            slower = current > previous * REGRESSION_FACTOR and current - previous > REGRESSION_MIN_SECONDS
+            marker = "  SLOWER" if slower else ""
+            print(f"  {scenario:<18} {stage:<26} {previous:>8.3f} -> {current:>8.3f} s ({ratio:>5.2f}x){marker}")
+            if slower:
+                regressions.append(f"{scenario}/{stage}: {previous:.3f} s -> {current:.3f} s")
+    return regressions
+
+def run_scale_benchmark(template, counts):
+    """Times builds with many assignments, with and without --scale."""
+    print(f"Scale benchmark with template {template}")
+    print(f"{'-n':>6} {'mode':>8} {'seconds':>9} {'ms/assignment':>14} {'log lines':>10}")
+    results = []
+    with tempfile.TemporaryDirectory(prefix="mbz_benchmark_") as work_dir:
+        work_path = pathlib.Path(work_dir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            snapshot = mmb.load_template_snapshot(template, work_path / "passthrough.tar")
+        for count in counts:
+            for scale in (False, True):
+                args = build_args(count, work_path / f"scale-{count}.mbz", scale)
+                elapsed, lines = time_build(snapshot, args)
+                mode = "scale" if scale else "default"
+                print(f"{count:>6} {mode:>8} {elapsed:>9.3f} {elapsed * 1000 / count:>14.3f} {lines:>10}")
+                results.append({'count': count, 'mode': mode, 'seconds': elapsed, 'log_lines': lines})
+    return results
+
+@contextlib.contextmanager
+def slow_file_writes(latency):
+    """Delays every file written by extract_mbz() by latency seconds (sleeping releases the GIL, like waiting for I/O)."""
+    write_extracted_file = mmb.write_extracted_file
+
+    def slow_write(path, data, member):
+        time.sleep(latency)
+        write_extracted_file(path, data, member)
+
+    mmb.write_extracted_file = slow_write
+    try:
+        yield
+    finally:
+        mmb.write_extracted_file = write_extracted_file
+
+def run_latency_benchmark(template, latency_ms, repeat):
+    """Times extract_mbz() on a high-latency directory stand-in, one and EXTRACT_WORKERS writer threads."""
+    print(f"Latency benchmark with template {template} ({latency_ms} ms per file write, best of {repeat})")
+    results = []
+    with tempfile.TemporaryDirectory(prefix="mbz_benchmark_") as work_dir:
+        work_path = pathlib.Path(work_dir)
+        input_path = generate_synthetic_mbz(work_path / "latency.mbz", template, LATENCY_ASSIGNMENTS)
+        with tarfile.open(input_path) as tar:
+            file_count = sum(1 for member in tar if member.isfile())
+        print(f"{'workers':>8} {'files':>6} {'seconds':>9} {'speedup':>8}")
+        sequential = None
+        for workers in (1, mmb.EXTRACT_WORKERS):
+            best = None
+            for run in range(repeat):
+                with slow_file_writes(latency_ms / 1000), contextlib.redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    mmb.extract_mbz(input_path, work_path / f"extracted-{workers}-{run}", workers=workers)
+                    elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            sequential = sequential or best
+            print(f"{workers:>8} {file_count:>6} {best:>9.3f} {sequential / best:>7.1f}x")
+            results.append({'workers': workers, 'files': file_count, 'latency_ms': latency_ms, 'seconds': best})
+    return results
+
+# --- Main Benchmark Logic ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark modify_moodle_backup.py.")
+    parser.add_argument("suite", nargs="?", choices=["stages", "scale", "latency", "all"], default="stages", help="Benchmark to run (default: stages)")
+    parser.add_argument("--template", default=str(DEFAULT_TEMPLATE), help="Template .mbz (default: the bundled Moodle 4.5 template)")
+    parser.add_argument("--scenarios", help=f"Comma-separated scenarios of the stage benchmark (default: all of {', '.join(s['name'] for s in SCENARIOS)})")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario; the fastest time of each stage is kept (default: 3)")
+    parser.add_argument("--counts", default=",".join(map(str, SCALE_COUNTS)), help="Comma-separated assignment counts for the scale benchmark")
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_LATENCY_MS, help=f"Delay per file write of the latency benchmark (default: {DEFAULT_LATENCY_MS})")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with; exits with 1 if a stage got slower")
+    args = parser.parse_args()
+
+    template = pathlib.Path(args.template)
+    if not template.is_file():
+        print(f"Error: Template not found at {template}")
+        return 1
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+    if args.suite in ("stages", "all"):
+        scenarios = SCENARIOS
+        if args.scenarios:
+            names = args.scenarios.split(",")
+            scenarios = [scenario for scenario in SCENARIOS if scenario['name'] in names]
+            unknown = set(names) - {scenario['name'] for scenario in scenarios}
+            if unknown:
+                print(f"Error: Unknown scenario(s): {', '.join(sorted(unknown))}")
+                return 1
+        results['scenarios'] = scenarios
+        results['stages'] = run_stage_benchmark(template, scenarios, args.repeat)
+    if args.suite in ("scale", "all"):
+        results['scale'] = run_scale_benchmark(template, [int(count) for count in args.counts.split(",")])
+    if args.suite in ("latency", "all"):
+        results['latency'] = run_latency_benchmark(template, args.latency_ms, args.repeat)
+
+    if args.output:
+        pathlib.Path(args.output).write_text(json.dumps(results, indent=2), encoding='utf-8')
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline and 'stages' in results:
+        baseline = json.loads(pathlib.Path(args.baseline).read_text(encoding='utf-8'))
+        regressions = compare_with_baseline(results['stages'], baseline)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) slower than the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo stage is slower than the baseline.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -21,30 +21,60 @@
 # SOFTWARE.
 
 import os
+import asyncio
+import bz2
+import collections
+import copy
+import concurrent.futures
+import contextlib
+import csv
+import hashlib
+import io
+import json
+import lzma
+import mmap
 import shutil
+import struct
+import sys
 import tarfile
 import re
 import argparse
 import time
+import tracemalloc
 import pathlib
 import tempfile
+import threading
 import uuid
+import zlib
 from datetime import datetime, timedelta
 
+try:
+    from compression import zstd # Python 3.14+
+except ImportError:
+    zstd = None
+
 TARGET_ASSIGNMENT_COUNT = 4
 
 # --- Helper Functions for ID Extraction ---
 
+# Combined, precompiled patterns: each file is scanned once with one pattern
+# per file type, the matching group tells which ID was found. moodle_backup.xml
+# is scanned as raw bytes (see BackupTree.open_buffer()).
+MOODLE_BACKUP_ID_PATTERN = re.compile(
+    rb'<moduleid>(\d+)</moduleid>|<sectionid>(\d+)</sectionid>|<detail backup_id="([a-f0-9]+)">'
+)
+ASSIGN_ID_PATTERN = re.compile(
+    r'<(?:activity|assign) id="(\d+)">|<plugin_config id="(\d+)">|<activity[^\n]*?contextid="(\d+)"'
+)
+INFOREF_GRADE_ITEM_PATTERN = re.compile(r'<grade_item>\s*<id>(\d+)</id>\s*</grade_item>')
+GRADING_AREA_PATTERN = re.compile(r'<area id="(\d+)">')
+GRADES_SORTORDER_PATTERN = re.compile(r'<sortorder>(\d+)</sortorder>')
+
 def find_max_id(pattern, text, cast_to=int):
     """Find all matches for a pattern and return the maximum ID found."""
     ids = [cast_to(match) for match in pattern.findall(text)]
     return max(ids) if ids else 0
 
-def find_first_id(pattern, text, cast_to=int):
-    """Find the first match for a pattern and return the ID."""
-    match = pattern.search(text)
-    return cast_to(match.group(1)) if match else None
-
 # --- Date Handling Functions ---
 
 def parse_datetime(date_str, time_str):
@@ -59,14 +89,15 @@ def parse_datetime(date_str, time_str):
         print("Please ensure date is in YYYY-MM-DD format and time in HH:MM:SS format")
         raise
 
-def generate_assignment_dates(args):
-    """Generate assignment dates based on command line arguments."""
+def generate_assignment_dates(args, now=None):
+    """Generate assignment dates based on command line arguments (now: the build time, default: current time)."""
     assignments = []
     extra_minutes = args.extra_time
     name_prefix = args.assignment_name_prefix
     
     # Current time for the first activation time if needed
-    now = datetime.now()
+    if now is None:
+        now = datetime.now()
     
     # Option A: First date + consecutive weeks
     if args.first_submission_date and args.num_consecutive_weeks:
@@ -125,167 +156,1032 @@ def generate_assignment_dates(args):
     
     return assignments
 
+def plan_assignments(args):
+    """Validates the date options and generates the assignment data for one build.
+
+    Returns (assignment_base_data, target_assignment_count, target_start_timestamp).
+    Raises ValueError with a message for the user if the options are invalid.
+    """
+    # Validate date/time options
+    if args.first_submission_date and args.submission_dates:
+        raise ValueError("Cannot use both --first-submission-date and --submission-dates. Choose one method.")
+
+    if args.first_submission_date and not args.num_consecutive_weeks:
+        raise ValueError("When using --first-submission-date, you must also specify --num-consecutive-weeks")
+
+    if args.num_consecutive_weeks and not args.first_submission_date:
+        raise ValueError("When using --num-consecutive-weeks, you must also specify --first-submission-date")
+
+    # If no date options provided, use default assignment count
+    target_assignment_count = args.num_assignments
+    if args.first_submission_date and args.num_consecutive_weeks:
+        target_assignment_count = args.num_consecutive_weeks
+    elif args.submission_dates:
+        target_assignment_count = len(args.submission_dates.split(','))
+
+    # Parse target start date if provided
+    target_start_timestamp = None
+    if args.target_start_date:
+        try:
+            # Parse as datetime object and convert to Unix timestamp
+            target_start_dt = datetime.strptime(args.target_start_date, "%Y-%m-%d")
+            target_start_timestamp = int(target_start_dt.timestamp())
+            print(f"  Target start date specified: {args.target_start_date} (Timestamp: {target_start_timestamp})")
+        except ValueError:
+            raise ValueError(f"Invalid format for --target-start-date '{args.target_start_date}'. Use YYYY-MM-DD.")
+
+    # --- Assignment Data Definition ---
+    fixed_time = deterministic_timestamp(args)
+    now = datetime.fromtimestamp(fixed_time) if fixed_time is not None else datetime.now()
+    if args.first_submission_date or args.submission_dates:
+        # Generate dates based on command line arguments
+        assignment_base_data = generate_assignment_dates(args, now)
+    else:
+        # Use default date generation if no specific dates provided
+        assignment_base_data = []
+        for i in range(target_assignment_count):
+            due_date = now + timedelta(days=7 * (i + 1))
+            cutoff_date = due_date + timedelta(minutes=args.extra_time)
+            activation_date = now if i == 0 else (now + timedelta(days=7 * i, minutes=args.extra_time))
+            
+            assignment_base_data.append({
+                "name": f"{args.assignment_name_prefix} {i + 1}",
+                "due_ts": int(due_date.timestamp()),
+                "cutoff_ts": int(cutoff_date.timestamp()),
+                "activation_ts": int(activation_date.timestamp())
+            })
+
+    return assignment_base_data, target_assignment_count, target_start_timestamp
+
+SECTION_LAYOUT_ENTRY_PATTERN = re.compile(r'\s*(\d+)\s*(?:-\s*(\d+)\s*)?(?:=(.*))?')
+
+def parse_section_layout(spec, target_assignment_count):
+    """Parses --section-layout: ranges of assignment numbers with optional section titles.
+
+    spec is e.g. "1-4=Block A;5-8=Block B;9-10": entries separated by ';',
+    each a range FIRST-LAST (or a single number) and optionally =TITLE. The
+    ranges must follow each other from 1 to target_assignment_count. Returns
+    a list of dictionaries with first, last and title (None to keep it).
+    Raises ValueError with a message for the user if spec is invalid.
+    """
+    layout = []
+    for entry in spec.split(';'):
+        if not entry.strip():
+            continue
+        match = SECTION_LAYOUT_ENTRY_PATTERN.fullmatch(entry)
+        if not match:
+            raise ValueError(f"Invalid --section-layout entry '{entry.strip()}'. Use FIRST-LAST or FIRST-LAST=Title, separated by ';'.")
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        expected_first = layout[-1]['last'] + 1 if layout else 1
+        if first != expected_first or last < first:
+            raise ValueError(f"Invalid --section-layout range {first}-{last}: the ranges must follow each other, starting at 1 (expected {expected_first}-...).")
+        title = match.group(3).strip() if match.group(3) is not None else None
+        layout.append({'first': first, 'last': last, 'title': title or None})
+    if not layout:
+        raise ValueError("--section-layout has no ranges.")
+    if layout[-1]['last'] != target_assignment_count:
+        raise ValueError(f"--section-layout covers assignments 1-{layout[-1]['last']}, but the build has {target_assignment_count}.")
+    return layout
+
+def deterministic_timestamp(args):
+    """Returns the fixed build time of --deterministic builds, or None to use the current time.
+
+    The time is taken from the SOURCE_DATE_EPOCH environment variable or else
+    from --target-start-date, so that it only depends on the inputs. Raises
+    ValueError if neither is given.
+    """
+    if not args.deterministic:
+        return None
+    if os.environ.get('SOURCE_DATE_EPOCH'):
+        try:
+            return int(os.environ['SOURCE_DATE_EPOCH'])
+        except ValueError:
+            raise ValueError(f"Invalid SOURCE_DATE_EPOCH '{os.environ['SOURCE_DATE_EPOCH']}'. Use a Unix timestamp.")
+    if args.target_start_date:
+        try:
+            return int(datetime.strptime(args.target_start_date, "%Y-%m-%d").timestamp())
+        except ValueError:
+            raise ValueError(f"Invalid format for --target-start-date '{args.target_start_date}'. Use YYYY-MM-DD.")
+    raise ValueError("--deterministic needs --target-start-date or the SOURCE_DATE_EPOCH environment variable as the build time.")
+
+def derive_backup_id(*inputs):
+    """Returns a backup ID (32 hex digits like uuid4().hex) derived from the build inputs."""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+def per_file_output(args):
+    """Whether a build prints a line per created file and manifest entry (not with --scale or --verbosity below 2)."""
+    return args.verbosity >= 2 and not args.scale
+
+def recorded_output_name(args):
+    """Returns the file name recorded in the backup: --output-name, else that of the output (-o)."""
+    if getattr(args, 'output_name', None):
+        return args.output_name
+    return DEFAULT_STREAM_OUTPUT_NAME if args.output_mbz == '-' else default_output_name(args.output_mbz)
+
+# --- Instrumentation ---
+
+class PipelineStats:
+    """Wall time, peak traced memory and byte counts of each pipeline stage.
+
+    A stage runs from start_stage() until the next stage starts or
+    end_stage() is called; stages that run more than once are summed. count()
+    adds to the byte counters of the running stage: bytes_read (input files
+    and members copied from a source), bytes_written (extracted files and the
+    compressed output) and bytes_compressed (tar data fed to the compressor).
+    A disabled instance records nothing, so all functions take stats=None.
+
+    Peak memory is measured with tracemalloc, which slows Python code down;
+    pass trace_memory=False for timings only.
+    """
+
+    COUNTERS = ('bytes_read', 'bytes_written', 'bytes_compressed')
+
+    def __init__(self, enabled=True, trace_memory=True):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.stages = {} # name -> totals, in the order the stages first ran
+        self.details = {} # Extra top-level fields of the report (mode, input, ...)
+        self._current = None
+        self._stage_start = None
+        self._started = time.perf_counter()
+        self._started_tracing = False
+
+    def start_stage(self, name):
+        if not self.enabled:
+            return
+        self.end_stage()
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            if hasattr(tracemalloc, 'reset_peak'): # Python 3.9+; before, the peak covers all earlier stages
+                tracemalloc.reset_peak()
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'runs': 0, 'peak_memory_bytes': None,
+                                              **dict.fromkeys(self.COUNTERS, 0)})
+        stage['runs'] += 1
+        self._current = name
+        self._stage_start = time.perf_counter()
+
+    def end_stage(self):
+        if not self.enabled or self._current is None:
+            return
+        stage = self.stages[self._current]
+        stage['seconds'] += time.perf_counter() - self._stage_start
+        if self.trace_memory and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            stage['peak_memory_bytes'] = max(stage['peak_memory_bytes'] or 0, peak)
+        self._current = None
+
+    def count(self, counter, amount):
+        if self.enabled and self._current is not None:
+            self.stages[self._current][counter] += amount
+
+    def seconds(self):
+        """Returns {stage: seconds} of all stages that ran."""
+        return {name: stage['seconds'] for name, stage in self.stages.items()}
+
+    def close(self):
+        """Ends the running stage and stops tracing memory (if this instance started it)."""
+        self.end_stage()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def report(self):
+        """Returns the report as a JSON-serializable dictionary."""
+        self.end_stage()
+        return {
+            'total_seconds': round(time.perf_counter() - self._started, 6),
+            **self.details,
+            'totals': {counter: sum(stage[counter] for stage in self.stages.values()) for counter in self.COUNTERS},
+            'stages': [{'name': name, **stage, 'seconds': round(stage['seconds'], 6)}
+                       for name, stage in self.stages.items()],
+        }
+
+    def write_json(self, path):
+        pathlib.Path(path).write_text(json.dumps(self.report(), indent=2) + "\n", encoding='utf-8')
+
+# --- In-Memory Backup Tree ---
+
+def normalize_member_name(name):
+    """Returns a tar member name without leading './' and trailing '/' ('' for the root entry)."""
+    while name.startswith('./'):
+        name = name[2:]
+    name = name.rstrip('/')
+    return '' if name == '.' else name
+
+def is_dotfile_member(name):
+    """Checks whether any path component of a (normalized) member name starts with '.'"""
+    return any(part.startswith('.') for part in name.split('/'))
+
+# TarInfo attributes kept for held members in template snapshots
+TARINFO_SNAPSHOT_ATTRIBUTES = ('type', 'mode', 'uid', 'gid', 'uname', 'gname', 'mtime', 'linkname')
+
+def normalize_tarinfo(info, mtime):
+    """Makes member metadata reproducible (--deterministic): fixed mtime and mode, root owner, no extended headers."""
+    info.mtime = mtime
+    info.mode = 0o755 if info.isdir() else 0o644
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    info.pax_headers = {}
+    return info
+
+def _member_sort_key(name):
+    """Sorts member names like pathlib sorts paths (component by component)."""
+    return name.split('/')
+
+class BackupTree:
+    """Members of a Moodle backup, loaded lazily and edited in memory.
+
+    Member content is only read from the source (an extracted directory or a
+    .mbz archive) when it is first accessed. Writes keep the new content in
+    memory and mark the member dirty; the source is never written to. When the
+    tree is written to an archive, dirty members come from memory and all other
+    members are copied from the source.
+
+    All content held in memory is accounted in memory_bytes (text is counted
+    by its length), so the peak can be reported and capped with
+    max_memory_bytes. Bytes read from the source are counted in stats (a
+    PipelineStats) if given.
+
+    With fixed_mtime, all members are written with that mtime and the
+    metadata of normalize_tarinfo(), so that the same input always gives the
+    same archive.
+    """
+
+    def __init__(self, sort_members=True, max_memory_bytes=None, stats=None, fixed_mtime=None):
+        self.sort_members = sort_members # Write in sorted order (directory sources) or source order (archives)
+        self.max_memory_bytes = max_memory_bytes
+        self.fixed_mtime = fixed_mtime
+        self.stats = stats or PipelineStats(enabled=False)
+        self.memory_bytes = 0
+        self.peak_memory_bytes = 0
+        self.skipped_dotfiles = 0
+        self._members = {} # name -> member record, in source order
+        self._archive = None
+        self.source = "memory" # Description of the source for messages
+
+    @classmethod
+    def from_directory(cls, base_path, member_order=None, **kwargs):
+        """Creates a tree for an extracted backup directory.
+
+        member_order lists member names in the order they are written (see
+        snapshot_member_order()); other files follow in sorted order. Without
+        it, all members are written sorted.
+        """
+        if member_order is not None:
+            kwargs.setdefault('sort_members', False)
+        tree = cls(**kwargs)
+        base_path = pathlib.Path(base_path)
+        tree.source = str(base_path)
+        items = {item.relative_to(base_path).as_posix(): item for item in sorted(base_path.glob('**/*'))}
+        for name in member_order or ():
+            item = items.pop(name, None)
+            if item is not None:
+                tree._add(name, is_dir=item.is_dir(), path=item)
+        for name, item in items.items():
+            tree._add(name, is_dir=item.is_dir(), path=item)
+        return tree
+
+    @classmethod
+    def from_archive(cls, mbz_path, **kwargs):
+        """Creates a tree that reads members from a .mbz archive on demand (dotfiles are skipped)."""
+        kwargs.setdefault('sort_members', False)
+        tree = cls(**kwargs)
+        tree.source = str(mbz_path)
+        tree._archive = open_mbz_for_reading(mbz_path)
+        for member in tree._archive.getmembers():
+            name = normalize_member_name(member.name)
+            if not name:
+                continue
+            if is_dotfile_member(name):
+                tree.skipped_dotfiles += 1
+                continue
+            tree.add_member(member, source_info=member)
+        return tree
+
+    @classmethod
+    def from_snapshot(cls, snapshot, **kwargs):
+        """Creates a tree from a template snapshot (see load_template_snapshot())."""
+        kwargs.setdefault('sort_members', False)
+        tree = cls(**kwargs)
+        tree.source = snapshot['source']
+        if snapshot['passthrough_path']:
+            # Uncompressed tar of all members that are never modified
+            tree._archive = tarfile.open(snapshot['passthrough_path'], "r:")
+            for member in tree._archive:
+                tree.add_member(member, source_info=member)
+        for name, attributes, data in snapshot['members']:
+            info = tarfile.TarInfo(name)
+            for key, value in attributes.items():
+                setattr(info, key, value)
+            tree.add_member(info, data)
+        return tree
+
+    def export_members(self):
+        """Returns the loaded, non-passthrough members as picklable (name, attributes, content) tuples."""
+        exported = []
+        for name, member in self._members.items():
+            if member['passthrough']:
+                continue
+            info = member['info'] or tarfile.TarInfo(name)
+            attributes = {key: getattr(info, key) for key in TARINFO_SNAPSHOT_ATTRIBUTES}
+            exported.append((name, attributes, None if member['is_dir'] else self.read_bytes(name)))
+        return exported
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _add(self, name, is_dir, info=None, path=None, source_info=None, passthrough=False):
+        member = {
+            'info': info, # TarInfo to write (None: derived from path or created)
+            'path': path, # Source file in an extracted directory
+            'source_info': source_info, # Source member in the archive
+            'is_dir': is_dir,
+            'passthrough': passthrough, # Already written elsewhere, content not available
+            'data': None,
+            'text': None,
+            'dirty': False,
+            'new': False,
+        }
+        self._members[name] = member
+        return member
+
+    def add_member(self, info, data=None, source_info=None, passthrough=False):
+        """Adds an archive member, optionally with its content already loaded."""
+        name = normalize_member_name(info.name)
+        info = copy.copy(info)
+        info.name = name
+        info.pax_headers = {} # Drop tool-specific extended headers (e.g. macOS xattrs)
+        member = self._add(name, info.isdir(), info=info, source_info=source_info, passthrough=passthrough)
+        if data is not None:
+            self._set_content(name, member, data=data)
+
+    def _set_content(self, name, member, data=None, text=None):
+        old_size = len(member['data'] or b'') + len(member['text'] or '')
+        member['data'] = data
+        member['text'] = text
+        self.memory_bytes += len(data or b'') + len(text or '') - old_size
+        self.peak_memory_bytes = max(self.peak_memory_bytes, self.memory_bytes)
+        if self.max_memory_bytes is not None and self.memory_bytes > self.max_memory_bytes:
+            raise MemoryError(f"Backup tree exceeds the memory limit of {self.max_memory_bytes} bytes while loading {name}")
+
+    def _member(self, name):
+        member = self._members.get(name)
+        if member is None or member['is_dir']:
+            raise FileNotFoundError(f"No file member {name} in backup")
+        return member
+
+    def exists(self, name):
+        return name in self._members
+
+    def is_file(self, name):
+        return name in self._members and not self._members[name]['is_dir']
+
+    def is_dir(self, name):
+        return name in self._members and self._members[name]['is_dir']
+
+    def is_passthrough(self, name):
+        """Whether a member was copied to the output unread (see scan_backup_members()), so its content is not available."""
+        return name in self._members and self._members[name]['passthrough']
+
+    def names(self):
+        return list(self._members)
+
+    def children(self, dir_name):
+        """Returns the names of the direct children of a directory member, sorted."""
+        prefix = f"{dir_name}/" if dir_name else ""
+        return sorted(name for name in self._members
+                      if name.startswith(prefix) and '/' not in name[len(prefix):])
+
+    def read_bytes(self, name):
+        member = self._member(name)
+        if member['data'] is None and member['text'] is None:
+            if member['passthrough']:
+                raise ValueError(f"Member {name} is not held in memory")
+            if member['path'] is not None:
+                data = member['path'].read_bytes()
+            elif member['source_info'] is not None:
+                data = self._archive.extractfile(member['source_info']).read()
+            else:
+                data = b''
+            self.stats.count('bytes_read', len(data))
+            self._set_content(name, member, data=data)
+        if member['data'] is None:
+            return member['text'].encode('utf-8')
+        return member['data']
+
+    @contextlib.contextmanager
+    def open_buffer(self, name):
+        """Yields the content of a file member as a bytes-like object, for scanning with bytes patterns.
+
+        Unmodified members of an extracted directory are memory-mapped instead
+        of being loaded, so they are neither held in memory nor decoded; the
+        buffer is only valid inside the with block. All other members are
+        returned as by read_bytes().
+        """
+        member = self._member(name)
+        if member['path'] is None or member['dirty'] or member['data'] is not None or member['text'] is not None:
+            yield self.read_bytes(name)
+            return
+        with open(member['path'], 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                yield b'' # Empty files cannot be mapped
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                self.stats.count('bytes_read', size)
+                yield buffer
+
+    def read_text(self, name):
+        member = self._member(name)
+        if member['text'] is None:
+            # Keep the decoded text only; bytes are re-encoded when needed
+            self._set_content(name, member, text=self.read_bytes(name).decode('utf-8'))
+        return member['text']
+
+    def _ensure_parents(self, name):
+        parent = name.rpartition('/')[0]
+        if parent and parent not in self._members:
+            self.mkdir(parent)
+
+    def mkdir(self, name):
+        """Adds a new directory member (and missing parents)."""
+        if name in self._members:
+            return
+        self._ensure_parents(name)
+        member = self._add(name, is_dir=True)
+        member['dirty'] = member['new'] = True
+
+    def write_text(self, name, text):
+        self._write(name, text=text)
+
+    def write_bytes(self, name, data):
+        self._write(name, data=data)
+
+    def _write(self, name, data=None, text=None):
+        member = self._members.get(name)
+        if member is None:
+            self._ensure_parents(name)
+            member = self._add(name, is_dir=False)
+            member['new'] = True
+        elif member['is_dir']:
+            raise IsADirectoryError(f"Member {name} is a directory")
+        self._set_content(name, member, data=data, text=text)
+        member['dirty'] = True
+
+    def dirty_names(self):
+        return [name for name, member in self._members.items() if member['dirty']]
+
+    def ordered_names(self):
+        """Returns member names in archive order.
+
+        Sorted for directory sources. Otherwise, the source order is kept and
+        new members follow the last existing activities/ member that is not a
+        passthrough one, so that --stream writes the same order.
+        """
+        if self.sort_members:
+            return sorted(self._members, key=_member_sort_key)
+        existing = [name for name, member in self._members.items() if not member['new']]
+        new = sorted((name for name, member in self._members.items() if member['new']), key=_member_sort_key)
+        insert_at = max((i + 1 for i, name in enumerate(existing)
+                         if name.startswith('activities/') and not self._members[name]['passthrough']), default=0)
+        return existing[:insert_at] + new + existing[insert_at:]
+
+    def _tarinfo(self, tar, name, member):
+        if member['info'] is not None:
+            info = copy.copy(member['info'])
+        elif member['path'] is not None:
+            info = tar.gettarinfo(str(member['path']), arcname=name)
+        else:
+            info = tarfile.TarInfo(name)
+            info.mtime = int(time.time())
+            if member['is_dir']:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+            else:
+                info.mode = 0o644
+        if member['dirty'] and not member['new']:
+            info.mtime = int(time.time())
+        if self.fixed_mtime is not None:
+            normalize_tarinfo(info, self.fixed_mtime)
+        return info
+
+    def write_to_tar(self, tar):
+        """Writes all members (except passthrough ones) to an open tarfile. Returns the number written."""
+        count = 0
+        for name in self.ordered_names():
+            member = self._members[name]
+            if member['passthrough']:
+                continue
+            count += 1
+            if member['is_dir'] or not (member['dirty'] or member['data'] is not None or member['text'] is not None):
+                # Clean member: copy straight from the source
+                if member['path'] is not None and self.fixed_mtime is None:
+                    tar.add(str(member['path']), arcname=name, recursive=False)
+                    if not member['is_dir']:
+                        self.stats.count('bytes_read', member['path'].stat().st_size)
+                elif member['path'] is not None and not member['is_dir']:
+                    info = self._tarinfo(tar, name, member)
+                    with open(member['path'], 'rb') as f:
+                        tar.addfile(info, f)
+                    self.stats.count('bytes_read', info.size)
+                elif member['source_info'] is not None and member['source_info'].isfile():
+                    tar.addfile(self._tarinfo(tar, name, member), self._archive.extractfile(member['source_info']))
+                    self.stats.count('bytes_read', member['source_info'].size)
+                else:
+                    tar.addfile(self._tarinfo(tar, name, member))
+                continue
+            data = self.read_bytes(name)
+            info = self._tarinfo(tar, name, member)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        return count
+
+# --- Archive Compression ---
+
+DEFAULT_COMPRESSION_LEVEL = 9 # Same as tarfile's "w:gz"; 0 stores without compression
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+
+def _compress_gzip_member(block, level):
+    """Compresses one block into a complete gzip member (zlib releases the GIL while compressing)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff' # Magic, deflate, no flags, mtime 0, unknown OS
+    trailer = struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+    return header + compressor.compress(block) + compressor.flush() + trailer
+
+class ParallelGzipWriter:
+    """Write-only file object that gzip-compresses blocks concurrently.
+
+    The data is split into blocks of COMPRESSION_BLOCK_SIZE bytes, each block
+    is compressed into its own gzip member in a thread pool, and the members
+    are written in order. The result is a valid multi-member gzip file that
+    gzip, tar and Moodle read like a single-member one. Input and output bytes
+    are counted in stats (a PipelineStats) if given.
+    """
+
+    def __init__(self, fileobj, level=DEFAULT_COMPRESSION_LEVEL, threads=None, block_size=COMPRESSION_BLOCK_SIZE,
+                 stats=None):
+        self.fileobj = fileobj
+        self.stats = stats or PipelineStats(enabled=False)
+        self.level = level
+        self.block_size = block_size
+        self.threads = max(1, threads or os.cpu_count() or 1)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) if self.threads > 1 else None
+        self._members_written = 0
+        self.closed = False
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_in += len(data)
+        self.stats.count('bytes_compressed', len(data))
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block):
+        if self._pool is None:
+            self._write_member(_compress_gzip_member(block, self.level))
+            return
+        self._pending.append(self._pool.submit(_compress_gzip_member, block, self.level))
+        # Bound the memory used by blocks waiting to be written
+        while len(self._pending) > 2 * self.threads:
+            self._write_member(self._pending.popleft().result())
+
+    def _write_member(self, member):
+        self.fileobj.write(member)
+        self.bytes_out += len(member)
+        self.stats.count('bytes_written', len(member))
+        self._members_written += 1
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._buffer or not self._members_written and not self._pending:
+                self._submit(bytes(self._buffer)) # An empty input still needs one gzip member
+                self._buffer.clear()
+            while self._pending:
+                self._write_member(self._pending.popleft().result())
+            self.fileobj.flush()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            if self._pool is not None:
+                self._pool.shutdown()
+
+class CountingWriter:
+    """Write-only file object that counts the bytes passed to fileobj as counter in stats.
+
+    Closing it closes fileobj only if close_fileobj is set (for compressors
+    that wrap an output which must stay open).
+    """
+
+    def __init__(self, fileobj, stats, counter, close_fileobj=False):
+        self.fileobj = fileobj
+        self.stats = stats or PipelineStats(enabled=False)
+        self.counter = counter
+        self.close_fileobj = close_fileobj
+        self.closed = False
+
+    def write(self, data):
+        self.stats.count(self.counter, len(data))
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.close_fileobj:
+                self.fileobj.close()
+            else:
+                self.fileobj.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# --- Archive Codecs ---
+
+# Input archives are recognized by their first bytes; a tar without
+# compression has "ustar" at offset 257. Moodle itself only restores gzip
+# (the default output codec); the others are for templates and archives
+# exchanged with other tools. zstd needs the compression.zstd module (Python
+# 3.14+), which also adds zstd support to tarfile.
+ARCHIVE_MAGIC = (
+    (b'\x1f\x8b', 'gz'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'BZh', 'bz2'),
+    (b'\x28\xb5\x2f\xfd', 'zst'),
+)
+OUTPUT_CODECS = ('gz', 'xz', 'bz2', 'zst', 'tar')
+DEFAULT_OUTPUT_CODEC = 'gz'
+
+def codec_available(codec):
+    """Checks whether this Python can read and write archives compressed with codec."""
+    return codec in OUTPUT_CODECS and (codec != 'zst' or zstd is not None)
+
+def detect_archive_codec(path):
+    """Returns the codec of an archive by its magic bytes ('gz', 'xz', 'bz2', 'zst' or 'tar'), or None."""
+    with open(path, 'rb') as f:
+        header = f.read(262)
+    for magic, codec in ARCHIVE_MAGIC:
+        if header.startswith(magic):
+            return codec
+    return 'tar' if header[257:262] == b'ustar' else None
+
+def archive_label(codec):
+    """Returns the usual name of an archive format, e.g. tar.gz."""
+    return 'tar' if codec == 'tar' else f"tar.{codec}"
+
+def open_mbz_for_reading(path, stream=False):
+    """Opens a .mbz in any codec of detect_archive_codec() for reading. Returns the TarFile.
+
+    stream opens it for reading member by member only (tarfile "r|").
+    Raises tarfile.ReadError for unknown or unsupported formats.
+    """
+    codec = detect_archive_codec(path)
+    if codec is None:
+        raise tarfile.ReadError(f"{path} is not a tar archive (plain or compressed with gzip, xz, bzip2 or zstd)")
+    if not codec_available(codec):
+        raise tarfile.ReadError(f"{path} is compressed with zstd, which needs Python 3.14 or later")
+    return tarfile.open(path, f"r{'|' if stream else ':'}{'' if codec == 'tar' else codec}")
+
+def open_compressor(raw, codec=DEFAULT_OUTPUT_CODEC, level=DEFAULT_COMPRESSION_LEVEL, threads=None, stats=None):
+    """Returns a write-only file object that compresses into raw with codec (see OUTPUT_CODECS).
+
+    gz uses a ParallelGzipWriter with threads; xz, bz2 and zst compress in
+    one thread with level as preset or level (bz2 at least 1). Closing the
+    compressor leaves raw open.
+    """
+    if not codec_available(codec):
+        raise ValueError(f"Output codec {codec} is not supported by this Python")
+    if codec == 'gz':
+        return ParallelGzipWriter(raw, level, threads, stats=stats)
+    written = CountingWriter(raw, stats, 'bytes_written')
+    if codec == 'tar':
+        return written
+    if codec == 'xz':
+        compressor = lzma.LZMAFile(written, 'wb', preset=level)
+    elif codec == 'bz2':
+        compressor = bz2.BZ2File(written, 'wb', compresslevel=max(1, level))
+    else:
+        compressor = zstd.ZstdFile(written, 'wb', level=level)
+    return CountingWriter(compressor, stats, 'bytes_compressed', close_fileobj=True)
+
+# File name recorded in moodle_backup.xml when the output is a stream without a name (-o -)
+DEFAULT_STREAM_OUTPUT_NAME = "backup.mbz"
+
+def is_file_object(output):
+    """Checks whether an output is a writable file object rather than a path."""
+    return hasattr(output, 'write')
+
+def default_output_name(output):
+    """Returns the file name recorded in a backup written to output (a path or a file object)."""
+    return DEFAULT_STREAM_OUTPUT_NAME if is_file_object(output) else pathlib.Path(output).name
+
+@contextlib.contextmanager
+def open_mbz_for_writing(output, compression_level=DEFAULT_COMPRESSION_LEVEL, threads=None, stats=None,
+                         codec=DEFAULT_OUTPUT_CODEC):
+    """Opens a .mbz for writing, compressed with codec (see open_compressor()). Yields the TarFile.
+
+    output is a path or a writable binary file object (which is left open).
+    """
+    raw_context = contextlib.nullcontext(output) if is_file_object(output) else open(output, 'wb')
+    with raw_context as raw, \
+            open_compressor(raw, codec, compression_level, threads, stats) as compressed, \
+            tarfile.open(fileobj=compressed, mode="w|") as tar:
+        yield tar
+
 # --- Core Moodle Backup Modification Functions ---
 
-def extract_ids(base_path):
+class BackupIdIndex:
+    """IDs and member locations of a backup, collected in a single walk.
+
+    moodle_backup.xml and each file of every activities/assign_* directory are
+    read exactly once (the BackupTree keeps their content for later stages) and
+    scanned with one combined, precompiled pattern per file type.
+    """
+
+    def __init__(self, tree, state=None):
+        self.tree = tree
+        self.has_moodle_backup = False
+        self.module_ids = [] # <moduleid> values from moodle_backup.xml, in document order
+        self.section_id = None
+        self.backup_id = None
+        self.activities = {} # module ID -> IDs and member names of activities/assign_<module ID>
+        if state is not None:
+            # Reuse the result of an earlier scan of the same (unmodified) members
+            for key, value in copy.deepcopy(state).items():
+                setattr(self, key, value)
+            return
+        self._scan_moodle_backup()
+        self._scan_activities()
+
+    def state(self):
+        """Returns the scan result as a picklable dictionary (see state argument)."""
+        return copy.deepcopy({key: getattr(self, key) for key in
+                              ('has_moodle_backup', 'module_ids', 'section_id', 'backup_id', 'activities')})
+
+    def _scan_moodle_backup(self):
+        if not self.tree.is_file("moodle_backup.xml"):
+            return
+        self.has_moodle_backup = True
+        with self.tree.open_buffer("moodle_backup.xml") as content:
+            for match in MOODLE_BACKUP_ID_PATTERN.finditer(content):
+                module_id, section_id, backup_id = match.groups()
+                if module_id is not None:
+                    self.module_ids.append(module_id.decode('ascii'))
+                elif section_id is not None:
+                    if self.section_id is None:
+                        self.section_id = int(section_id)
+                elif self.backup_id is None:
+                    self.backup_id = backup_id.decode('ascii')
+
+    def _scan_activities(self):
+        tree = self.tree
+        for assign_dir in tree.children("activities"):
+            if not (assign_dir.startswith("activities/assign_") and tree.is_dir(assign_dir)):
+                continue
+            activity = {
+                'directory': assign_dir,
+                'assign_xml': None,
+                'activity_id': 0,
+                'context_id': None,
+                'plugin_config_ids': [],
+                'grade_item_id': 0,
+                'grading_area_id': 0,
+                'sortorder': 0,
+            }
+            assign_name = f"{assign_dir}/assign.xml"
+            if tree.is_file(assign_name):
+                activity['assign_xml'] = assign_name
+                for match in ASSIGN_ID_PATTERN.finditer(tree.read_text(assign_name)):
+                    act_id, plugin_config_id, context_id = match.groups()
+                    if act_id is not None:
+                        activity['activity_id'] = max(activity['activity_id'], int(act_id))
+                    elif plugin_config_id is not None:
+                        activity['plugin_config_ids'].append(int(plugin_config_id))
+                    elif activity['context_id'] is None:
+                        activity['context_id'] = int(context_id)
+            if tree.is_file(f"{assign_dir}/inforef.xml"):
+                activity['grade_item_id'] = find_max_id(INFOREF_GRADE_ITEM_PATTERN, tree.read_text(f"{assign_dir}/inforef.xml"))
+            if tree.is_file(f"{assign_dir}/grading.xml"):
+                activity['grading_area_id'] = find_max_id(GRADING_AREA_PATTERN, tree.read_text(f"{assign_dir}/grading.xml"))
+            if tree.is_file(f"{assign_dir}/grades.xml"):
+                activity['sortorder'] = find_max_id(GRADES_SORTORDER_PATTERN, tree.read_text(f"{assign_dir}/grades.xml"))
+            self.activities[assign_dir[len("activities/assign_"):]] = activity
+
+    def assign_xml_files(self):
+        """Returns the assign.xml member names of all activities, sorted."""
+        return [activity['assign_xml'] for activity in self.activities.values() if activity['assign_xml']]
+
+    def as_ids(self):
+        """Returns the IDs in the dictionary format used by the modification steps."""
+        with_assign = [a for a in self.activities.values() if a['assign_xml']]
+        context_ids = [a['context_id'] for a in with_assign if a['context_id']]
+        return {
+            'max_module_id': max(map(int, self.module_ids), default=0),
+            'max_activity_id': max((a['activity_id'] for a in with_assign), default=0),
+            'max_plugin_config_id': max((max(a['plugin_config_ids'], default=0) for a in with_assign), default=0),
+            'max_grade_item_id': max((a['grade_item_id'] for a in self.activities.values()), default=0),
+            'context_id': context_ids[0] if context_ids else None, # From activity
+            'max_context_id': max(context_ids, default=0),
+            'max_grading_area_id': max((a['grading_area_id'] for a in self.activities.values()), default=0),
+            'max_sortorder': max((a['sortorder'] for a in self.activities.values()), default=0),
+            'section_id': self.section_id,
+            'existing_module_ids': list(self.module_ids),
+            'existing_activity_ids': sorted(set(a['activity_id'] for a in with_assign)),
+            'original_backup_id': self.backup_id
+        }
+
+def _as_tree(source):
+    """Accepts a BackupTree or the path of an extracted backup directory."""
+    return source if isinstance(source, BackupTree) else BackupTree.from_directory(source)
+
+def extract_ids(tree, index=None):
     """Extracts maximum IDs and constants from existing backup files."""
     print("\nExtracting existing IDs...")
-    ids = {
-        'max_module_id': 0,
-        'max_activity_id': 0,
-        'max_plugin_config_id': 0,
-        'max_grade_item_id': 0,
-        'context_id': None, # From activity
-        'max_context_id': 0, # New - track highest contextid
-        'max_grading_area_id': 0, # New - track highest grading area id
-        'max_sortorder': 0, # New - track highest sortorder
-        'section_id': None,
-        'existing_module_ids': [],
-        'existing_activity_ids': [],
-        'original_backup_id': None
-    }
-
-    # 1. moodle_backup.xml
-    moodle_backup_path = base_path / "moodle_backup.xml"
-    if moodle_backup_path.is_file():
-        content = moodle_backup_path.read_text()
-        # Max moduleid from <activity><moduleid>...
-        ids['max_module_id'] = find_max_id(re.compile(r'<moduleid>(\d+)</moduleid>'), content)
-        ids['existing_module_ids'] = [str(m) for m in re.findall(r'<moduleid>(\d+)</moduleid>', content)]
-        # sectionid from first <activity><sectionid>...
-        ids['section_id'] = find_first_id(re.compile(r'<sectionid>(\d+)</sectionid>'), content)
-        # Original backup ID
-        backup_id_match = re.search(r'<detail backup_id="([a-f0-9]+)">', content)
-        if backup_id_match:
-            ids['original_backup_id'] = backup_id_match.group(1)
+    if index is None:
+        index = BackupIdIndex(_as_tree(tree))
+    ids = index.as_ids()
+    if index.has_moodle_backup:
         print(f"  Found in moodle_backup.xml: max_module_id={ids['max_module_id']}, section_id={ids['section_id']}, backup_id={ids['original_backup_id']}")
-
-    # 2. assign.xml files
-    activity_dir = base_path / "activities"
-    max_act_id_overall = 0
-    max_plugin_id_overall = 0
-    max_context_id_overall = 0
-    existing_act_ids_temp = []
-
-    if activity_dir.is_dir():
-        for item in activity_dir.glob('assign_*/assign.xml'):
-            if item.is_file():
-                content = item.read_text()
-                # Max activity id (should match assign id)
-                act_id = find_max_id(re.compile(r'<(?:activity|assign) id="(\d+)">'), content)
-                max_act_id_overall = max(max_act_id_overall, act_id)
-                existing_act_ids_temp.append(act_id)
-                # Max plugin_config id
-                plug_id = find_max_id(re.compile(r'<plugin_config id="(\d+)">'), content)
-                max_plugin_id_overall = max(max_plugin_id_overall, plug_id)
-                # Max context ID
-                context_id = find_first_id(re.compile(r'<activity.*?contextid="(\d+)".*?>'), content)
-                if context_id:
-                    max_context_id_overall = max(max_context_id_overall, context_id)
-                    # Also track the first context ID found for backward compatibility
-                    if ids['context_id'] is None:
-                        ids['context_id'] = context_id
-
-    ids['max_activity_id'] = max_act_id_overall
-    ids['existing_activity_ids'] = sorted(list(set(existing_act_ids_temp)))
-    ids['max_plugin_config_id'] = max_plugin_id_overall
-    ids['max_context_id'] = max_context_id_overall
     print(f"  Found in assign.xml files: max_activity_id={ids['max_activity_id']}, max_plugin_config_id={ids['max_plugin_config_id']}, max_context_id={ids['max_context_id']}")
-
-    # 3. inforef.xml files
-    max_grade_id_overall = 0
-    if activity_dir.is_dir():
-        for item in activity_dir.glob('assign_*/inforef.xml'):
-            if item.is_file():
-                content = item.read_text()
-                grade_id = find_max_id(re.compile(r'<grade_item>\s*<id>(\d+)</id>\s*</grade_item>'), content)
-                max_grade_id_overall = max(max_grade_id_overall, grade_id)
-    ids['max_grade_item_id'] = max_grade_id_overall
     print(f"  Found in inforef.xml files: max_grade_item_id={ids['max_grade_item_id']}")
-
-    # 4. grading.xml files
-    max_grading_area_id_overall = 0
-    if activity_dir.is_dir():
-        for item in activity_dir.glob('assign_*/grading.xml'):
-            if item.is_file():
-                content = item.read_text()
-                area_id = find_max_id(re.compile(r'<area id="(\d+)">'), content)
-                max_grading_area_id_overall = max(max_grading_area_id_overall, area_id)
-    ids['max_grading_area_id'] = max_grading_area_id_overall
     print(f"  Found in grading.xml files: max_grading_area_id={ids['max_grading_area_id']}")
-
-    # 5. grades.xml files
-    max_sortorder_overall = 0
-    if activity_dir.is_dir():
-        for item in activity_dir.glob('assign_*/grades.xml'):
-            if item.is_file():
-                content = item.read_text()
-                sortorder = find_max_id(re.compile(r'<sortorder>(\d+)</sortorder>'), content)
-                max_sortorder_overall = max(max_sortorder_overall, sortorder)
-    ids['max_sortorder'] = max_sortorder_overall
     print(f"  Found in grades.xml files: max_sortorder={ids['max_sortorder']}")
-
     return ids
 
-def extract_mbz(mbz_path, extract_to):
-    """Extracts the .mbz (tar.gz) file."""
+# IDs that grow by one per new assignment: (key of the ID block, maximum in extract_ids())
+NEW_ASSIGNMENT_IDS = (
+    ('module_id', 'max_module_id'),
+    ('activity_id', 'max_activity_id'),
+    ('grade_item_id', 'max_grade_item_id'),
+    ('context_id', 'max_context_id'),
+    ('grading_area_id', 'max_grading_area_id'),
+    ('sortorder', 'max_sortorder'),
+)
+
+class IdAllocator:
+    """Reserves the complete ID block of every new assignment in advance.
+
+    Each block follows from the extract_ids() maximums and the number of
+    <plugin_config> IDs per assignment (plugin_configs, see
+    compile_assignment_template()) alone. The n-th new assignment therefore
+    gets the same IDs no matter in which order the assignments are created,
+    and a failed one never shifts or reuses the IDs of the others.
+    """
+
+    def __init__(self, ids, plugin_configs):
+        self.ids = ids
+        self.plugin_configs = plugin_configs
+        self.allocated = 0
+
+    def block(self, index):
+        """Returns the IDs of the index-th (0-based) new assignment."""
+        block = {key: self.ids[maximum] + index + 1 for key, maximum in NEW_ASSIGNMENT_IDS}
+        # First of plugin_configs consecutive IDs
+        block['plugin_config_id'] = self.ids['max_plugin_config_id'] + 1 + index * self.plugin_configs
+        return block
+
+    def allocate(self):
+        """Reserves and returns the ID block of the next new assignment."""
+        block = self.block(self.allocated)
+        self.allocated += 1
+        return block
+
+# Files written at once by extract_mbz(). Writing is bound by the latency of
+# the temporary directory (e.g. on a network drive), not by the CPU count.
+EXTRACT_WORKERS = 8
+
+def write_extracted_file(path, data, member):
+    """Writes one extracted file with the mode and mtime of its member (called from extract_mbz() threads)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    if member.mode is not None:
+        os.chmod(path, member.mode)
+    os.utime(path, (member.mtime, member.mtime))
+
+def extract_mbz(mbz_path, extract_to, stats=None, workers=EXTRACT_WORKERS, member_names=None):
+    """Extracts the .mbz file (tar.gz or any codec of detect_archive_codec()), except dotfiles.
+
+    Dotfile members (e.g. .DS_Store, macOS ._* files or .git leftovers, see
+    is_dotfile_member()) are skipped while reading, so they are never
+    written. The archive is read in order while up to workers threads write
+    the files, so slow temporary directories are not waited on file by
+    file; directory attributes are set last, as tarfile's extractall() does.
+    Returns the number of skipped members. The names of the extracted
+    members are appended to member_names (a list) in archive order if given.
+    The archive and extracted sizes are counted in stats if given.
+    """
     print(f"Extracting {mbz_path} to {extract_to}...")
-    mode = "r:gz" # Standard moodle backup is .tar.gz
+    extract_to = pathlib.Path(extract_to)
+    workers = max(1, workers)
+    data_filter = tarfile.data_filter if hasattr(tarfile, 'data_filter') and callable(tarfile.data_filter) else None
+    skipped = 0
+    extracted_bytes = 0
+    directories = []
     try:
-        with tarfile.open(mbz_path, mode) as tar:
-            if hasattr(tarfile, 'data_filter') and callable(tarfile.data_filter):
-                tar.extractall(path=extract_to, filter='data')
-            else:
-                 tar.extractall(path=extract_to)
-            print(f"Extracted as {mode}")
+        with open_mbz_for_reading(mbz_path) as tar, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for member in tar:
+                if is_dotfile_member(normalize_member_name(member.name)):
+                    skipped += 1
+                    continue
+                if data_filter is not None:
+                    member = data_filter(member, str(extract_to)) # Rejects absolute paths, .. and unsafe links
+                elif os.path.isabs(member.name) or '..' in pathlib.PurePosixPath(member.name).parts:
+                    raise ValueError(f"Unsafe member path {member.name}")
+                if member_names is not None:
+                    member_names.append(normalize_member_name(member.name))
+                if member.isfile():
+                    if len(pending) >= 2 * workers:
+                        # Bounds the file contents waiting to be written
+                        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    data = tar.extractfile(member).read()
+                    extracted_bytes += len(data)
+                    pending.add(pool.submit(write_extracted_file, extract_to / member.name, data, member))
+                elif member.isdir():
+                    (extract_to / member.name).mkdir(parents=True, exist_ok=True)
+                    directories.append(member)
+                elif data_filter is not None:
+                    tar.extract(member, path=extract_to, filter='data')
+                else:
+                    tar.extract(member, path=extract_to)
+            for future in concurrent.futures.as_completed(pending):
+                future.result()
+        for member in sorted(directories, key=lambda member: member.name, reverse=True):
+            path = extract_to / member.name
+            if member.mode is not None:
+                os.chmod(path, member.mode)
+            os.utime(path, (member.mtime, member.mtime))
+        print(f"Extracted as {archive_label(detect_archive_codec(mbz_path))}, skipped {skipped} dotfiles/directories.")
+        if stats is not None:
+            stats.count('bytes_read', os.path.getsize(mbz_path))
+            stats.count('bytes_written', extracted_bytes)
+        return skipped
     except tarfile.ReadError as e:
         print(f"Error reading archive {mbz_path}: {e}")
-        print("Is it a valid .mbz (tar.gz or tar.xz) file?")
+        print("Is it a valid .mbz (tar.gz, tar.xz, tar.bz2, tar.zst or tar) file?")
         raise
     except Exception as e:
         print(f"An unexpected error occurred during extraction: {e}")
         raise
 
-def delete_dotfiles(base_path):
-    """Recursively deletes files and directories starting with '.'"""
-    print(f"\nDeleting dotfiles and dot directories in {base_path}...")
-    deleted_count = 0
-    path_obj = pathlib.Path(base_path)
-    for item in path_obj.rglob('.*'):
-        if not item.exists():
-            continue
-        try:
-            if item.resolve() == path_obj.resolve():
-                continue
-            if item.is_file():
-                item.unlink()
-                print(f"  Deleted file: {item.relative_to(base_path)}")
-                deleted_count += 1
-            elif item.is_dir():
-                if item.name not in ('.', '..'):
-                    shutil.rmtree(item)
-                    print(f"  Deleted directory: {item.relative_to(base_path)}")
-                    deleted_count += 1
-        except Exception as e:
-            print(f"  Error deleting {item.relative_to(base_path)}: {e}")
-    print(f"Deleted {deleted_count} dotfiles/directories.")
-
-def find_assign_xml_files(base_path):
-    """Finds all assign.xml files within the activities directory, sorted."""
-    activity_dir = pathlib.Path(base_path) / "activities"
-    assign_files = []
-    if activity_dir.is_dir():
-        assign_files = sorted(list(activity_dir.glob('assign_*/assign.xml')))
-    print(f"Found {len(assign_files)} assignment files: {[str(f.relative_to(base_path)) for f in assign_files]}")
+def find_assign_xml_files(tree, index=None):
+    """Finds all assign.xml members within the activities directory, sorted."""
+    if index is None:
+        index = BackupIdIndex(_as_tree(tree))
+    assign_files = index.assign_xml_files()
+    print(f"Found {len(assign_files)} assignment files: {assign_files}")
     return assign_files
 
-def modify_assignment(file_path, new_name, new_due_ts, new_cutoff_ts, new_activation_ts=None):
+def modify_assignment(tree, file_path, new_name, new_due_ts, new_cutoff_ts, new_activation_ts=None):
     """Modifies name, duedate, and cutoffdate in an existing assign.xml."""
     # Simplified: assumes IDs are not changed for existing assignments
-    print(f"\nModifying existing {file_path.relative_to(file_path.parent.parent.parent)}...")
+    print(f"\nModifying existing {file_path}...")
     modified = False
     try:
-        content = file_path.read_text()
+        content = tree.read_text(file_path)
         original_content = content
         changes = []
 
@@ -322,7 +1218,7 @@ def modify_assignment(file_path, new_name, new_due_ts, new_cutoff_ts, new_activa
         
 
         if content != original_content:
-            file_path.write_text(content)
+            tree.write_text(file_path, content)
             print("  Changes written.")
             for change in changes:
                 print(change)
@@ -335,69 +1231,119 @@ def modify_assignment(file_path, new_name, new_due_ts, new_cutoff_ts, new_activa
 
     return modified
 
-def create_new_assignment_files(base_path, assign_template_content, inforef_template_content, 
+# Files of a new assignment that do not depend on its IDs
+NEW_GRADE_HISTORY_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<grade_history>
+  <grade_grades>
+  </grade_grades>
+</grade_history>"""
+NEW_ROLES_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<roles>
+  <role_overrides>
+  </role_overrides>
+  <role_assignments>
+  </role_assignments>
+</roles>"""
+
+# Slots of assign.xml and inforef.xml, filled in for every new assignment (see
+# compile_assignment_template()). Each pattern is replaced once, in this order.
+ASSIGN_TEMPLATE_SLOTS = (
+    ('activity_id', r'<activity id="\d+"', '<activity id="{}"'),
+    ('module_id', r'moduleid="\d+"', 'moduleid="{}"'),
+    ('context_id', r'contextid="\d+"', 'contextid="{}"'),
+    ('activity_id', r'<assign id="\d+">', '<assign id="{}">'),
+    ('name', r'<name>.*?</name>', '<name>{}</name>'),
+    ('due_ts', r'<duedate>\d+</duedate>', '<duedate>{}</duedate>'),
+    ('cutoff_ts', r'<cutoffdate>\d+</cutoffdate>', '<cutoffdate>{}</cutoffdate>'),
+    ('activation_ts', r'<allowsubmissionsfromdate>\d+</allowsubmissionsfromdate>', '<allowsubmissionsfromdate>{}</allowsubmissionsfromdate>'),
+)
+PLUGIN_CONFIG_SLOT = (r'<plugin_config id="\d+">', '<plugin_config id="{}">') # Numbered, every occurrence
+INFOREF_TEMPLATE_SLOTS = (
+    ('grade_item_id', r'<id>\d+</id>', '<id>{}</id>'),
+)
+
+def compile_assignment_template(assign_template_content, inforef_template_content):
+    """Compiles the assign.xml and inforef.xml templates for new assignments once per template.
+
+    Returns a dictionary with the slot templates (see compile_slot_template())
+    assign_xml and inforef_xml, the number of <plugin_config> IDs
+    (plugin_configs, slots plugin_config_0, plugin_config_1, ...) and the
+    template's allowsubmissionsfromdate, kept if an assignment has no
+    activation_ts. It is JSON-serializable, so template snapshots keep it.
+    """
+    plugin_config_pattern, plugin_config_format = PLUGIN_CONFIG_SLOT
+    plugin_configs = len(re.findall(plugin_config_pattern, assign_template_content))
+    plugin_config_slots = tuple((f"plugin_config_{i}", plugin_config_pattern, plugin_config_format)
+                                for i in range(plugin_configs))
+    activation_match = re.search(r'<allowsubmissionsfromdate>(\d+)</allowsubmissionsfromdate>', assign_template_content)
+    return {
+        'assign_xml': compile_slot_template(assign_template_content, ASSIGN_TEMPLATE_SLOTS + plugin_config_slots),
+        'inforef_xml': compile_slot_template(inforef_template_content, INFOREF_TEMPLATE_SLOTS),
+        'plugin_configs': plugin_configs,
+        'allowsubmissionsfromdate': activation_match.group(1) if activation_match else None,
+    }
+
+def create_new_assignment_files(tree, assignment_template, 
                             new_module_id, new_activity_id, start_plugin_config_id, new_grade_item_id, 
-                            new_context_id, new_grading_area_id, new_sortorder, assignment_info, section_id):
-    """Creates directory and files for a new assignment."""
-    print(f"\nCreating new assignment files for module ID {new_module_id}...")
-    assign_dir = base_path / "activities" / f"assign_{new_module_id}"
-    assign_dir.mkdir(parents=True, exist_ok=True)
+                            new_context_id, new_grading_area_id, new_sortorder, assignment_info, section_id,
+                            created_at=None, verbose=True, section_number=1):
+    """Creates directory and files for a new assignment. Returns True on success.
+
+    assignment_template is the result of compile_assignment_template(), so
+    assign.xml and inforef.xml are rendered without any regex work. The
+    plugin_config IDs are start_plugin_config_id and the following ones, as
+    reserved by IdAllocator. The module is placed in section_id, whose
+    position in the course is section_number. created_at is the timestamp
+    used for <added>/<timecreated> (default: now).
+    """
+    if created_at is None:
+        created_at = int(time.time())
+    if verbose:
+        print(f"\nCreating new assignment files for module ID {new_module_id}...")
+    assign_dir = f"activities/assign_{new_module_id}"
+    tree.mkdir(assign_dir)
 
     current_plugin_config_id = start_plugin_config_id
     files_created = []
 
     try:
         # 1. Create assign.xml
-        assign_content = assign_template_content
-
-        # Replace IDs first
-        assign_content = re.sub(r'<activity id="\d+"', f'<activity id="{new_activity_id}"', assign_content, count=1)
-        assign_content = re.sub(r'moduleid="\d+"', f'moduleid="{new_module_id}"', assign_content, count=1)
-        assign_content = re.sub(r'contextid="\d+"', f'contextid="{new_context_id}"', assign_content, count=1)
-        assign_content = re.sub(r'<assign id="\d+">', f'<assign id="{new_activity_id}">', assign_content, count=1)
-
-        # Replace data
-        assign_content = re.sub(r'<name>.*?</name>', f'<name>{assignment_info["name"]}</name>', assign_content, count=1)
-        assign_content = re.sub(r'<duedate>\d+</duedate>', f'<duedate>{assignment_info["due_ts"]}</duedate>', assign_content, count=1)
-        assign_content = re.sub(r'<cutoffdate>\d+</cutoffdate>', f'<cutoffdate>{assignment_info["cutoff_ts"]}</cutoffdate>', assign_content, count=1)
-        
-        # Set activation date if provided
-        if "activation_ts" in assignment_info:
-            assign_content = re.sub(r'<allowsubmissionsfromdate>\d+</allowsubmissionsfromdate>',
-                                   f'<allowsubmissionsfromdate>{assignment_info["activation_ts"]}</allowsubmissionsfromdate>', 
-                                   assign_content, count=1)
-                                   
-        
-
-        # Replace plugin_config IDs sequentially
-        def replace_plugin_id(match):
-            nonlocal current_plugin_config_id
-            replacement = f'<plugin_config id="{current_plugin_config_id}">'
+        values = {
+            'activity_id': str(new_activity_id),
+            'module_id': str(new_module_id),
+            'context_id': str(new_context_id),
+            'name': assignment_info["name"],
+            'due_ts': str(assignment_info["due_ts"]),
+            'cutoff_ts': str(assignment_info["cutoff_ts"]),
+            # Keep the template's activation date if none is provided
+            'activation_ts': str(assignment_info.get("activation_ts", assignment_template['allowsubmissionsfromdate'])),
+            'grade_item_id': str(new_grade_item_id),
+        }
+        # plugin_config IDs are numbered sequentially
+        for i in range(assignment_template['plugin_configs']):
+            values[f"plugin_config_{i}"] = str(current_plugin_config_id)
             current_plugin_config_id += 1
-            return replacement
+        assign_content = render_slot_template(assignment_template['assign_xml'], values)
 
-        assign_content = re.sub(r'<plugin_config id="\d+">', replace_plugin_id, assign_content)
-
-        assign_xml_path = assign_dir / "assign.xml"
-        assign_xml_path.write_text(assign_content)
-        files_created.append(f"  Created {assign_xml_path.relative_to(base_path)}")
+        assign_xml_path = f"{assign_dir}/assign.xml"
+        tree.write_text(assign_xml_path, assign_content)
+        files_created.append(f"  Created {assign_xml_path}")
 
         # 2. Create inforef.xml
-        inforef_content = inforef_template_content
-        inforef_content = re.sub(r'<id>\d+</id>', f'<id>{new_grade_item_id}</id>', inforef_content, count=1)
+        inforef_content = render_slot_template(assignment_template['inforef_xml'], values)
 
-        inforef_xml_path = assign_dir / "inforef.xml"
-        inforef_xml_path.write_text(inforef_content)
-        files_created.append(f"  Created {inforef_xml_path.relative_to(base_path)}")
+        inforef_xml_path = f"{assign_dir}/inforef.xml"
+        tree.write_text(inforef_xml_path, inforef_content)
+        files_created.append(f"  Created {inforef_xml_path}")
 
         # 3. Create module.xml
         module_content = f"""<?xml version="1.0" encoding="UTF-8"?>
 <module id="{new_module_id}" version="2024100700">
   <modulename>assign</modulename>
   <sectionid>{section_id}</sectionid>
-  <sectionnumber>1</sectionnumber>
+  <sectionnumber>{section_number}</sectionnumber>
   <idnumber></idnumber>
-  <added>{int(time.time())}</added>
+  <added>{created_at}</added>
   <score>0</score>
   <indent>0</indent>
   <visible>1</visible>
@@ -421,12 +1367,12 @@ def create_new_assignment_files(base_path, assign_template_content, inforef_temp
   <tags>
   </tags>
 </module>"""
-        module_xml_path = assign_dir / "module.xml"
-        module_xml_path.write_text(module_content)
-        files_created.append(f"  Created {module_xml_path.relative_to(base_path)}")
+        module_xml_path = f"{assign_dir}/module.xml"
+        tree.write_text(module_xml_path, module_content)
+        files_created.append(f"  Created {module_xml_path}")
 
         # 4. Create grades.xml
-        current_time = int(time.time())
+        current_time = created_at
         grades_content = f"""<?xml version="1.0" encoding="UTF-8"?>
 <activity_gradebook>
   <grade_items>
@@ -467,9 +1413,9 @@ def create_new_assignment_files(base_path, assign_template_content, inforef_temp
   <grade_letters>
   </grade_letters>
 </activity_gradebook>"""
-        grades_xml_path = assign_dir / "grades.xml"
-        grades_xml_path.write_text(grades_content)
-        files_created.append(f"  Created {grades_xml_path.relative_to(base_path)}")
+        grades_xml_path = f"{assign_dir}/grades.xml"
+        tree.write_text(grades_xml_path, grades_content)
+        files_created.append(f"  Created {grades_xml_path}")
 
         # 5. Create grading.xml
         grading_content = f"""<?xml version="1.0" encoding="UTF-8"?>
@@ -481,50 +1427,75 @@ def create_new_assignment_files(base_path, assign_template_content, inforef_temp
     </definitions>
   </area>
 </areas>"""
-        grading_xml_path = assign_dir / "grading.xml"
-        grading_xml_path.write_text(grading_content)
-        files_created.append(f"  Created {grading_xml_path.relative_to(base_path)}")
+        grading_xml_path = f"{assign_dir}/grading.xml"
+        tree.write_text(grading_xml_path, grading_content)
+        files_created.append(f"  Created {grading_xml_path}")
 
         # 6. Create grade_history.xml
-        grade_history_content = """<?xml version="1.0" encoding="UTF-8"?>
-<grade_history>
-  <grade_grades>
-  </grade_grades>
-</grade_history>"""
-        grade_history_xml_path = assign_dir / "grade_history.xml"
-        grade_history_xml_path.write_text(grade_history_content)
-        files_created.append(f"  Created {grade_history_xml_path.relative_to(base_path)}")
+        grade_history_xml_path = f"{assign_dir}/grade_history.xml"
+        tree.write_text(grade_history_xml_path, NEW_GRADE_HISTORY_XML)
+        files_created.append(f"  Created {grade_history_xml_path}")
 
         # 7. Create roles.xml
-        roles_content = """<?xml version="1.0" encoding="UTF-8"?>
-<roles>
-  <role_overrides>
-  </role_overrides>
-  <role_assignments>
-  </role_assignments>
-</roles>"""
-        roles_xml_path = assign_dir / "roles.xml"
-        roles_xml_path.write_text(roles_content)
-        files_created.append(f"  Created {roles_xml_path.relative_to(base_path)}")
+        roles_xml_path = f"{assign_dir}/roles.xml"
+        tree.write_text(roles_xml_path, NEW_ROLES_XML)
+        files_created.append(f"  Created {roles_xml_path}")
 
         # Print summary of files created
-        for file_msg in files_created:
-            print(file_msg)
+        if verbose:
+            for file_msg in files_created:
+                print(file_msg)
 
-        return current_plugin_config_id # Return the next available ID
+        return True
 
     except Exception as e:
         print(f"Error creating files for module {new_module_id}: {e}")
-        return start_plugin_config_id # Return original start ID on error
+        return False
 
-def update_section_xml(section_xml_path, all_module_ids, section_title=None):
+def create_new_assignments(tree, assignment_template, new_assignments, verbose=True, created_at=None):
+    """Creates the files of all new assignments in one pass. Returns True if all of them were created.
+
+    assignment_template is the result of compile_assignment_template() for
+    the assign.xml and inforef.xml templates. new_assignments is a list of
+    ID blocks (see IdAllocator) with the assignment_info, section_id and
+    section_number of each new assignment. All of them share one creation timestamp (created_at,
+    default: now). Without verbose, only a summary line is printed.
+    """
+    if created_at is None:
+        created_at = int(time.time())
+    failed = 0
+    for new in new_assignments:
+        if not create_new_assignment_files(
+            tree,
+            assignment_template,
+            new['module_id'],
+            new['activity_id'],
+            new['plugin_config_id'],
+            new['grade_item_id'],
+            new['context_id'],
+            new['grading_area_id'],
+            new['sortorder'],
+            new['assignment_info'],
+            new['section_id'],
+            created_at,
+            verbose,
+            new['section_number']
+        ):
+            failed += 1
+    if not verbose and new_assignments:
+        print(f"\nCreated {len(new_assignments) - failed} new assignments (activities/assign_{new_assignments[0]['module_id']} to assign_{new_assignments[-1]['module_id']}).")
+    if failed:
+        print(f"Error: Failed to create {failed} of {len(new_assignments)} new assignments.")
+    return not failed
+
+def update_section_xml(tree, section_xml_path, all_module_ids, section_title=None, verbose=True):
     """Updates the sequence in section.xml and optionally the section title."""
-    print(f"\nUpdating {section_xml_path.relative_to(section_xml_path.parent.parent.parent)}...") # More informative path
-    if not section_xml_path.is_file():
+    print(f"\nUpdating {section_xml_path}...")
+    if not tree.is_file(section_xml_path):
         print(f"  Error: {section_xml_path} not found. Cannot update sequence.")
         return False
     try:
-        content = section_xml_path.read_text()
+        content = tree.read_text(section_xml_path)
         original_content = content # Store original content
         changes_made = False
         
@@ -537,7 +1508,10 @@ def update_section_xml(section_xml_path, all_module_ids, section_title=None):
             count=1
         )
         if count > 0 and new_content != original_content:
-            print(f"  Updated sequence to: {sequence_str}")
+            if verbose or not all_module_ids:
+                print(f"  Updated sequence to: {sequence_str}")
+            else:
+                print(f"  Updated sequence to {len(all_module_ids)} modules ({all_module_ids[0]} to {all_module_ids[-1]})")
             content = new_content
             changes_made = True
         elif count == 0:
@@ -562,7 +1536,7 @@ def update_section_xml(section_xml_path, all_module_ids, section_title=None):
                 print("  Warning: Could not find <name> tag in section.xml.")
         
         if changes_made:
-            section_xml_path.write_text(content)
+            tree.write_text(section_xml_path, content)
             return True
         else: 
             print("  No changes needed to make.")
@@ -571,248 +1545,2049 @@ def update_section_xml(section_xml_path, all_module_ids, section_title=None):
         print(f"Error modifying file {section_xml_path}: {e}")
         return False
 
-def update_moodle_backup_xml(xml_path, output_filename, original_backup_id, new_backup_id, all_assignment_details, section_id, added_module_ids, section_title=None, target_start_timestamp=None):
-    """Modifies moodle_backup.xml: filename, backup_id, startdate, rebuilds activities, adds settings."""
-    print(f"\nUpdating {xml_path.name}...")
-    if not xml_path.is_file():
+# Section of a module in its module.xml (moved with --section-layout)
+MODULE_SECTION_PATTERN = re.compile(r'<sectionid>\d+</sectionid>(\s*)<sectionnumber>\d+</sectionnumber>')
+SECTION_NUMBER_PATTERN = re.compile(r'<number>(\d+)</number>')
+
+def backup_section_ids(tree):
+    """Returns the IDs of the sections in <sections> of moodle_backup.xml, in order."""
+    with tree.open_buffer("moodle_backup.xml") as content:
+        return [int(match.group(1)) for match in SECTION_ENTRY_PATTERN.finditer(content)]
+
+def section_number(tree, section_id):
+    """Returns the <number> (position in the course) of a section from its section.xml, 1 if unknown."""
+    section_xml_path = f"sections/section_{section_id}/section.xml"
+    if tree.is_file(section_xml_path):
+        match = SECTION_NUMBER_PATTERN.search(tree.read_text(section_xml_path))
+        if match:
+            return int(match.group(1))
+    return 1
+
+def place_assignments(tree, first_section_id, assignment_count, section_layout=None, section_title=None):
+    """Returns the section ID of each assignment and the new titles of the sections (by ID, None to keep).
+
+    Without section_layout (see parse_section_layout()), all assignments go
+    to first_section_id, the section of the first existing assignment, and
+    section_title is its title. Otherwise, the n-th range of the layout goes
+    to the n-th section of <sections>, counting from first_section_id;
+    section_title names that section unless its range has a title. Raises
+    ValueError if the backup has too few sections for the layout.
+    """
+    if not section_layout:
+        return [first_section_id] * assignment_count, {first_section_id: section_title}
+    section_ids = backup_section_ids(tree)
+    if first_section_id not in section_ids:
+        raise ValueError(f"Section {first_section_id} of the first assignment is not in <sections> of moodle_backup.xml")
+    section_ids = section_ids[section_ids.index(first_section_id):]
+    if len(section_layout) > len(section_ids):
+        raise ValueError(f"--section-layout has {len(section_layout)} ranges, but the backup has only {len(section_ids)} sections from section {first_section_id} on")
+    placement, titles = [], {}
+    for entry, section_id in zip(section_layout, section_ids):
+        placement.extend([section_id] * (entry['last'] - entry['first'] + 1))
+        titles[section_id] = entry['title']
+    if section_title and not titles[first_section_id]:
+        titles[first_section_id] = section_title
+    return placement[:assignment_count], titles
+
+def move_module_to_section(tree, module_id, section_id, number):
+    """Sets the section (ID and number) of an existing assignment in its module.xml. Returns True if it changed."""
+    module_xml_path = f"activities/assign_{module_id}/module.xml"
+    if not tree.is_file(module_xml_path):
+        print(f"  Warning: {module_xml_path} not found, cannot move module {module_id} to section {section_id}.")
+        return False
+    content = tree.read_text(module_xml_path)
+    new_content = MODULE_SECTION_PATTERN.sub(
+        lambda match: f"<sectionid>{section_id}</sectionid>{match.group(1)}<sectionnumber>{number}</sectionnumber>",
+        content, count=1)
+    if new_content == content:
+        return False
+    tree.write_text(module_xml_path, new_content)
+    print(f"  Moved module {module_id} to section {section_id}.")
+    return True
+
+def remove_from_sequence(tree, section_id, module_ids, verbose=True):
+    """Removes modules (e.g. placed in another section by this build) from the <sequence> of a section, if it lists any."""
+    section_xml_path = f"sections/section_{section_id}/section.xml"
+    if not tree.is_file(section_xml_path):
+        return True
+    sequence = re.search(r'<sequence>(.*?)</sequence>', tree.read_text(section_xml_path))
+    listed = [module_id for module_id in (sequence.group(1).split(',') if sequence else []) if module_id]
+    remaining = [module_id for module_id in listed if module_id not in module_ids]
+    if remaining == listed:
+        return True
+    return update_section_xml(tree, section_xml_path, remaining, verbose=verbose)
+
+# Tokens of moodle_backup.xml that edits are anchored to: whole <setting>
+# blocks, start dates, backup_id attributes and the tags around names,
+# activities and sections. All anchors are found in one pass over these
+# tokens instead of one full-document regex per edit. The patterns work on
+# the raw UTF-8 bytes, so the file is never decoded as a whole; only the
+# regions that are rewritten are decoded.
+MOODLE_BACKUP_TOKEN_PATTERN = re.compile(
+    rb'(?P<setting><setting>.*?</setting>)'
+    rb'|<(?P<date_tag>startdate|original_course_startdate)>(?P<date>\d+)</(?P=date_tag)>'
+    rb'|backup_id="(?P<backup_id>[^"]*)"'
+    rb'|<(?P<close>/?)(?P<tag>information|name|activities|activity|details|course|section|sectionid|title)\b[^>]*>',
+    re.DOTALL)
+FILENAME_SETTING_PATTERN = re.compile(
+    rb'<setting>\s*<level>root</level>\s*<name>filename</name>\s*<value>(.*?)</value>\s*</setting>', re.DOTALL)
+NAME_TAG_PATTERN = re.compile(rb'<name>(.*?)</name>', re.DOTALL)
+SETTINGS_END_PATTERN = re.compile(rb'(\s*)</settings>')
+
+def _is_blank(text):
+    return not text or text.isspace()
+
+def _ends_with_tags(content, tokens, sequence):
+    """Checks whether the last tokens match sequence and returns their spans or None.
+
+    sequence alternates literal tags (e.g. b'<name>') and checks for the
+    bytes between two tags: a literal, a predicate such as _is_blank, or None
+    for any text.
+    """
+    tags = sequence[::2]
+    if len(tokens) < len(tags):
+        return None
+    window = tokens[-len(tags):]
+    for (start, end), tag in zip(window, tags):
+        if content[start:end] != tag:
+            return None
+    for (_, gap_start), (gap_end, _), check in zip(window, window[1:], sequence[1::2]):
+        text = content[gap_start:gap_end]
+        if check is not None and not (check(text) if callable(check) else text == check):
+            return None
+    return window
+
+def _whitespace_before(content, pos, limit=0):
+    start = pos
+    while start > limit and content[start - 1:start].isspace():
+        start -= 1
+    return content[start:pos].decode('utf-8')
+
+def scan_moodle_backup_xml(content, original_backup_id=None, section_id=None, section_ids=()):
+    """Finds all edit anchors of moodle_backup.xml in a single pass.
+
+    content is the raw UTF-8 content as a bytes-like object (bytes or an
+    mmap, see BackupTree.open_buffer()); str is encoded first. Returns a
+    dictionary of (start, end) byte spans of the values to replace, each None
+    if the anchor is missing: information_name, filename_setting, backup_id,
+    section_title (only looked up if section_id is given), section_titles
+    (a dictionary of the titles found for section_id and section_ids, by
+    section ID), activities (the inside of the <activities> block), the
+    start date candidates
+    original_course_startdate, details_startdate, course_startdate and
+    startdate, settings_end (insertion point after the last </setting>) and
+    the layout (see extract_moodle_backup_layout()), which is decoded.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    if isinstance(original_backup_id, str):
+        original_backup_id = original_backup_id.encode('ascii')
+    anchors = dict.fromkeys(('information_name', 'filename_setting', 'backup_id', 'section_title', 'activities',
+                             'original_course_startdate', 'details_startdate', 'course_startdate', 'startdate',
+                             'settings_end'))
+    anchors['section_titles'] = {}
+    wanted_sections = {str(wanted).encode('ascii') for wanted in (*section_ids, section_id) if wanted}
+    section_title = (b'<section>', _is_blank, b'<sectionid>', lambda text: text in wanted_sections, b'</sectionid>',
+                     _is_blank, b'<title>', None, b'</title>')
+    information_start = name_start = activities_start = activity_start = activity_template = None
+    details_start = course_start = last_details_end = last_course_end = setting_start = None
+    tokens = []
+
+    for match in MOODLE_BACKUP_TOKEN_PATTERN.finditer(content):
+        start, end = match.span()
+        tokens.append((start, end))
+        if match.group('setting'):
+            setting_start = start
+            anchors['settings_end'] = end
+            if information_start is not None and anchors['information_name'] is None:
+                # <information><name> is the first <name> after <information>, even inside a setting
+                name_match = NAME_TAG_PATTERN.search(content, start, end)
+                if name_match:
+                    anchors['information_name'] = name_match.span(1)
+                    continue # Replacing it breaks this setting, as if it did not exist
+            if anchors['filename_setting'] is None:
+                setting_match = FILENAME_SETTING_PATTERN.fullmatch(content, start, end)
+                if setting_match:
+                    anchors['filename_setting'] = setting_match.span(1)
+            continue
+        if match.group('date'):
+            span = match.span('date')
+            if match.group('date_tag') == b'original_course_startdate':
+                anchors['original_course_startdate'] = anchors['original_course_startdate'] or span
+            else:
+                anchors['startdate'] = anchors['startdate'] or span
+                if details_start is not None and anchors['details_startdate'] is None:
+                    anchors['details_startdate'] = span
+                if course_start is not None and anchors['course_startdate'] is None:
+                    anchors['course_startdate'] = span
+            continue
+        if match.group('backup_id') is not None:
+            if original_backup_id and anchors['backup_id'] is None and match.group('backup_id') == original_backup_id:
+                anchors['backup_id'] = match.span('backup_id')
+            continue
+
+        tag, name = match.group(0), match.group('tag')
+        if not match.group('close'):
+            if tag == b'<information>' and information_start is None:
+                information_start = start
+            elif tag == b'<name>' and information_start is not None and name_start is None:
+                name_start = end
+            elif tag == b'<activities>' and activities_start is None:
+                activities_start = end
+            elif tag == b'<activity>' and activities_start is not None and anchors['activities'] is None and activity_start is None:
+                activity_start = start
+            elif tag == b'<details>' and details_start is None:
+                details_start = start
+            elif name == b'course' and course_start is None:
+                course_start = start
+        elif name == b'name' and name_start is not None and anchors['information_name'] is None:
+            anchors['information_name'] = (name_start, start)
+        elif name == b'activity' and activity_start is not None and activity_template is None:
+            activity_template = (activity_start, end)
+        elif name == b'activities' and activities_start is not None and anchors['activities'] is None:
+            anchors['activities'] = (activities_start, start)
+        elif name == b'title' and wanted_sections:
+            window = _ends_with_tags(content, tokens, section_title)
+            if window:
+                found_id = int(content[window[1][1]:window[2][0]])
+                anchors['section_titles'].setdefault(found_id, (window[3][1], window[4][0]))
+        elif name == b'details':
+            last_details_end = end
+        elif name == b'course':
+            last_course_end = end
+
+    if section_id:
+        anchors['section_title'] = anchors['section_titles'].get(int(section_id))
+
+    # <details>/<course> start dates only count if the block is closed after them
+    for key, block_end in (('details_startdate', last_details_end), ('course_startdate', last_course_end)):
+        if anchors[key] and (block_end is None or block_end < anchors[key][1]):
+            anchors[key] = None
+
+    layout = {
+        'activity_template': None,
+        'activity_indent': '          ', # Default indent
+        'closing_indent': '        ', # Default indent
+        'setting_indent': None,
+    }
+    if anchors['activities']:
+        inner_start, inner_end = anchors['activities']
+        if activity_start is not None and activity_start < inner_end:
+            # Leading whitespace before the first activity for proper indentation
+            layout['activity_indent'] = _whitespace_before(content, activity_start, inner_start)
+            if activity_template is not None and activity_template[1] <= inner_end:
+                layout['activity_template'] = content[activity_template[0]:activity_template[1]].decode('utf-8')
+        # Trailing whitespace before </activities> for proper closing indentation
+        layout['closing_indent'] = _whitespace_before(content, inner_end, inner_start)
+    if setting_start is not None:
+        # Indentation of the last setting block, used for new settings
+        layout['setting_indent'] = _whitespace_before(content, setting_start)
+    anchors['layout'] = layout
+    return anchors
+
+def extract_moodle_backup_layout(content):
+    """Finds the parts of moodle_backup.xml that new activities and settings are built from.
+
+    Returns the first <activity> block (the template for new entries) and the
+    indentation around activities and settings. The layout does not change
+    when a template is reused, so it can be cached with the template.
+    """
+    return scan_moodle_backup_xml(content)['layout']
+
+def apply_text_edits(content, edits):
+    """Applies non-overlapping (start, end, replacement) edits to content with a single join.
+
+    content is a str or a bytes-like object (then the replacements are bytes
+    and bytes are returned). Edits that start inside an earlier replaced span
+    are dropped (e.g. start dates inside the rebuilt <activities> block).
+    """
+    parts = []
+    position = 0
+    for start, end, replacement in sorted(edits, key=lambda edit: (edit[0], edit[1])):
+        if start < position:
+            continue
+        parts.append(content[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(content[position:])
+    return ('' if isinstance(content, str) else b'').join(parts)
+
+# Slots of an <activity> entry in moodle_backup.xml, filled in for every
+# assignment: (value name, pattern in the template, replacement format).
+ACTIVITY_ENTRY_SLOTS = (
+    ('moduleid', r'<moduleid>\d+</moduleid>', '<moduleid>{}</moduleid>'),
+    ('sectionid', r'<sectionid>\d+</sectionid>', '<sectionid>{}</sectionid>'),
+    ('title', r'<title>.*?</title>', '<title>{}</title>'),
+    ('moduleid', r'<directory>.*?</directory>', '<directory>activities/assign_{}</directory>'),
+)
+SLOT_MARKER = '\x00' # Never part of XML text
+
+def compile_slot_template(text, slots):
+    """Splits text into literal fragments and named slots, so that it can be rendered with one join.
+
+    slots are (value name, pattern, replacement format) tuples; the first
+    match of each pattern becomes a slot. Returns a list alternating literal
+    fragments and value names.
+    """
+    for name, pattern, replacement in slots:
+        marked = replacement.format(f"{SLOT_MARKER}{name}{SLOT_MARKER}")
+        text = re.sub(pattern, lambda match: marked, text, count=1)
+    return text.split(SLOT_MARKER)
+
+def render_slot_template(parts, values):
+    """Renders a compile_slot_template() result with the given values."""
+    return ''.join([values[part] if i % 2 else part for i, part in enumerate(parts)])
+
+def update_moodle_backup_xml(tree, xml_path, output_filename, original_backup_id, new_backup_id, all_assignment_details, section_id, added_module_ids, section_title=None, target_start_timestamp=None, layout=None, verbose=True, section_titles=None):
+    """Modifies moodle_backup.xml: filename, backup_id, startdate, rebuilds activities, adds settings.
+
+    Each entry of all_assignment_details is placed in its sectionid
+    (default: section_id). section_titles maps section IDs to new titles in
+    <sections>; section_title is the title of section_id.
+
+    All anchors are located by one scan_moodle_backup_xml() pass over the
+    raw bytes and the edits are applied in one join, so the file is never
+    decoded as a whole. layout is the result of
+    extract_moodle_backup_layout() for this file; it is taken from the scan
+    if not given. Without verbose, the activity entries and settings are
+    summarized instead of listed.
+    """
+    print(f"\nUpdating {xml_path}...")
+    if not tree.is_file(xml_path):
         print(f"  Error: {xml_path} not found.")
         return False
 
     try:
-        content = xml_path.read_text()
-        original_content = content
-        changes_made = False
+        # Scanned as raw bytes (memory-mapped if possible); only replaced regions are decoded or encoded
+        with tree.open_buffer(xml_path) as content:
+            section_titles = {int(title_section_id): title for title_section_id, title in (section_titles or {}).items() if title}
+            if section_title and section_id:
+                section_titles.setdefault(int(section_id), section_title)
+            anchors = scan_moodle_backup_xml(content, original_backup_id, section_ids=section_titles)
+            if layout is None:
+                layout = anchors['layout']
+            edits = [] # (start, end, replacement)
+            changes_made = False
+
+            def changes(span, value):
+                return span is not None and content[span[0]:span[1]] != value.encode('utf-8')
+
+            # 1. Modify backup filename in <information><name>
+            if changes(anchors['information_name'], output_filename):
+                edits.append((*anchors['information_name'], output_filename))
+                print(f"  - Updated <information><name> to: {output_filename}"); changes_made = True
+            else:
+                print("  - Warning: Could not find <information><name> tag.")
+                raise Exception("Could not find <information><name> tag.")
 
-        # 1. Modify backup filename in <information><name>
-        new_content_1, count1 = re.subn(r'(<information>.*?<name>)(.*?)(</name>)', rf'\g<1>{output_filename}\g<3>', content, count=1, flags=re.DOTALL)
-        if count1 > 0 and content != new_content_1:
-            print(f"  - Updated <information><name> to: {output_filename}"); changes_made = True
-        else:
-            print("  - Warning: Could not find <information><name> tag.")
-            raise Exception("Could not find <information><name> tag.")
-        content = new_content_1
-
-        # 2. Modify backup filename in <setting>
-        pattern_setting = re.compile(r'(<setting>\s*<level>root</level>\s*<name>filename</name>\s*<value>)(.*?)(</value>\s*</setting>)', re.DOTALL)
-        new_content_2, count2 = pattern_setting.subn(rf'\g<1>{output_filename}\g<3>', content, count=1)
-        if count2 > 0 and content != new_content_2:
-            print(f"  - Updated filename setting value to: {output_filename}"); changes_made = True
-        else:
-            print("  - Warning: Could not find <setting> for filename.")
-            raise Exception("Could not find <setting> for filename.")
-        content = new_content_2
-
-        # 3. Modify backup_id
-        if original_backup_id:
-            new_content_3, count3 = re.subn(f'backup_id="{original_backup_id}"', f'backup_id="{new_backup_id}"', content, count=1)
-            if count3 > 0 and content != new_content_3:
-                print(f"  - Updated backup_id to: {new_backup_id}"); changes_made = True
+            # 2. Modify backup filename in <setting>
+            if changes(anchors['filename_setting'], output_filename):
+                edits.append((*anchors['filename_setting'], output_filename))
+                print(f"  - Updated filename setting value to: {output_filename}"); changes_made = True
             else:
-                print("  - Warning: Could not find original backup_id to replace.")
-                raise Exception("Could not find original backup_id to replace.")
-            content = new_content_3
-        else:
-             print("  - Warning: No original backup_id found, cannot replace.")
-             raise Exception("No original backup_id found, cannot replace.")
-        
-        # 3.5. Update section title in <sections> if provided
-        if section_title and section_id:
-            section_title_pattern = rf'(<section>\s*<sectionid>{section_id}</sectionid>\s*<title>)(.*?)(</title>)'
-            new_content_3_5, count3_5 = re.subn(section_title_pattern, rf'\g<1>{section_title}\g<3>', content, count=1, flags=re.DOTALL)
-            if count3_5 > 0 and content != new_content_3_5: 
-                print(f"  - Updated section title in <sections> to: {section_title}")
-                content = new_content_3_5
-                changes_made = True
-            else: 
-                print("  - Warning: Could not find section title to update in <sections>.")
-                raise Exception("Could not find section title to update in <sections>.")
-
-        # 4. Rebuild <activities> block
-        activities_match = re.search(r'(<activities>)(.*?)(</activities>)', content, re.DOTALL)
-        if activities_match:
-            # Capture leading whitespace before the first activity for proper indentation
-            first_activity_match = re.search(r'(\s*)<activity>', activities_match.group(2))
-            leading_indent = first_activity_match.group(1) if first_activity_match else '          ' # Default indent
-
-            activity_template_match = re.search(r'(<activity>.*?</activity>)', activities_match.group(2), re.DOTALL)
-            if activity_template_match:
-                activity_template = activity_template_match.group(1)
-                new_activities_content = "\n"
-                print("  - Rebuilding <activities> block:")
-                for details in all_assignment_details:
-                    new_entry = activity_template
-                    # Ensure title is XML-safe (basic check for now)
-                    safe_title = details["name"].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-                    new_entry = re.sub(r'<moduleid>\d+</moduleid>', f'<moduleid>{details["moduleid"]}</moduleid>', new_entry, count=1)
-                    new_entry = re.sub(r'<sectionid>\d+</sectionid>', f'<sectionid>{section_id}</sectionid>', new_entry, count=1)
-                    new_entry = re.sub(r'<title>.*?</title>', f'<title>{safe_title}</title>', new_entry, count=1)
-                    new_entry = re.sub(r'<directory>.*?</directory>', f'<directory>activities/assign_{details["moduleid"]}</directory>', new_entry, count=1)
-                    new_activities_content += f"{leading_indent}{new_entry}\n"
-                    print(f"    - Added entry for module {details['moduleid']}")
-
-                # Capture trailing whitespace before </activities> for proper closing indentation
-                closing_activities_match = re.search(r'(\s*)</activities>$', activities_match.group(0))
-                trailing_indent = closing_activities_match.group(1) if closing_activities_match else '        ' # Default indent
-
-                new_activities_block = activities_match.group(1) + new_activities_content + trailing_indent + activities_match.group(3)
-                content = content.replace(activities_match.group(0), new_activities_block, 1)
-                changes_made = True
+                print("  - Warning: Could not find <setting> for filename.")
+                raise Exception("Could not find <setting> for filename.")
+
+            # 3. Modify backup_id
+            if original_backup_id:
+                if changes(anchors['backup_id'], new_backup_id):
+                    edits.append((*anchors['backup_id'], new_backup_id))
+                    print(f"  - Updated backup_id to: {new_backup_id}"); changes_made = True
+                else:
+                    print("  - Warning: Could not find original backup_id to replace.")
+                    raise Exception("Could not find original backup_id to replace.")
             else:
-                print("  - Warning: Could not find an <activity> template within <activities> block.")
-        else:
-             print("  - Warning: Could not find <activities> section.")
-
-        # 5. Add new <setting> blocks for added activities
-        if added_module_ids:
-            print("  - Adding new <setting> blocks for added activities:")
-            # Find the last setting block to determine indentation and insertion point
-            last_setting_match = None
-            for match in re.finditer(r'(\s*)<setting>.*?</setting>', content, re.DOTALL):
-                 last_setting_match = match
-
-            if last_setting_match:
-                indent = last_setting_match.group(1) # Indentation of the last existing setting
-                insertion_point = last_setting_match.end() # Insert after the last setting
-                new_settings_text = "\n" # Start with a newline
-
-                for mod_id in added_module_ids:
-                    activity_name = f"assign_{mod_id}"
-                    # Use captured indent for new blocks
-                    setting_included = (
-                        f"{indent}<setting>\n"
-                        f"{indent}  <level>activity</level>\n"
-                        f"{indent}  <activity>{activity_name}</activity>\n"
-                        f"{indent}  <name>{activity_name}_included</name>\n"
-                        f"{indent}  <value>1</value>\n"
-                        f"{indent}</setting>\n"
-                    )
-                    setting_userinfo = (
-                        f"{indent}<setting>\n"
-                        f"{indent}  <level>activity</level>\n"
-                        f"{indent}  <activity>{activity_name}</activity>\n"
-                        f"{indent}  <name>{activity_name}_userinfo</name>\n"
-                        f"{indent}  <value>0</value>\n"
-                        f"{indent}</setting>\n"
-                    )
-                    new_settings_text += setting_included + setting_userinfo
-                    print(f"    - Added settings for {activity_name}")
-
-                # Insert the new settings text at the calculated point
-                content = content[:insertion_point] + new_settings_text + content[insertion_point:]
-                changes_made = True
+                 print("  - Warning: No original backup_id found, cannot replace.")
+                 raise Exception("No original backup_id found, cannot replace.")
+
+            # 3.5. Update section titles in <sections> if provided
+            for title_section_id, title in section_titles.items():
+                span = anchors['section_titles'].get(title_section_id)
+                if span is None:
+                    print(f"  - Warning: Could not find the title of section {title_section_id} to update in <sections>.")
+                    raise Exception(f"Could not find the title of section {title_section_id} to update in <sections>.")
+                if changes(span, title):
+                    edits.append((*span, title))
+                    print(f"  - Updated section title in <sections> to: {title}" if len(section_titles) == 1 else
+                          f"  - Updated the title of section {title_section_id} in <sections> to: {title}")
+                    changes_made = True
+
+            # 4. Rebuild <activities> block
+            if anchors['activities']:
+                leading_indent = layout['activity_indent']
+                if layout['activity_template']:
+                    entry_parts = compile_slot_template(layout['activity_template'], ACTIVITY_ENTRY_SLOTS)
+                    new_entries = [""] # Start with a newline
+                    print("  - Rebuilding <activities> block:")
+                    for details in all_assignment_details:
+                        # Ensure title is XML-safe (basic check for now)
+                        safe_title = details["name"].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                        values = {'moduleid': str(details["moduleid"]), 'sectionid': str(details.get("sectionid", section_id)), 'title': safe_title}
+                        new_entries.append(leading_indent + render_slot_template(entry_parts, values))
+                        if verbose:
+                            print(f"    - Added entry for module {details['moduleid']}")
+                    if not verbose:
+                        print(f"    - Added entries for {len(all_assignment_details)} modules")
+
+                    trailing_indent = layout['closing_indent']
+                    new_entries.append(trailing_indent)
+                    edits.append((*anchors['activities'], "\n".join(new_entries)))
+                    changes_made = True
+                else:
+                    print("  - Warning: Could not find an <activity> template within <activities> block.")
             else:
-                # Fallback if no existing settings found (less likely but possible)
-                settings_end_match = re.search(r'(\s*)</settings>', content)
-                if settings_end_match:
-                    indent = settings_end_match.group(1) + '  ' # Guess indentation
-                    print("  - Warning: Could not find existing <setting> blocks to determine indent. Used fallback.")
+                 print("  - Warning: Could not find <activities> section.")
+
+            # 5. Add new <setting> blocks for added activities
+            if added_module_ids:
+                print("  - Adding new <setting> blocks for added activities:")
+                # Insert after the last setting block, using its indentation
+                if layout['setting_indent'] is not None and anchors['settings_end'] is not None:
+                    indent = layout['setting_indent'] # Indentation of the last existing setting
+                    insertion_point = anchors['settings_end']
+                    new_settings = ["\n"] # Start with a newline
+
+                    for mod_id in added_module_ids:
+                        activity_name = f"assign_{mod_id}"
+                        # Use captured indent for new blocks
+                        setting_included = (
+                            f"{indent}<setting>\n"
+                            f"{indent}  <level>activity</level>\n"
+                            f"{indent}  <activity>{activity_name}</activity>\n"
+                            f"{indent}  <name>{activity_name}_included</name>\n"
+                            f"{indent}  <value>1</value>\n"
+                            f"{indent}</setting>\n"
+                        )
+                        setting_userinfo = (
+                            f"{indent}<setting>\n"
+                            f"{indent}  <level>activity</level>\n"
+                            f"{indent}  <activity>{activity_name}</activity>\n"
+                            f"{indent}  <name>{activity_name}_userinfo</name>\n"
+                            f"{indent}  <value>0</value>\n"
+                            f"{indent}</setting>\n"
+                        )
+                        new_settings.append(setting_included)
+                        new_settings.append(setting_userinfo)
+                        if verbose:
+                            print(f"    - Added settings for {activity_name}")
+                    if not verbose:
+                        print(f"    - Added settings for {len(added_module_ids)} activities")
+
+                    # Insert the new settings text at the calculated point
+                    edits.append((insertion_point, insertion_point, "".join(new_settings)))
+                    changes_made = True
                 else:
-                    print("  - Warning: Could not find </settings> tag or existing settings to insert new ones.")
-
-        # 6. Modify course start date if provided
-        if target_start_timestamp is not None:
-            # Try a broader set of patterns based on what we've found in our scan
-            changes_made_for_date = False
-            
-            # Pattern 1: <original_course_startdate> tag
-            pattern1 = re.compile(r'(<original_course_startdate>)\d+(</original_course_startdate>)')
-            new_content_6, count_p1 = pattern1.subn(rf'\g<1>{target_start_timestamp}\g<2>', content, count=1)
-            if count_p1 > 0 and content != new_content_6:
-                content = new_content_6
-                print(f"  - Updated <original_course_startdate> to: {target_start_timestamp}")
-                changes_made = True
-                changes_made_for_date = True
-            
-            # Pattern 2: <details><startdate> (inside course details)
-            pattern2 = re.compile(r'(<details>.*?<startdate>)\d+(</startdate>.*?</details>)', re.DOTALL)
-            new_content_6, count_p2 = pattern2.subn(rf'\g<1>{target_start_timestamp}\g<2>', content, count=1)
-            if count_p2 > 0 and content != new_content_6:
-                content = new_content_6
-                print(f"  - Updated <details><startdate> to: {target_start_timestamp}")
-                changes_made = True
-                changes_made_for_date = True
-            
-            # Pattern 3: <course><startdate> (in main course tag)
-            pattern3 = re.compile(r'(<course\b[^>]*>.*?<startdate>)\d+(</startdate>.*?</course>)', re.DOTALL)
-            new_content_6, count_p3 = pattern3.subn(rf'\g<1>{target_start_timestamp}\g<2>', content, count=1)
-            if count_p3 > 0 and content != new_content_6:
-                content = new_content_6
-                print(f"  - Updated <course><startdate> to: {target_start_timestamp}")
-                changes_made = True
-                changes_made_for_date = True
-            
-            # Pattern 4: Try original pattern one more time (already tried earlier)
-            if not changes_made_for_date:
-                startdate_pattern_global = re.compile(r'(<startdate>)\d+(</startdate>)')
-                new_content_6, count6 = startdate_pattern_global.subn(rf'\g<1>{target_start_timestamp}\g<2>', content, count=1)
-
-                if count6 > 0 and content != new_content_6:
+                    # Fallback if no existing settings found (less likely but possible)
+                    settings_end_match = SETTINGS_END_PATTERN.search(content)
+                    if settings_end_match:
+                        indent = settings_end_match.group(1).decode('utf-8') + '  ' # Guess indentation
+                        print("  - Warning: Could not find existing <setting> blocks to determine indent. Used fallback.")
+                    else:
+                        print("  - Warning: Could not find </settings> tag or existing settings to insert new ones.")
+
+            # 6. Modify course start date if provided
+            if target_start_timestamp is not None:
+                # Try a broader set of patterns based on what we've found in our scan
+                changes_made_for_date = False
+                timestamp = str(target_start_timestamp)
+                updated_date_spans = set()
+
+                # Patterns 1-3: <original_course_startdate>, <details><startdate> (inside course
+                # details), <course><startdate> (in main course tag)
+                for key, label in (('original_course_startdate', '<original_course_startdate>'),
+                                   ('details_startdate', '<details><startdate>'),
+                                   ('course_startdate', '<course><startdate>')):
+                    span = anchors[key]
+                    if span not in updated_date_spans and changes(span, timestamp):
+                        edits.append((*span, timestamp))
+                        updated_date_spans.add(span)
+                        print(f"  - Updated {label} to: {target_start_timestamp}")
+                        changes_made = True
+                        changes_made_for_date = True
+
+                # Pattern 4: Try original pattern one more time (already tried earlier)
+                if not changes_made_for_date and changes(anchors['startdate'], timestamp):
+                    edits.append((*anchors['startdate'], timestamp))
                     # Display human-readable date along with timestamp
                     start_dt_readable = datetime.fromtimestamp(target_start_timestamp)
                     print(f"  - Updated course <startdate> to: {target_start_timestamp} ({start_dt_readable.strftime('%Y-%m-%d %H:%M:%S')})")
-                    content = new_content_6
                     changes_made = True
-            
-            # Final check if we couldn't find any expected patterns
-            if not changes_made_for_date:
-                # Provide a more helpful warning if the tag isn't found
-                print(f"  - Warning: Could not find the <startdate> tag in {xml_path.name} to update.")
-                # Suggest checking course.xml instead
-                course_xml_path = xml_path.parent / "course" / "course.xml"
-                if course_xml_path.exists():
-                    print(f"  - Note: You might need to check {course_xml_path.relative_to(xml_path.parent)} for the course start date instead.")
-         
+
+                # Final check if we couldn't find any expected patterns
+                if not changes_made_for_date:
+                    # Provide a more helpful warning if the tag isn't found
+                    print(f"  - Warning: Could not find the <startdate> tag in {xml_path} to update.")
+                    # Suggest checking course.xml instead
+                    if tree.exists("course/course.xml"):
+                        print("  - Note: You might need to check course/course.xml for the course start date instead.")
+
+            content = apply_text_edits(content, [(start, end, text.encode('utf-8')) for start, end, text in edits])
+
         # Write changes if any were made
         if changes_made:
-            xml_path.write_text(content)
-            print(f"  Changes written to {xml_path.name}.")
+            tree.write_bytes(xml_path, content)
+            print(f"  Changes written to {xml_path}.")
             return True
         else:
-            print(f"  No changes made to {xml_path.name}.")
+            print(f"  No changes made to {xml_path}.")
             return False
 
     except Exception as e:
         print(f"Error modifying file {xml_path}: {e}")
         return False
 
-def create_mbz(source_dir, output_path):
-    """Creates a .tar.gz archive from the source directory."""
-    print(f"\nCreating archive {output_path} (tar.gz) from {source_dir}...")
+def create_mbz(source, output_path, compression_level=DEFAULT_COMPRESSION_LEVEL, compress_threads=None, stats=None,
+               codec=DEFAULT_OUTPUT_CODEC):
+    """Creates a .tar.gz archive (or another codec, see open_compressor()) from a BackupTree or an extracted backup directory.
+
+    output_path can also be a writable binary file object (e.g.
+    sys.stdout.buffer), which is written to and left open. Members modified
+    in a BackupTree are written from memory, all others are copied from the
+    tree's source. Compression runs in compress_threads threads (default:
+    number of CPUs); level 0 only stores. Compressed and written bytes are
+    counted in stats if given. A failed write removes the incomplete output
+    file (but cannot take back what was written to a file object).
+    """
+    tree = _as_tree(source)
+    if is_file_object(output_path):
+        print(f"\nWriting archive ({archive_label(codec)}) from {tree.source} to a stream...")
+        with open_mbz_for_writing(output_path, compression_level, compress_threads, stats, codec) as tar:
+            print(f"  Adding {len(tree.names())} items to archive...")
+            tree.write_to_tar(tar)
+        print("Archive written successfully.")
+        return
+    print(f"\nCreating archive {output_path} ({archive_label(codec)}) from {tree.source}...")
     output_path = pathlib.Path(output_path)
     output_path.parent.mkdir(parents=True, exist_ok=True)
     if output_path.exists():
         print(f"Warning: Output file {output_path} exists. Deleting.")
         output_path.unlink()
-    cwd = os.getcwd()
+    success = False
     try:
-        os.chdir(source_dir)
-        with tarfile.open(output_path, "w:gz") as tar:
-            items_to_add = sorted(list(pathlib.Path('.').glob('**/*')))
-            print(f"  Adding {len(items_to_add)} items to archive...") # Less verbose now
-            for item in items_to_add:
-                arcname = str(item.relative_to('.'))
-                tar.add(str(item), arcname=arcname)
+        with open_mbz_for_writing(output_path, compression_level, compress_threads, stats, codec) as tar:
+            print(f"  Adding {len(tree.names())} items to archive...") # Less verbose now
+            tree.write_to_tar(tar)
+        success = True
         print(f"Archive created successfully: {output_path}")
     except Exception as e:
         print(f"Error creating archive {output_path}: {e}")
         raise
     finally:
-        os.chdir(cwd)
+        if not success and output_path.exists():
+            print(f"Removing incomplete output file {output_path}.")
+            output_path.unlink()
 
-def truncate_log_file(log_file_path):
+def truncate_log_file(tree, log_file_path):
     """Truncates the moodle_backup.log file."""
-    print(f"\nTruncating log file: {log_file_path.name}")
+    print(f"\nTruncating log file: {log_file_path}")
     try:
-        with open(log_file_path, 'w') as f:
-            f.truncate(0)
+        tree.write_bytes(log_file_path, b'')
         print("  Log file truncated.")
     except Exception as e:
         print(f"  Error truncating log file {log_file_path}: {e}")
 
-def main():
+def describe_template(tree, index, with_layout=True):
+    """Returns the parts of an unmodified backup that every build reuses.
+
+    These are the assign.xml and inforef.xml of the first existing assignment
+    (the templates for new assignments), both compiled for rendering
+    (assignment_template, see compile_assignment_template()), and the
+    moodle_backup.xml layout (None without with_layout;
+    update_moodle_backup_xml() then takes it from its own scan).
+    """
+    template = {'assign_xml': None, 'inforef_xml': None, 'inforef_path': None, 'assignment_template': None, 'layout': None}
+    assign_files = index.assign_xml_files()
+    if assign_files:
+        template['assign_xml'] = tree.read_text(assign_files[0])
+        template['inforef_path'] = assign_files[0].rpartition('/')[0] + "/inforef.xml"
+        if tree.is_file(template['inforef_path']):
+            template['inforef_xml'] = tree.read_text(template['inforef_path'])
+            template['assignment_template'] = compile_assignment_template(template['assign_xml'], template['inforef_xml'])
+    if with_layout and tree.is_file("moodle_backup.xml"):
+        with tree.open_buffer("moodle_backup.xml") as content:
+            template['layout'] = extract_moodle_backup_layout(content)
+    return template
+
+def apply_assignment_changes(tree, assignment_base_data, target_assignment_count, output_filename, section_title=None, target_start_timestamp=None, index=None, template=None, verbose=True, stats=None, fixed_time=None, validate=True, section_layout=None):
+    """Applies all assignment, section and manifest changes to the members of a BackupTree.
+
+    index and template (see describe_template()) can be passed if they are
+    already known for the unmodified tree, e.g. from a template snapshot.
+    verbose=False (scale mode) prints summaries instead of a line per
+    created file and manifest entry. The extract_ids, modification and
+    update_moodle_backup_xml stages are recorded in stats (a PipelineStats)
+    if given. With fixed_time (see deterministic_timestamp()), new
+    assignments are created at that time and the new backup ID is derived
+    from the inputs instead of random. With validate, the modified tree is
+    checked with validate_backup() (stage validate) and an inconsistent
+    result fails. section_layout (see parse_section_layout()) spreads the
+    assignments over several sections (see place_assignments()).
+
+    Returns a summary (new backup ID, section ID, final assignments, see
+    MbzEditor.apply()) on success, False otherwise.
+    """
+    stats = stats or PipelineStats(enabled=False)
+    # 2. Extract existing IDs (single walk, reused by the following steps)
+    stats.start_stage('extract_ids')
+    if index is None:
+        index = BackupIdIndex(tree)
+    ids = extract_ids(tree, index)
+    stats.start_stage('modification')
+    original_assignment_count = len(ids['existing_module_ids'])
+    print(f"Original assignment count: {original_assignment_count}")
+
+    if not ids['section_id'] or not ids['context_id']:
+         print("Error: Could not extract required section_id or context_id from backup files.")
+         return False
+
+    # 3. Find existing assignment files (sorted)
+    existing_assign_files = find_assign_xml_files(tree, index)
+    if len(existing_assign_files) != original_assignment_count:
+         print(f"Warning: Mismatch between module IDs in moodle_backup.xml ({original_assignment_count}) and found assign.xml files ({len(existing_assign_files)}). Proceeding cautiously.")
+         original_assignment_count = min(original_assignment_count, len(existing_assign_files))
+
+    # 4. Read template files (use first existing assignment)
+    if template is None:
+        template = describe_template(tree, index, with_layout=False)
+    assign_template_content = ""
+    inforef_template_content = ""
+    if existing_assign_files:
+         assign_template_content = template['assign_xml']
+         if template['inforef_xml'] is not None:
+              inforef_template_content = template['inforef_xml']
+         else:
+              print(f"Warning: Could not read inforef.xml template from {template['inforef_path']}. Cannot create new inforef files.")
+              return False
+    elif target_assignment_count > 0:
+        print("Error: No existing assignments found to use as template, but target count > 0.")
+        return False
+
+    # 5. Reserve IDs for new assignments and initialize lists for the loop
+    assignment_template = template['assignment_template']
+    allocator = IdAllocator(ids, assignment_template['plugin_configs'] if assignment_template else 0)
+
+    final_assignment_details = [] # List to hold {name, moduleid} for all final assignments
+    final_module_ids = [] # List to hold all final module IDs in order
+    added_module_ids = [] # List of module IDs added in this run
+    new_assignments = [] # IDs of the added assignments, created together after the loop
+
+    # --- 6. Process Assignments (Modify or Add) ---
+    print(f"\nProcessing target of {target_assignment_count} assignments...")
+    for i in range(target_assignment_count):
+        if i >= len(assignment_base_data):
+            print(f"Warning: Not enough assignment data for index {i}, skipping.")
+            continue
+
+        assignment_info = assignment_base_data[i]
+
+        if i < original_assignment_count:
+            # Modify existing assignment
+            module_id = ids['existing_module_ids'][i]
+            file_path = f"activities/assign_{module_id}/assign.xml"
+            if tree.is_file(file_path):
+                modify_assignment(
+                    tree,
+                    file_path, 
+                    assignment_info["name"], 
+                    assignment_info["due_ts"], 
+                    assignment_info["cutoff_ts"],
+                    assignment_info.get("activation_ts")
+                )
+            else:
+                print(f"  Warning: Expected file {file_path} not found for modification.")
+
+            final_module_ids.append(module_id)
+            final_assignment_details.append({"name": assignment_info["name"], "moduleid": module_id})
+
+        else:
+            # Add new assignment
+            # Ensure templates are available
+            if not assign_template_content or not inforef_template_content:
+                 print("Error: Missing template content to create new assignment. Stopping.")
+                 break # Stop processing further assignments
+
+            new = allocator.allocate()
+            new['assignment_info'] = assignment_info
+            new_assignments.append(new)
+            added_module_ids.append(new['module_id'])
+            final_module_ids.append(new['module_id'])
+            final_assignment_details.append({"name": assignment_info["name"], "moduleid": new['module_id']})
+
+    # Sections of the final assignments
+    try:
+        placement, section_titles = place_assignments(tree, ids['section_id'], len(final_module_ids),
+                                                      section_layout, section_title)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return False
+    section_numbers = {section_id: section_number(tree, section_id) for section_id in section_titles}
+    module_sections = {} # module ID (str) -> section ID
+    for details, section_id in zip(final_assignment_details, placement):
+        details['sectionid'] = section_id
+        module_sections[str(details['moduleid'])] = section_id
+    for new in new_assignments:
+        new['section_id'] = module_sections[str(new['module_id'])]
+        new['section_number'] = section_numbers[new['section_id']]
+    added = set(added_module_ids)
+    for module_id, section_id in module_sections.items():
+        if int(module_id) not in added:
+            move_module_to_section(tree, module_id, section_id, section_numbers[section_id])
+
+    if not create_new_assignments(
+        tree,
+        assignment_template,
+        new_assignments,
+        verbose,
+        fixed_time
+    ):
+        return False
+
+    # --- 7. Update Manifest Files ---
+    # Update section.xml of every section with assignments
+    for section_id, title in section_titles.items():
+        section_xml_path = f"sections/section_{section_id}/section.xml"
+        section_module_ids = [module_id for module_id in final_module_ids if module_sections[str(module_id)] == section_id]
+        if not update_section_xml(tree, section_xml_path, section_module_ids, title, verbose):
+            print("Error: Failed to update section.xml. Backup may be invalid.")
+            return False
+    # Other sections must not list the assignments any more
+    for section_id in backup_section_ids(tree):
+        if section_id not in section_titles and not remove_from_sequence(tree, section_id, module_sections, verbose):
+            print("Error: Failed to update section.xml. Backup may be invalid.")
+            return False
+
+    # Update moodle_backup.xml
+    stats.start_stage('update_moodle_backup_xml')
+    moodle_backup_xml_path = "moodle_backup.xml"
+    if fixed_time is None:
+        new_backup_id = uuid.uuid4().hex # Generate new random backup ID
+    else:
+        schedule = [(info['name'], info['due_ts'], info['cutoff_ts'], info.get('activation_ts'))
+                    for info in assignment_base_data[:target_assignment_count]]
+        inputs = [ids['original_backup_id'], output_filename, schedule, section_title, target_start_timestamp, fixed_time]
+        if section_layout:
+            inputs.append(section_layout)
+        new_backup_id = derive_backup_id(*inputs)
+    if not update_moodle_backup_xml(
+        tree,
+        moodle_backup_xml_path, 
+        output_filename, 
+        ids['original_backup_id'], 
+        new_backup_id, 
+        final_assignment_details, 
+        ids['section_id'], 
+        added_module_ids, 
+        section_title,
+        target_start_timestamp, # Pass the new timestamp
+        template['layout'],
+        verbose,
+        section_titles
+    ):
+        print("Error: Failed to update moodle_backup.xml. Backup may be invalid.")
+        return False
+
+    # Truncate log file
+    stats.start_stage('modification')
+    log_file_path = "moodle_backup.log"
+    if tree.exists(log_file_path):
+         truncate_log_file(tree, log_file_path)
+    else:
+         print("\nLog file moodle_backup.log not found, skipping truncation.")
+
+    validation = None
+    if validate:
+        stats.start_stage('validate')
+        validation = validate_backup(tree, stats)
+        print_validation(validation)
+        if not validation['valid']:
+            print("Error: The modified backup is inconsistent and would fail to restore.")
+            return False
+        stats.start_stage('modification')
+
+    print(f"\nModified {len(tree.dirty_names())} of {len(tree.names())} members in memory (peak {tree.peak_memory_bytes / 1024:.1f} KiB).")
+    return {
+        'backup_id': new_backup_id,
+        'section_id': ids['section_id'],
+        'original_assignment_count': original_assignment_count,
+        'assignments': [{'name': details['name'], 'module_id': int(details['moduleid']), 'created': details['moduleid'] in added,
+                         'section_id': details['sectionid'], 'due_ts': info['due_ts'], 'cutoff_ts': info['cutoff_ts'], 'activation_ts': info.get('activation_ts')}
+                        for details, info in zip(final_assignment_details, assignment_base_data)],
+        'members': len(tree.names()),
+        'modified_members': len(tree.dirty_names()),
+        'peak_memory_bytes': tree.peak_memory_bytes,
+        'validation': validation,
+    }
+
+
+def modify_backup(input_path, output_path, assignment_base_data, target_assignment_count, section_title=None,
+                  target_start_timestamp=None, max_memory_bytes=None, compression_level=DEFAULT_COMPRESSION_LEVEL,
+                  compress_threads=None, verbose=True, stats=None, fixed_time=None, output_name=None, validate=True,
+                  codec=DEFAULT_OUTPUT_CODEC, section_layout=None):
+    """Extracts the backup to a temporary directory, modifies it and re-packs it as output_path.
+
+    output_path is a path or a writable binary file object; output_name is
+    the file name recorded in the backup (default: that of output_path).
+    Returns True on success; errors are printed. Each stage is recorded in
+    stats (a PipelineStats) if given. fixed_time makes the output
+    reproducible (see deterministic_timestamp()). section_layout spreads the
+    assignments over several sections (see parse_section_layout()).
+    """
+    stats = stats or PipelineStats(enabled=False)
+    with tempfile.TemporaryDirectory(prefix="moodle_mbz_") as temp_dir:
+        print(f"Using temporary directory: {temp_dir}")
+        temp_path = pathlib.Path(temp_dir)
+
+        try:
+            # 1. Extract (without dotfiles)
+            stats.start_stage('extract_mbz')
+            member_names = []
+            extract_mbz(input_path, temp_path, stats, member_names=member_names)
+
+            # 2.-7. Modify assignments and manifest files (in memory), written in the order of the other modes
+            tree = BackupTree.from_directory(temp_path, snapshot_member_order(member_names),
+                                             max_memory_bytes=max_memory_bytes, stats=stats, fixed_mtime=fixed_time)
+            if not apply_assignment_changes(tree, assignment_base_data, target_assignment_count,
+                                            output_name or default_output_name(output_path), section_title,
+                                            target_start_timestamp, verbose=verbose, stats=stats, fixed_time=fixed_time,
+                                            validate=validate, section_layout=section_layout):
+                return False
+
+            # 8. Re-pack as tar.gz (modified members from memory, the rest from disk)
+            stats.start_stage('create_mbz')
+            create_mbz(tree, output_path, compression_level, compress_threads, stats, codec)
+            stats.end_stage()
+            return True
+
+        except Exception as e:
+            print(f"\nAn error occurred during the process: {e}")
+            import traceback
+            traceback.print_exc() # Kept for error troubleshooting
+            return False
+        finally:
+             print(f"Temporary directory {temp_dir} cleaned up.")
+
+# --- Validation ---
+
+# A built backup is consistent if every module in <activities> of
+# moodle_backup.xml is in the <sequence> of its section.xml, its directory
+# exists and its module.xml names the same section, it has
+# _included and _userinfo settings, and no two assignments share an ID. Only
+# moodle_backup.xml, section.xml, module.xml and the ID files of assignments
+# are read; other members are only checked by name. With --stream, the
+# module.xml of other activities is copied unread and its section not checked.
+# Modules in a <sequence> but not in <activities> (activities left out of the
+# backup, which Moodle still lists) are only warned about: restore skips them.
+VALIDATED_MEMBER_PATTERN = re.compile(
+    r'moodle_backup\.xml|sections/section_\d+/section\.xml|activities/[^/]+/module\.xml'
+    r'|activities/assign_\d+/(?:assign|inforef|grading)\.xml')
+ACTIVITY_ENTRY_PATTERN = re.compile(rb'<activity>\s*<moduleid>(\d+)</moduleid>(.*?)</activity>', re.DOTALL)
+SECTION_ENTRY_PATTERN = re.compile(rb'<section>\s*<sectionid>(\d+)</sectionid>(.*?)</section>', re.DOTALL)
+ACTIVITY_SETTING_PATTERN = re.compile(
+    rb'<setting>\s*<level>activity</level>\s*<activity>([^<]*)</activity>\s*<name>([^<]*)</name>')
+SEQUENCE_PATTERN = re.compile(rb'<sequence>([^<]*)</sequence>')
+ASSIGN_MODULE_ID_PATTERN = re.compile(rb'<activity id="\d+" moduleid="(\d+)"')
+
+def _xml_field(tag, text):
+    match = re.search(b'<' + tag + b'>([^<]*)</' + tag + b'>', text)
+    return match.group(1).decode('utf-8') if match else None
+
+def _read_validated_members(source, stats):
+    """Returns (all member names, content of the members matching VALIDATED_MEMBER_PATTERN) in one pass."""
+    contents = {}
+    if isinstance(source, BackupTree):
+        names = set(source.names())
+        for name in names:
+            if (source.is_file(name) and not source.is_passthrough(name)
+                    and VALIDATED_MEMBER_PATTERN.fullmatch(name)):
+                with source.open_buffer(name) as content:
+                    contents[name] = bytes(content)
+        return names, contents
+    names = set()
+    stats.count('bytes_read', os.path.getsize(source))
+    with open_mbz_for_reading(source, stream=True) as tar:
+        for member in tar:
+            name = normalize_member_name(member.name)
+            if not name or is_dotfile_member(name):
+                continue
+            names.add(name)
+            if member.isfile() and VALIDATED_MEMBER_PATTERN.fullmatch(name):
+                contents[name] = tar.extractfile(member).read()
+    return names, contents
+
+def validate_backup(source, stats=None):
+    """Checks a backup (a BackupTree or the path of a .mbz) for structural consistency.
+
+    Returns a report with valid, errors, warnings (e.g. assignment
+    directories or settings that are not restored because they are not in
+    <activities>), and the number of activities and sections.
+    """
+    stats = stats or PipelineStats(enabled=False)
+    names, contents = _read_validated_members(source, stats)
+    directories = names | {name.rsplit('/', i)[0] for name in names for i in range(1, name.count('/') + 1)}
+    errors, warnings = [], []
+    report = {'valid': False, 'errors': errors, 'warnings': warnings, 'activities': 0, 'sections': 0}
+    backup_xml = contents.get('moodle_backup.xml')
+    if backup_xml is None:
+        errors.append("moodle_backup.xml is missing")
+        return report
+
+    # <activities> and <sections> of moodle_backup.xml
+    activities = {} # module ID -> (section ID, module name, directory)
+    for match in ACTIVITY_ENTRY_PATTERN.finditer(backup_xml):
+        module_id, fields = match.group(1).decode('ascii'), match.group(2)
+        if module_id in activities:
+            errors.append(f"Module {module_id} is listed twice in <activities>")
+        activities[module_id] = (_xml_field(b'sectionid', fields), _xml_field(b'modulename', fields),
+                                 _xml_field(b'directory', fields))
+    sections = {match.group(1).decode('ascii'): _xml_field(b'directory', match.group(2))
+                for match in SECTION_ENTRY_PATTERN.finditer(backup_xml)}
+    report.update(activities=len(activities), sections=len(sections))
+
+    # Section sequences
+    sequences = {} # section ID -> module IDs
+    for section_id, directory in sections.items():
+        section_xml = contents.get(f"{directory}/section.xml")
+        if section_xml is None:
+            errors.append(f"Section {section_id}: {directory}/section.xml is missing")
+            continue
+        sequence = SEQUENCE_PATTERN.search(section_xml)
+        module_ids = [module_id for module_id in (sequence.group(1).decode('ascii') if sequence else '').split(',') if module_id]
+        if len(set(module_ids)) != len(module_ids):
+            errors.append(f"Section {section_id}: <sequence> lists a module more than once")
+        sequences[section_id] = module_ids
+    sequenced = {module_id: section_id for section_id, module_ids in sequences.items() for module_id in module_ids}
+
+    # Activities: section, directory, settings
+    settings = collections.Counter(match.group(2).decode('utf-8') for match in ACTIVITY_SETTING_PATTERN.finditer(backup_xml))
+    for module_id, (section_id, module_name, directory) in activities.items():
+        if section_id not in sections:
+            errors.append(f"Module {module_id}: section {section_id} is not in <sections>")
+        elif section_id in sequences and sequenced.get(module_id) != section_id:
+            errors.append(f"Module {module_id}: missing from the <sequence> of section {section_id}")
+        if not directory or directory not in directories:
+            errors.append(f"Module {module_id}: directory {directory} is missing")
+        elif f"{directory}/module.xml" in contents:
+            module_section_id = _xml_field(b'sectionid', contents[f"{directory}/module.xml"])
+            if module_section_id is not None and module_section_id != section_id:
+                errors.append(f"Module {module_id}: module.xml places it in section {module_section_id}, <activities> in section {section_id}")
+        for setting in ('included', 'userinfo'):
+            count = settings.pop(f"{module_name}_{module_id}_{setting}", 0)
+            if count != 1:
+                errors.append(f"Module {module_id}: {count} {module_name}_{module_id}_{setting} settings, expected 1")
+    for module_id, section_id in sequenced.items():
+        if module_id not in activities:
+            warnings.append(f"Module {module_id} is in the <sequence> of section {section_id} but not in <activities> and will be skipped")
+    for setting in sorted(settings):
+        warnings.append(f"Setting {setting} belongs to no activity in <activities>")
+
+    # IDs of assignments must be unique across all restored assignments
+    owners = {} # (kind, ID) -> directory
+    for module_id, (_, module_name, directory) in sorted(activities.items()):
+        if module_name != 'assign':
+            continue
+        assign_xml = contents.get(f"{directory}/assign.xml")
+        if assign_xml is None:
+            errors.append(f"Module {module_id}: {directory}/assign.xml is missing")
+            continue
+        declared = ASSIGN_MODULE_ID_PATTERN.search(assign_xml)
+        if declared is None or declared.group(1).decode('ascii') != module_id:
+            errors.append(f"Module {module_id}: {directory}/assign.xml belongs to module {declared and declared.group(1).decode('ascii')}")
+        found = []
+        for activity_id, plugin_config_id, context_id in ASSIGN_ID_PATTERN.findall(assign_xml.decode('utf-8')):
+            found += [('activity', activity_id), ('plugin_config', plugin_config_id), ('context', context_id)]
+        for pattern, kind, file_name in ((INFOREF_GRADE_ITEM_PATTERN, 'grade_item', 'inforef.xml'),
+                                         (GRADING_AREA_PATTERN, 'grading_area', 'grading.xml')):
+            if f"{directory}/{file_name}" in contents:
+                found += [(kind, value) for value in pattern.findall(contents[f"{directory}/{file_name}"].decode('utf-8'))]
+        for kind, value in found:
+            if not value:
+                continue
+            owner = owners.setdefault((kind, value), directory)
+            if owner != directory:
+                errors.append(f"Duplicate {kind} ID {value} in {owner} and {directory}")
+
+    restored = {directory for _, _, directory in activities.values()}
+    for name in sorted(names):
+        if name.startswith("activities/") and name.count('/') == 1 and name in directories and name not in restored:
+            warnings.append(f"{name} is not in <activities> and will not be restored")
+    report['valid'] = not errors
+    return report
+
+def print_validation(report):
+    """Prints a validate_backup() report."""
+    status = "valid" if report['valid'] else f"INVALID ({len(report['errors'])} errors)"
+    print(f"\nValidated backup: {report['activities']} activities in {report['sections']} sections, {status}.")
+    for error in report['errors']:
+        print(f"  - Error: {error}")
+    for warning in report['warnings']:
+        print(f"  - Warning: {warning}")
+
+# --- Streaming Rewrite ---
+
+# Members read or rewritten by the modification steps. All other members are
+# copied from the input archive to the output archive without touching disk.
+STREAM_HELD_MEMBER_PATTERN = re.compile(
+    r'^(?:moodle_backup\.xml|moodle_backup\.log|sections/section_[^/]+/section\.xml|activities/assign_[^/]+(?:/.*)?)$'
+)
+
+def snapshot_member_order(names):
+    """Orders member names (in archive order) as --stream and template snapshots write them.
+
+    Members that are copied unread come first, then the held ones
+    (STREAM_HELD_MEMBER_PATTERN), each in archive order.
+    """
+    held = [name for name in names if STREAM_HELD_MEMBER_PATTERN.match(name)]
+    held_names = set(held)
+    return [name for name in names if name not in held_names] + held
+
+def scan_backup_members(input_path, tree, passthrough_tar):
+    """Reads a .mbz once, member by member.
+
+    Members matching STREAM_HELD_MEMBER_PATTERN are loaded into tree; all
+    others are copied to passthrough_tar right away and only registered in
+    tree as passthrough members. Returns the number of passthrough members.
+    """
+    passthrough_count = 0
+    with open_mbz_for_reading(input_path, stream=True) as tar_in:
+        for member in tar_in:
+            name = normalize_member_name(member.name)
+            if not name:
+                continue
+            if is_dotfile_member(name):
+                tree.skipped_dotfiles += 1
+                continue
+            if (member.isfile() or member.isdir()) and STREAM_HELD_MEMBER_PATTERN.match(name):
+                tree.add_member(member, tar_in.extractfile(member).read() if member.isfile() else None)
+            else:
+                # Known to the tree (so it is not re-created) but written right away
+                tree.add_member(member, passthrough=True)
+                info = copy.copy(member)
+                info.name = name
+                info.pax_headers = {} # Drop tool-specific extended headers (e.g. macOS xattrs)
+                if tree.fixed_mtime is not None:
+                    normalize_tarinfo(info, tree.fixed_mtime)
+                passthrough_tar.addfile(info, tar_in.extractfile(member) if member.isfile() else None)
+                passthrough_count += 1
+    return passthrough_count
+
+def stream_rewrite_mbz(input_path, output_path, assignment_base_data, target_assignment_count,
+                       section_title=None, target_start_timestamp=None, max_memory_bytes=None,
+                       compression_level=DEFAULT_COMPRESSION_LEVEL, compress_threads=None, verbose=True, stats=None,
+                       fixed_time=None, output_name=None, validate=True, codec=DEFAULT_OUTPUT_CODEC, section_layout=None):
+    """Rewrites the .mbz member by member instead of extracting and re-packing it.
+
+    Members matching STREAM_HELD_MEMBER_PATTERN are held in a BackupTree;
+    everything else (e.g. the files/ pool) is copied to the output archive as
+    it is read. Once the input is exhausted, the held members are modified in
+    memory and appended to the output, with new assignment directories placed
+    right after the existing activities. The stream_copy and write_held
+    stages (and those of apply_assignment_changes()) are recorded in stats if
+    given. fixed_time makes the output reproducible (see
+    deterministic_timestamp()). section_layout spreads the assignments over
+    several sections (see parse_section_layout()).
+
+    output_path can also be a writable binary file object; output_name is
+    the file name recorded in the backup (default: that of output_path). A
+    failed rewrite removes an incomplete output file, but cannot take back
+    what was already written to a file object.
+    """
+    stats = stats or PipelineStats(enabled=False)
+    to_file_object = is_file_object(output_path)
+    output_name = output_name or default_output_name(output_path)
+    print(f"\nStreaming {input_path} to {'a stream' if to_file_object else output_path}...")
+    if not to_file_object:
+        output_path = pathlib.Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        if output_path.exists():
+            print(f"Warning: Output file {output_path} exists. Deleting.")
+            output_path.unlink()
+
+    tree = BackupTree(sort_members=False, max_memory_bytes=max_memory_bytes, stats=stats, fixed_mtime=fixed_time)
+    tree.source = str(input_path)
+    success = False
+    try:
+        stats.start_stage('stream_copy')
+        with open_mbz_for_writing(output_path, compression_level, compress_threads, stats, codec) as tar_out:
+            passthrough_count = scan_backup_members(input_path, tree, tar_out)
+            stats.count('bytes_read', os.path.getsize(input_path))
+            print(f"  Copied {passthrough_count} members unchanged, holding {len(tree.names()) - passthrough_count} members for modification.")
+            print(f"  Skipped {tree.skipped_dotfiles} dotfiles/directories.")
+
+            if not apply_assignment_changes(tree, assignment_base_data, target_assignment_count,
+                                            output_name, section_title, target_start_timestamp,
+                                            verbose=verbose, stats=stats, fixed_time=fixed_time, validate=validate,
+                                            section_layout=section_layout):
+                return False
+            stats.start_stage('write_held')
+            written = tree.write_to_tar(tar_out)
+            print(f"  Wrote {written} held and new members.")
+        stats.end_stage()
+        success = True
+        print("Archive written successfully." if to_file_object else f"Archive created successfully: {output_path}")
+        return True
+    except tarfile.ReadError as e:
+        print(f"Error reading archive {input_path}: {e}")
+        print("Is it a valid .mbz (tar.gz, tar.xz, tar.bz2, tar.zst or tar) file?")
+        raise
+    finally:
+        if not success and not to_file_object and output_path.exists():
+            print(f"Removing incomplete output file {output_path}.")
+            output_path.unlink()
+
+# --- Batch Builds ---
+
+# Manifest columns/keys that are converted to int; all other values are strings.
+# Columns are named like the command line options (e.g. section_title or section-title).
+BATCH_INT_FIELDS = ('num_assignments', 'num_consecutive_weeks', 'extra_time')
+BATCH_FIELDS = ('output_mbz', 'num_assignments', 'first_submission_date', 'num_consecutive_weeks',
+                'submission_dates', 'submission_time', 'extra_time', 'section_title', 'section_layout',
+                'assignment_name_prefix', 'target_start_date')
+BATCH_FIELD_ALIASES = {'output': 'output_mbz', 'output_name': 'output_mbz'}
+
+def load_template_snapshot(input_path, passthrough_path):
+    """Parses a template .mbz once so that many builds can share it.
+
+    Held members and their ID index are kept in a picklable dictionary; all
+    other members are written to an uncompressed tar at passthrough_path, from
+    which every build copies them without decompressing the template again.
+    """
+    print(f"\nLoading template {input_path}...")
+    tree = BackupTree(sort_members=False)
+    with tarfile.open(passthrough_path, "w:") as passthrough_tar:
+        passthrough_count = scan_backup_members(input_path, tree, passthrough_tar)
+    index = BackupIdIndex(tree)
+    print(f"  {passthrough_count} passthrough and {len(tree.names()) - passthrough_count} held members, {tree.skipped_dotfiles} dotfiles skipped.")
+    return {
+        'source': str(input_path),
+        'members': tree.export_members(),
+        'passthrough_path': str(passthrough_path) if passthrough_count else None,
+        'index': index.state(),
+        'template': describe_template(tree, index),
+    }
+
+def build_from_snapshot(snapshot, args, max_memory_bytes=None, plan=None, stats=None):
+    """Builds one output .mbz (args.output_mbz) from a template snapshot. Returns True on success.
+
+    plan is the result of plan_build(args) if the caller has it already.
+    Stages are recorded in stats (a PipelineStats) if given.
+    """
+    with MbzEditor(snapshot, max_memory_bytes, stats, echo=True) as editor:
+        return editor.build(plan or plan_build(args), pathlib.Path(args.output_mbz).resolve())['success']
+
+def read_batch_manifest(manifest_path):
+    """Reads a batch manifest (.json list of objects or .csv with a header row) into a list of dicts.
+
+    Keys are normalized to the argument names used by plan_assignments();
+    empty values are dropped so that the command line defaults apply.
+    """
+    manifest_path = pathlib.Path(manifest_path)
+    if manifest_path.suffix.lower() == '.json':
+        data = json.loads(manifest_path.read_text(encoding='utf-8'))
+        raw_rows = data.get('courses', []) if isinstance(data, dict) else data
+    else:
+        with open(manifest_path, newline='', encoding='utf-8-sig') as f:
+            raw_rows = list(csv.DictReader(f))
+
+    rows = []
+    for raw_row in raw_rows:
+        row = {}
+        for key, value in raw_row.items():
+            if key is None or value is None or str(value).strip() == '':
+                continue
+            key = key.strip().lower().replace('-', '_')
+            key = BATCH_FIELD_ALIASES.get(key, key)
+            if key not in BATCH_FIELDS:
+                raise ValueError(f"Unknown column '{key}' in batch manifest {manifest_path}")
+            row[key] = value.strip() if isinstance(value, str) else value
+        rows.append(row)
+    return rows
+
+def batch_row_args(defaults, row):
+    """Returns the arguments for one manifest row: command line values overridden by the row."""
+    args = copy.copy(defaults)
+    args.output_name = None # Each row is named after its output file
+    for key, value in row.items():
+        setattr(args, key, int(value) if key in BATCH_INT_FIELDS else value)
+    return args
+
+_batch_snapshot = None # Template snapshot of the current batch worker process
+
+def _init_batch_worker(snapshot):
+    global _batch_snapshot
+    _batch_snapshot = snapshot
+
+def _run_batch_job(job):
+    """Builds one manifest row in a worker. Never raises; failures are reported in the result."""
+    row_number, args, max_memory_bytes, template_digest = job
+    log = io.StringIO()
+    result = {'row': row_number, 'output': args.output_mbz, 'success': False, 'error': None}
+    try:
+        with contextlib.redirect_stdout(log):
+            if template_digest:
+                result['success'] = build_incrementally(args, template_digest,
+                                                        lambda: build_from_snapshot(_batch_snapshot, args, max_memory_bytes))
+            else:
+                result['success'] = build_from_snapshot(_batch_snapshot, args, max_memory_bytes)
+        if not result['success']:
+            result['error'] = "Build failed (see log)"
+    except Exception as e:
+        result['error'] = str(e)
+    result['log'] = log.getvalue()
+    return result
+
+def run_batch(input_path, manifest_path, defaults, jobs=None, max_memory_bytes=None, cache=None, concurrency=None):
+    """Builds one .mbz per manifest row from a single parse of the template.
+
+    Rows are built in a process pool, or with concurrency, by up to that many
+    concurrent builds in this process (see build_many()); a failing row is
+    reported and does not stop the others. The template snapshot is taken from cache (a
+    TemplateCache) if given. With --incremental, unchanged outputs are
+    reused. Returns the list of per-row results.
+    """
+    rows = read_batch_manifest(manifest_path)
+    print(f"Batch manifest {manifest_path}: {len(rows)} course(s).")
+    template_digest = file_sha256(input_path) if defaults.incremental else None
+
+    results = []
+    batch_jobs = []
+    seen_outputs = set()
+    for row_number, row in enumerate(rows, start=1):
+        output = row.get('output_mbz')
+        if not output or output in seen_outputs:
+            error = "Missing output name" if not output else f"Duplicate output name {output}"
+            results.append({'row': row_number, 'output': output, 'success': False, 'error': error, 'log': ''})
+            print(f"  [{row_number}] {output}: FAILED: {error}")
+            continue
+        seen_outputs.add(output)
+        row_args = batch_row_args(defaults, row)
+        if not row_args.compress_threads:
+            row_args.compress_threads = 1 # Rows are built in parallel already
+        batch_jobs.append((row_number, row_args, max_memory_bytes, template_digest))
+
+    with tempfile.TemporaryDirectory(prefix="moodle_mbz_batch_") as work_dir:
+        if cache is not None:
+            snapshot = cache.snapshot_for(input_path, pathlib.Path(work_dir))
+        else:
+            snapshot = load_template_snapshot(input_path, pathlib.Path(work_dir) / "passthrough.tar")
+        if concurrency:
+            print(f"Building {len(batch_jobs)} backup(s), up to {concurrency} at once...")
+            results.extend(asyncio.run(_run_batch_concurrently(snapshot, batch_jobs, concurrency)))
+        else:
+            results.extend(_run_batch_in_processes(snapshot, batch_jobs, jobs))
+
+    results.sort(key=lambda result: result['row'])
+    failed = [result for result in results if not result['success']]
+    print(f"\nBatch finished: {len(results) - len(failed)} succeeded, {len(failed)} failed.")
+    for result in failed:
+        print(f"\n--- Log for row {result['row']} ({result['output']}) ---")
+        print(result['log'].strip() or result['error'])
+    return results
+
+def _run_batch_in_processes(snapshot, batch_jobs, jobs=None):
+    """Builds batch jobs (see run_batch()) in a process pool of jobs workers, printing each result as it completes."""
+    results = []
+    jobs = min(jobs or os.cpu_count() or 1, max(len(batch_jobs), 1))
+    print(f"Building {len(batch_jobs)} backup(s) with {jobs} worker process(es)...")
+    pool = None
+    if jobs > 1:
+        try:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_batch_worker, initargs=(snapshot,))
+        except (OSError, NotImplementedError) as e:
+            print(f"Warning: Could not start worker processes ({e}). Building sequentially.")
+    if pool is None:
+        _init_batch_worker(snapshot)
+        completed = (_run_batch_job(job) for job in batch_jobs)
+    else:
+        futures = {pool.submit(_run_batch_job, job): job for job in batch_jobs}
+        completed = (_batch_future_result(future, futures[future]) for future in concurrent.futures.as_completed(futures))
+    try:
+        for result in completed:
+            status = "OK" if result['success'] else f"FAILED: {result['error']}"
+            print(f"  [{result['row']}] {result['output']}: {status}")
+            results.append(result)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return results
+
+def _batch_future_result(future, job):
+    """Returns the result of a batch job future, turning worker crashes into failed results."""
+    try:
+        return future.result()
+    except Exception as e:
+        return {'row': job[0], 'output': job[1].output_mbz, 'success': False, 'error': f"Worker failed: {e}", 'log': ''}
+
+# --- Concurrent Builds (asyncio) ---
+
+class ThreadOutput(io.TextIOBase):
+    """Replacement for sys.stdout that keeps the prints of each thread in the buffer registered for it.
+
+    Prints of threads without a buffer go to fallback.
+    """
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self._local = threading.local()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        return (getattr(self._local, 'buffer', None) or self.fallback).write(text)
+
+    def flush(self):
+        self.fallback.flush()
+
+    @contextlib.contextmanager
+    def capture(self, buffer):
+        self._local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            self._local.buffer = None
+
+async def build_many(snapshot, jobs, concurrency=4, max_memory_bytes=None, executor=None):
+    """Builds many backups from one template snapshot concurrently, yielding an event per started and finished job.
+
+    jobs is a list of (job_id, plan, output) with plans from plan_build(). At
+    most concurrency builds run at once. The modification and the compression
+    of each build run in executor threads (default: a pool with concurrency
+    threads), so that the compression of one build (zlib releases the GIL)
+    overlaps the modification and file writes of others. Events are
+    dictionaries with event ('started' or 'finished'), job and output; finished
+    events also have success, error, seconds and the MbzEditor result
+    (including the build's log).
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    events = asyncio.Queue()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    output = ThreadOutput(sys.stdout)
+
+    def captured(log, function, *args):
+        with output.capture(log):
+            return function(*args)
+
+    async def run(job_id, plan, job_output):
+        async with semaphore:
+            await events.put({'event': 'started', 'job': job_id, 'output': str(job_output)})
+            start = time.perf_counter()
+            log = io.StringIO()
+            editor = MbzEditor(snapshot, max_memory_bytes, echo=True)
+            try:
+                result = await loop.run_in_executor(executor, captured, log, editor.apply, plan, pathlib.Path(job_output).name)
+                if result['success']:
+                    await loop.run_in_executor(executor, captured, log, editor.save, job_output)
+            except Exception as e:
+                result = {'success': False, 'error': f"{type(e).__name__}: {e}"}
+            finally:
+                editor.close()
+            result['log'] = log.getvalue()
+            await events.put({'event': 'finished', 'job': job_id, 'output': str(job_output), 'success': result['success'],
+                              'error': result.get('error'), 'seconds': round(time.perf_counter() - start, 6),
+                              'result': result})
+
+    tasks = []
+    try:
+        with contextlib.redirect_stdout(output):
+            tasks = [asyncio.ensure_future(run(*job)) for job in jobs]
+            finished = 0
+            while finished < len(tasks):
+                event = await events.get()
+                finished += event['event'] == 'finished'
+                yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if own_executor:
+            executor.shutdown()
+
+async def _run_batch_concurrently(snapshot, batch_jobs, concurrency):
+    """Builds batch jobs (see run_batch()) with build_many(), printing each result as it completes."""
+    results = []
+    plans = []
+    for row_number, args, max_memory_bytes, template_digest in batch_jobs:
+        try:
+            plan = plan_build(args)
+        except ValueError as e:
+            results.append({'row': row_number, 'output': args.output_mbz, 'success': False, 'error': str(e), 'log': ''})
+            print(f"  [{row_number}] {args.output_mbz}: FAILED: {e}")
+            continue
+        key = build_key(args, template_digest) if template_digest else None
+        if key and output_is_up_to_date(pathlib.Path(args.output_mbz).resolve(), key):
+            results.append({'row': row_number, 'output': args.output_mbz, 'success': True, 'error': None, 'log': ''})
+            print(f"  [{row_number}] {args.output_mbz}: OK (up to date)")
+            continue
+        if key:
+            discard_build_manifest(pathlib.Path(args.output_mbz).resolve())
+        plans.append((row_number, plan, args.output_mbz, key, template_digest))
+
+    max_memory_bytes = batch_jobs[0][2] if batch_jobs else None
+    outputs = {row_number: (output, key, template_digest) for row_number, _, output, key, template_digest in plans}
+    jobs = [(row_number, plan, pathlib.Path(output).resolve()) for row_number, plan, output, _, _ in plans]
+    async for event in build_many(snapshot, jobs, concurrency, max_memory_bytes):
+        if event['event'] != 'finished':
+            continue
+        row_number = event['job']
+        output, key, template_digest = outputs[row_number]
+        if event['success'] and key:
+            write_build_manifest(pathlib.Path(output).resolve(), key, template_digest)
+        result = {'row': row_number, 'output': output, 'success': event['success'], 'error': event['error'],
+                  'log': event['result']['log']}
+        status = "OK" if result['success'] else f"FAILED: {result['error']}"
+        print(f"  [{row_number}] {result['output']}: {status} ({event['seconds']:.2f} s)")
+        results.append(result)
+    return results
+
+# --- Template Cache ---
+
+# Parsed templates are cached on disk, keyed by the SHA-256 of the template
+# .mbz, so that repeated builds from the same template skip decompressing and
+# scanning it. Bump TEMPLATE_CACHE_FORMAT whenever the content of a snapshot
+# changes; entries of other formats are rebuilt.
+TEMPLATE_CACHE_FORMAT = 2
+DEFAULT_CACHE_MAX_MB = 512
+
+def default_cache_dir():
+    """Returns the per-user cache directory for parsed templates (MBZ_TEMPLATE_CACHE_DIR overrides it)."""
+    if os.environ.get('MBZ_TEMPLATE_CACHE_DIR'):
+        return pathlib.Path(os.environ['MBZ_TEMPLATE_CACHE_DIR'])
+    if sys.platform == 'win32' and os.environ.get('LOCALAPPDATA'):
+        base = pathlib.Path(os.environ['LOCALAPPDATA'])
+    elif sys.platform == 'darwin':
+        base = pathlib.Path.home() / "Library" / "Caches"
+    else:
+        base = pathlib.Path(os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / ".cache")
+    return base / "klausur-booklets" / "mbz-templates"
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Returns the hex SHA-256 digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class TemplateCache:
+    """Size-bounded on-disk cache of template snapshots (see load_template_snapshot()).
+
+    Each entry is a directory named after the template's SHA-256 with
+    state.json (ID index, assign/inforef templates, moodle_backup.xml layout),
+    held.tar (members modified by builds) and passthrough.tar (all other
+    members), both uncompressed. The modification time of state.json records
+    the last use; the least recently used entries are evicted once the cache
+    grows beyond max_bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir else default_cache_dir()
+        self.max_bytes = max_bytes
+
+    def _entry_dir(self, digest):
+        return self.cache_dir / digest
+
+    def load(self, digest, input_path):
+        """Returns the cached snapshot for a template digest, or None if it is not cached (or unusable)."""
+        entry_dir = self._entry_dir(digest)
+        state_path = entry_dir / "state.json"
+        if not state_path.is_file():
+            return None
+        try:
+            state = json.loads(state_path.read_text(encoding='utf-8'))
+            if state.get('format') != TEMPLATE_CACHE_FORMAT:
+                print(f"  Cached template {digest[:12]} has an old format, rebuilding it.")
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return None
+            members = []
+            with tarfile.open(entry_dir / "held.tar", "r:") as held_tar:
+                for info in held_tar:
+                    attributes = {key: getattr(info, key) for key in TARINFO_SNAPSHOT_ATTRIBUTES}
+                    members.append((info.name, attributes, held_tar.extractfile(info).read() if info.isfile() else None))
+            passthrough_path = entry_dir / "passthrough.tar"
+            os.utime(state_path) # Mark as recently used
+        except (OSError, ValueError, KeyError, tarfile.TarError) as e:
+            print(f"Warning: Ignoring unreadable cache entry {entry_dir}: {e}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        return {
+            'source': str(input_path),
+            'members': members,
+            'passthrough_path': str(passthrough_path) if state['has_passthrough'] else None,
+            'index': state['index'],
+            'template': state['template'],
+        }
+
+    def store(self, digest, snapshot):
+        """Adds a snapshot to the cache (files are copied, snapshot stays valid) and evicts old entries."""
+        entry_dir = self._entry_dir(digest)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        staging_dir = pathlib.Path(tempfile.mkdtemp(prefix=f".{digest[:12]}-", dir=self.cache_dir))
+        try:
+            with tarfile.open(staging_dir / "held.tar", "w:") as held_tar:
+                for name, attributes, data in snapshot['members']:
+                    info = tarfile.TarInfo(name)
+                    for key, value in attributes.items():
+                        setattr(info, key, value)
+                    info.size = len(data) if data is not None else 0
+                    held_tar.addfile(info, io.BytesIO(data) if data is not None else None)
+            if snapshot['passthrough_path']:
+                shutil.copyfile(snapshot['passthrough_path'], staging_dir / "passthrough.tar")
+            state = {
+                'format': TEMPLATE_CACHE_FORMAT,
+                'has_passthrough': bool(snapshot['passthrough_path']),
+                'index': snapshot['index'],
+                'template': snapshot['template'],
+            }
+            # Written last: an entry without state.json is never loaded
+            (staging_dir / "state.json").write_text(json.dumps(state), encoding='utf-8')
+
+            size = self._entry_size(staging_dir)
+            if size > self.max_bytes:
+                print(f"  Template is larger than the cache limit ({size // (1024 * 1024)} MiB), not caching it.")
+                return
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            staging_dir.rename(entry_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        print(f"  Cached parsed template as {digest[:12]} in {self.cache_dir}.")
+        self.evict(keep=digest)
+
+    @staticmethod
+    def _entry_size(entry_dir):
+        return sum(path.stat().st_size for path in entry_dir.iterdir() if path.is_file())
+
+    def evict(self, keep=None):
+        """Removes least recently used entries until the cache fits into max_bytes."""
+        entries = []
+        for entry_dir in self.cache_dir.iterdir():
+            state_path = entry_dir / "state.json"
+            if entry_dir.name.startswith('.') or not state_path.is_file():
+                continue
+            entries.append((state_path.stat().st_mtime, entry_dir.name, self._entry_size(entry_dir)))
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            print(f"  Evicting cached template {name[:12]} ({size // 1024} KiB).")
+            shutil.rmtree(self._entry_dir(name), ignore_errors=True)
+            total -= size
+
+    def snapshot_for(self, input_path, work_dir):
+        """Returns a template snapshot for input_path, from the cache or parsed into work_dir (and cached).
+
+        A cached passthrough.tar is hardlinked (or copied) into work_dir, so
+        that the snapshot stays usable when its entry is evicted later.
+        """
+        digest = file_sha256(input_path)
+        snapshot = self.load(digest, input_path)
+        if snapshot is not None and snapshot['passthrough_path']:
+            passthrough_path = pathlib.Path(work_dir) / "passthrough.tar"
+            try:
+                try:
+                    os.link(snapshot['passthrough_path'], passthrough_path)
+                except OSError: # e.g. the cache is on another file system
+                    shutil.copyfile(snapshot['passthrough_path'], passthrough_path)
+                snapshot['passthrough_path'] = str(passthrough_path)
+            except OSError as e:
+                print(f"Warning: Could not use cached template {digest[:12]} ({e}), parsing it again.")
+                snapshot = None
+        if snapshot is not None:
+            print(f"\nUsing cached template {digest[:12]} for {input_path}.")
+            return snapshot
+        snapshot = load_template_snapshot(input_path, pathlib.Path(work_dir) / "passthrough.tar")
+        try:
+            self.store(digest, snapshot)
+        except OSError as e:
+            print(f"Warning: Could not cache the parsed template in {self.cache_dir}: {e}")
+        return snapshot
+
+# --- Incremental Builds ---
+
+# A build manifest (<output>.build.json) records the key of the inputs an
+# output was built from. --incremental reuses the output if the key is
+# unchanged and the output has not been modified since. Bump
+# BUILD_MANIFEST_FORMAT whenever the key changes.
+BUILD_MANIFEST_FORMAT = 2
+# Options that do not change the output archive and are left out of the key.
+# --stream, --no-cache and building from the cache write the same archive.
+BUILD_KEY_IGNORED_ARGS = ('input_mbz', 'output_mbz', 'output_name', 'batch', 'jobs', 'concurrency', 'compress_threads',
+                          'scale', 'verbosity', 'stats_json', 'max_memory_mb', 'stream', 'no_cache', 'cache_dir',
+                          'cache_max_mb', 'worker', 'incremental', 'validate', 'validate_only')
+
+def build_manifest_path(output_path):
+    output_path = pathlib.Path(output_path)
+    return output_path.with_name(output_path.name + ".build.json")
+
+def build_key(args, template_digest):
+    """Returns the SHA-256 of everything a build depends on: this script, the template and the build options."""
+    arguments = {key: value for key, value in vars(args).items() if key not in BUILD_KEY_IGNORED_ARGS}
+    arguments['output_name'] = recorded_output_name(args) # Written into moodle_backup.xml
+    key_data = {
+        'format': BUILD_MANIFEST_FORMAT,
+        'script': file_sha256(__file__),
+        'template': template_digest,
+        'arguments': arguments,
+        'source_date_epoch': os.environ.get('SOURCE_DATE_EPOCH'),
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+def output_is_up_to_date(output_path, key):
+    """Checks whether output_path was built with key (see build_key()) and is unchanged since."""
+    try:
+        manifest = json.loads(build_manifest_path(output_path).read_text(encoding='utf-8'))
+        return (manifest.get('key') == key and pathlib.Path(output_path).is_file()
+                and manifest.get('output_sha256') == file_sha256(output_path))
+    except (OSError, ValueError, AttributeError):
+        return False
+
+def discard_build_manifest(output_path):
+    try:
+        build_manifest_path(output_path).unlink()
+    except FileNotFoundError:
+        pass
+
+def write_build_manifest(output_path, key, template_digest):
+    """Records that output_path was built with key."""
+    manifest = {
+        'format': BUILD_MANIFEST_FORMAT,
+        'key': key,
+        'template_sha256': template_digest,
+        'output_sha256': file_sha256(output_path),
+    }
+    build_manifest_path(output_path).write_text(json.dumps(manifest, indent=2) + "\n", encoding='utf-8')
+
+def build_incrementally(args, template_digest, build):
+    """Calls build() unless the output of args is up to date (see output_is_up_to_date()).
+
+    A build manifest is written after a successful build. Returns the result
+    of build(), or True if the existing output was reused.
+    """
+    output_path = pathlib.Path(args.output_mbz).resolve()
+    key = build_key(args, template_digest)
+    if output_is_up_to_date(output_path, key):
+        print(f"Output {output_path} is up to date (same template and options), reusing it.")
+        return True
+    discard_build_manifest(output_path)
+    success = build()
+    if success:
+        write_build_manifest(output_path, key, template_digest)
+    return success
+
+# --- Library API ---
+
+# Build options of plan_build() and MbzEditor.plan(), named like the command line options, with their defaults
+BUILD_OPTION_DEFAULTS = {
+    'num_assignments': TARGET_ASSIGNMENT_COUNT,
+    'first_submission_date': None,
+    'num_consecutive_weeks': None,
+    'submission_dates': None,
+    'submission_time': "23:59:59",
+    'extra_time': 60,
+    'section_title': None,
+    'section_layout': None,
+    'assignment_name_prefix': "Page",
+    'target_start_date': None,
+    'deterministic': False,
+    'compression_level': DEFAULT_COMPRESSION_LEVEL,
+    'compress_threads': None,
+    'output_codec': DEFAULT_OUTPUT_CODEC,
+    'scale': False,
+    'verbosity': 2,
+    'validate': True,
+}
+
+def plan_build(args=None, **options):
+    """Validates the options of one build and returns its plan.
+
+    args is an argparse.Namespace (e.g. the parsed command line) and options
+    override single values; missing options take the defaults of
+    BUILD_OPTION_DEFAULTS. The plan is a dictionary with the merged options,
+    the assignments (see plan_assignments()), target_assignment_count,
+    target_start_timestamp, fixed_time (see deterministic_timestamp()) and
+    section_layout (see parse_section_layout(), None without the option).
+    Raises ValueError for invalid or unknown options.
+    """
+    unknown = set(options) - set(BUILD_OPTION_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown build option(s): {', '.join(sorted(unknown))}")
+    values = dict(BUILD_OPTION_DEFAULTS)
+    values.update(vars(args) if args is not None else {})
+    values.update(options)
+    args = argparse.Namespace(**values)
+    if not codec_available(args.output_codec):
+        raise ValueError(f"Output codec {args.output_codec} is not available (choose from {', '.join(c for c in OUTPUT_CODECS if codec_available(c))})")
+    assignment_base_data, target_assignment_count, target_start_timestamp = plan_assignments(args)
+    return {
+        'options': args,
+        'assignments': assignment_base_data,
+        'target_assignment_count': target_assignment_count,
+        'target_start_timestamp': target_start_timestamp,
+        'fixed_time': deterministic_timestamp(args),
+        'section_layout': parse_section_layout(args.section_layout, target_assignment_count) if args.section_layout else None,
+    }
+
+class MbzEditor:
+    """Builds Moodle backups from a template in-process, without the command line.
+
+        with MbzEditor.open("moodle-4.5-2024100700.mbz") as editor:
+            plan = editor.plan(first_submission_date="2025-04-25", num_consecutive_weeks=6,
+                               section_title="Exam Booklet")
+            result = editor.build(plan, "booklets.mbz")
+
+    The template is parsed once (see load_template_snapshot()) and every
+    apply() starts from the unmodified template, so one editor can build any
+    number of backups. Results are dictionaries; the messages of the build
+    steps are collected in result['log'] instead of being printed, unless
+    echo is set (as for the command line).
+    """
+
+    def __init__(self, snapshot, max_memory_bytes=None, stats=None, echo=False, work_dir=None):
+        self.snapshot = snapshot
+        self.max_memory_bytes = max_memory_bytes
+        self.stats = stats or PipelineStats(enabled=False)
+        self.echo = echo
+        self._work_dir = work_dir # Temporary directory owned by the editor (removed by close())
+        self._tree = None # Modified tree of the last successful apply()
+        self._plan = None
+        self._result = None
+
+    @classmethod
+    def open(cls, template_path, cache=None, max_memory_bytes=None, stats=None, echo=False):
+        """Parses a template .mbz, or takes it from cache (a TemplateCache). Raises if it cannot be read."""
+        work_dir = pathlib.Path(tempfile.mkdtemp(prefix="moodle_mbz_"))
+        try:
+            with contextlib.nullcontext() if echo else contextlib.redirect_stdout(io.StringIO()):
+                if cache is not None:
+                    snapshot = cache.snapshot_for(template_path, work_dir)
+                else:
+                    snapshot = load_template_snapshot(template_path, work_dir / "passthrough.tar")
+        except BaseException:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+        return cls(snapshot, max_memory_bytes, stats, echo, work_dir)
+
+    def close(self):
+        self.discard()
+        if self._work_dir is not None:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+            self._work_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def discard(self):
+        """Drops the modified backup of the last apply() without saving it."""
+        if self._tree is not None:
+            self._tree.close()
+            self._tree = None
+
+    @contextlib.contextmanager
+    def _capture(self, result):
+        if self.echo:
+            yield
+            return
+        log = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(log):
+                yield
+        finally:
+            result['log'] += log.getvalue()
+
+    def plan(self, args=None, **options):
+        """Returns the plan of a build, see plan_build(). Raises ValueError for invalid options."""
+        with contextlib.nullcontext() if self.echo else contextlib.redirect_stdout(io.StringIO()):
+            return plan_build(args, **options)
+
+    def apply(self, plan, output_name):
+        """Applies a plan to a fresh copy of the template.
+
+        output_name is the file name recorded in the backup. Returns a result
+        dictionary with success, error, log, output (None until saved),
+        output_name, backup_id, section_id (of the first assignment),
+        original_assignment_count, assignments (name, module_id, created,
+        section_id, due_ts, cutoff_ts and activation_ts of each final
+        assignment), members, modified_members,
+        peak_memory_bytes and validation (see validate_backup(), None if
+        the validate option is off).
+        """
+        self.discard()
+        options = plan['options']
+        result = {'success': False, 'error': None, 'log': '', 'output': None, 'output_name': output_name}
+        with self._capture(result):
+            tree = BackupTree.from_snapshot(self.snapshot, max_memory_bytes=self.max_memory_bytes, stats=self.stats,
+                                            fixed_mtime=plan['fixed_time'])
+            try:
+                summary = apply_assignment_changes(tree, plan['assignments'], plan['target_assignment_count'],
+                                                   output_name, options.section_title, plan['target_start_timestamp'],
+                                                   index=BackupIdIndex(tree, self.snapshot['index']),
+                                                   template=self.snapshot.get('template'),
+                                                   verbose=per_file_output(options), stats=self.stats,
+                                                   fixed_time=plan['fixed_time'], validate=options.validate,
+                                                   section_layout=plan['section_layout'])
+            except BaseException:
+                tree.close()
+                raise
+        if summary:
+            result.update(summary, success=True)
+            self._tree, self._plan = tree, plan
+        else:
+            tree.close()
+            result['error'] = "Could not apply the plan to the template (see log)"
+        self._result = result
+        return result
+
+    def save(self, output):
+        """Writes the backup of the last successful apply() to a path or a writable binary file object.
+
+        Returns the result of apply() with output set (None for file objects).
+        If writing to a path fails, the error is raised and no file is left.
+        """
+        if self._tree is None:
+            raise RuntimeError("Nothing to save: apply() was not called or failed")
+        options = self._plan['options']
+        result = self._result
+        with self._capture(result):
+            self.stats.start_stage('create_mbz')
+            create_mbz(self._tree, output, options.compression_level, options.compress_threads, self.stats,
+                       options.output_codec)
+            if not is_file_object(output):
+                result['output'] = str(pathlib.Path(output).resolve())
+            self.stats.end_stage()
+        return result
+
+    def build(self, plan, output, output_name=None):
+        """Applies a plan and saves the backup to output (a path or a binary file object). Returns the result.
+
+        output_name defaults to the file name of output (DEFAULT_STREAM_OUTPUT_NAME for file objects).
+        """
+        if output_name is None:
+            output_name = default_output_name(output)
+        result = self.apply(plan, output_name)
+        if result['success']:
+            self.save(output)
+            self.discard()
+        return result
+
+# --- Worker Mode ---
+
+# --worker reads one JSON-RPC 2.0 request per line from stdin and writes one
+# response per line to stdout, keeping parsed templates in memory between
+# requests. Methods: generate, preview, validate and shutdown (see
+# BuildWorker). Errors use the JSON-RPC codes below.
+RPC_PARSE_ERROR = -32700
+RPC_INVALID_REQUEST = -32600
+RPC_METHOD_NOT_FOUND = -32601
+RPC_INVALID_PARAMS = -32602
+RPC_SERVER_ERROR = -32000
+WORKER_MAX_TEMPLATES = 8
+# Types of the build options in worker requests; all others are strings.
+# Integers may also be given as strings, like the cells of a manifest.
+WORKER_INT_OPTIONS = ('num_assignments', 'num_consecutive_weeks', 'extra_time', 'compression_level',
+                      'compress_threads', 'verbosity')
+WORKER_BOOL_OPTIONS = ('deterministic', 'scale', 'validate')
+WORKER_OPTION_CHOICES = {'compression_level': range(10), 'verbosity': (0, 1, 2), 'output_codec': OUTPUT_CODECS}
+
+class RpcError(Exception):
+    """Error reported to a worker client as a JSON-RPC error response."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+class BuildWorker:
+    """Handles worker requests against templates that stay parsed between requests.
+
+    Templates are kept as MbzEditors, keyed by path and reloaded if the file
+    changes; the least recently used one is closed when more than
+    max_templates are open. Request parameters are template (path to the
+    template .mbz), the build options of plan_build() and, for generate,
+    output (path of the new .mbz). include_log adds the build messages to
+    the result.
+    """
+
+    def __init__(self, cache=None, max_memory_bytes=None, max_templates=WORKER_MAX_TEMPLATES):
+        self.cache = cache
+        self.max_memory_bytes = max_memory_bytes
+        self.max_templates = max_templates
+        self._editors = collections.OrderedDict() # path -> (file signature, MbzEditor), least recently used first
+        self.running = True
+
+    def close(self):
+        for _, editor in self._editors.values():
+            editor.close()
+        self._editors.clear()
+
+    def editor_for(self, template):
+        """Returns the MbzEditor of a template, parsing it on first use or after it changed."""
+        path = pathlib.Path(template).resolve()
+        try:
+            stat = path.stat()
+        except OSError as e:
+            raise RpcError(RPC_INVALID_PARAMS, f"Template not found: {template} ({e.strerror})")
+        signature = (stat.st_size, stat.st_mtime_ns)
+        entry = self._editors.pop(str(path), None)
+        if entry is not None and entry[0] != signature:
+            entry[1].close()
+            entry = None
+        if entry is None:
+            entry = (signature, MbzEditor.open(path, self.cache, self.max_memory_bytes))
+        self._editors[str(path)] = entry
+        while len(self._editors) > self.max_templates:
+            self._editors.popitem(last=False)[1][1].close()
+        return entry[1]
+
+    @staticmethod
+    def _split_params(params, *required):
+        if not isinstance(params, dict):
+            raise RpcError(RPC_INVALID_PARAMS, "params must be an object")
+        params = dict(params)
+        for key in required:
+            if not params.get(key):
+                raise RpcError(RPC_INVALID_PARAMS, f"Missing parameter: {key}")
+        return {key: params.pop(key, None) for key in ('template', 'output', 'backup', 'include_log')}, params
+
+    @staticmethod
+    def _check_options(options):
+        """Checks the types of build options and converts integer strings. Raises RpcError for invalid values."""
+        checked = {}
+        for key, value in options.items():
+            if key not in BUILD_OPTION_DEFAULTS:
+                checked[key] = value # Reported as unknown by plan_build()
+                continue
+            if value is None:
+                continue # Same as leaving it out: the default
+            if key in WORKER_INT_OPTIONS:
+                if isinstance(value, str) and re.fullmatch(r'\s*-?\d+\s*', value):
+                    value = int(value)
+                if isinstance(value, bool) or not isinstance(value, int):
+                    raise RpcError(RPC_INVALID_PARAMS, f"Parameter {key} must be an integer, not {value!r}")
+            elif key in WORKER_BOOL_OPTIONS:
+                if not isinstance(value, bool):
+                    raise RpcError(RPC_INVALID_PARAMS, f"Parameter {key} must be true or false, not {value!r}")
+            elif not isinstance(value, str):
+                raise RpcError(RPC_INVALID_PARAMS, f"Parameter {key} must be a string, not {value!r}")
+            if key in WORKER_OPTION_CHOICES and value not in WORKER_OPTION_CHOICES[key]:
+                raise RpcError(RPC_INVALID_PARAMS, f"Parameter {key} must be one of "
+                                                   f"{', '.join(map(str, WORKER_OPTION_CHOICES[key]))}, not {value!r}")
+            checked[key] = value
+        return checked
+
+    @classmethod
+    def _plan(cls, options):
+        options = cls._check_options(options)
+        try:
+            return plan_build(**options)
+        except ValueError as e:
+            raise RpcError(RPC_INVALID_PARAMS, str(e))
+
+    @staticmethod
+    def _response(result, include_log):
+        result = dict(result)
+        if not include_log:
+            result.pop('log', None)
+        return result
+
+    def rpc_generate(self, params):
+        """Builds a backup to params['output']. Returns the MbzEditor result."""
+        request, options = self._split_params(params, 'template', 'output')
+        editor = self.editor_for(request['template'])
+        plan = self._plan(options)
+        return self._response(editor.build(plan, request['output']), request['include_log'])
+
+    def rpc_preview(self, params):
+        """Applies the options to the template without writing anything. Returns the MbzEditor result."""
+        request, options = self._split_params(params, 'template')
+        editor = self.editor_for(request['template'])
+        plan = self._plan(options)
+        result = editor.apply(plan, request['output'] and pathlib.Path(request['output']).name or "preview.mbz")
+        editor.discard()
+        return self._response(result, request['include_log'])
+
+    def rpc_validate(self, params):
+        """Checks the options (and the template, if given) without building. Returns the planned assignments.
+
+        With backup (path of a built .mbz), that backup is also checked for
+        consistency (see validate_backup()); the report is in backup and
+        decides valid.
+        """
+        request, options = self._split_params(params)
+        if request['template']:
+            self.editor_for(request['template'])
+        plan = self._plan(options)
+        result = {
+            'valid': True,
+            'target_assignment_count': plan['target_assignment_count'],
+            'assignments': [{'name': info['name'], 'due_ts': info['due_ts'], 'cutoff_ts': info['cutoff_ts'],
+                             'activation_ts': info.get('activation_ts')}
+                            for info in plan['assignments'][:plan['target_assignment_count']]],
+        }
+        if request['backup']:
+            try:
+                result['backup'] = validate_backup(pathlib.Path(request['backup']))
+            except (OSError, tarfile.TarError) as e:
+                raise RpcError(RPC_INVALID_PARAMS, f"Cannot read backup {request['backup']}: {e}")
+            result['valid'] = result['backup']['valid']
+        return result
+
+    def rpc_shutdown(self, params):
+        """Stops the worker after this response."""
+        self.running = False
+        return {'stopped': True}
+
+    def handle(self, line):
+        """Handles one request line. Returns the response dictionary."""
+        request_id = None
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                raise RpcError(RPC_PARSE_ERROR, f"Invalid JSON: {e}")
+            if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+                raise RpcError(RPC_INVALID_REQUEST, "A request must be an object with a method")
+            request_id = request.get('id')
+            handler = getattr(self, f"rpc_{request['method']}", None)
+            if handler is None:
+                raise RpcError(RPC_METHOD_NOT_FOUND, f"Unknown method: {request['method']}")
+            start = time.perf_counter()
+            result = handler(request.get('params') or {})
+            result['seconds'] = round(time.perf_counter() - start, 6)
+            return {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+        except RpcError as e:
+            error = {'code': e.code, 'message': str(e)}
+        except Exception as e:
+            error = {'code': RPC_SERVER_ERROR, 'message': f"{type(e).__name__}: {e}"}
+        return {'jsonrpc': '2.0', 'id': request_id, 'error': error}
+
+def serve_worker(worker, input_stream, output_stream):
+    """Answers line-delimited JSON-RPC requests from input_stream until EOF or shutdown.
+
+    Anything printed while handling a request goes to stderr, so that
+    output_stream only carries responses.
+    """
+    with contextlib.redirect_stdout(sys.stderr):
+        for line in input_stream:
+            if not line.strip():
+                continue
+            response = worker.handle(line)
+            output_stream.write(json.dumps(response) + "\n")
+            output_stream.flush()
+            if not worker.running:
+                break
+
+def build_arg_parser():
+    """Returns the parser of the command line options."""
     parser = argparse.ArgumentParser(description="Modify or add assignments in a Moodle backup (.mbz).")
-    parser.add_argument("input_mbz", help="Path to the input .mbz file (e.g., sample.tar.gz).")
-    parser.add_argument("-o", "--output_mbz", default="testbackup.mbz", help="Path for the output .mbz file.")
+    parser.add_argument("input_mbz", nargs="?", help="Path to the input .mbz file (e.g., sample.tar.gz). Not used with --worker.")
+    parser.add_argument("-o", "--output_mbz", default="testbackup.mbz", help="Path for the output .mbz file, or - to write it to stdout (messages then go to stderr).")
+    parser.add_argument("--output-name", help=f"File name recorded in the backup (default: that of the output file, {DEFAULT_STREAM_OUTPUT_NAME} with -o -)")
     parser.add_argument("-n", "--num_assignments", type=int, default=TARGET_ASSIGNMENT_COUNT, help=f"Total number of assignments in output (default: {TARGET_ASSIGNMENT_COUNT}).")
     
     # Date/time options - Method A
@@ -828,230 +3603,208 @@ def main():
     
     # New options for section title and assignment naming
     parser.add_argument("--section-title", help="Exact title of the section in Moodle where assignments should be imported")
+    parser.add_argument("--section-layout", metavar="SPEC", help="Spread the assignments over several sections: ranges of assignment numbers separated by ';', each optionally with a new section title, e.g. '1-4=Block A;5-8=Block B'. The n-th range goes to the n-th section of the backup, counting from the section of the first assignment")
     parser.add_argument("--assignment-name-prefix", default="Page", help="Prefix for assignment names, followed by incremented number (default: 'Page')")
     
     # New option for target course start date
     parser.add_argument("--target-start-date", help="Target course start date (YYYY-MM-DD). Modifies the backup's start date.")
+
+    # Processing mode
+    parser.add_argument("--stream", action="store_true", help="Rewrite the backup member by member instead of extracting it to a temporary directory (faster for backups with a large files/ pool)")
+    parser.add_argument("--batch", metavar="MANIFEST", help="Build one backup per row of a CSV/JSON manifest from the input template (see documentation); -o is ignored")
+    parser.add_argument("--jobs", type=int, help="Number of worker processes for --batch (default: number of CPUs)")
+    parser.add_argument("--concurrency", type=int, help="Build up to this many backups of --batch at once in this process (asyncio, compression in threads) instead of in worker processes")
+    parser.add_argument("--compression-level", type=int, default=DEFAULT_COMPRESSION_LEVEL, choices=range(10), metavar="0-9", help=f"Compression level of the output archive: gzip level (0 = store only), xz preset or bz2/zstd level (default: {DEFAULT_COMPRESSION_LEVEL})")
+    parser.add_argument("--output-codec", choices=OUTPUT_CODECS, default=DEFAULT_OUTPUT_CODEC, help="Compression of the output archive (default: gz, the only one Moodle restores). xz, bz2, zst (Python 3.14+) and tar (uncompressed) are for archives used by other tools; the input codec is detected automatically")
+    parser.add_argument("--compress-threads", type=int, help="Threads compressing the output archive (default: number of CPUs; 1 per row with --batch)")
+    parser.add_argument("--scale", action="store_true", help="Scale mode for hundreds or thousands of assignments: summarize created files and manifest entries instead of printing a line for each")
+    parser.add_argument("--max-memory-mb", type=float, help="Abort if the backup members held in memory for modification exceed this size (MiB)")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the cache of parsed templates (always extract the input)")
+    parser.add_argument("--cache-dir", help=f"Directory of the parsed template cache (default: {default_cache_dir()})")
+    parser.add_argument("--cache-max-mb", type=float, default=DEFAULT_CACHE_MAX_MB, help=f"Size limit of the template cache in MiB, least recently used templates are evicted (default: {DEFAULT_CACHE_MAX_MB})")
+    parser.add_argument("--worker", action="store_true", help="Run as a long-lived worker that answers line-delimited JSON-RPC requests (generate, preview, validate) on stdin/stdout, keeping templates parsed (see documentation)")
+    parser.add_argument("--deterministic", action="store_true", help="Reproducible output: the same inputs give a byte-identical .mbz (fixed member times and owners, backup ID derived from the inputs). Needs --target-start-date or SOURCE_DATE_EPOCH")
+    parser.add_argument("--incremental", action="store_true", help="Implies --deterministic. Records the template checksum and options next to the output (<output>.build.json) and reuses the output if nothing changed")
+    parser.add_argument("--verbosity", type=int, default=2, choices=(0, 1, 2), help="2: print every step and created file (default), 1: print summaries instead of a line per file (like --scale), 0: print only errors and the result")
+    parser.add_argument("--no-validate", dest="validate", action="store_false", help="Do not check the consistency of the built backup (see --validate)")
+    parser.add_argument("--validate", dest="validate_only", action="store_true", help="Only check input_mbz (e.g. a built backup) for consistency: module IDs in <activities>, section sequences and directories, unique assignment IDs and activity settings. Exit code 1 if it is inconsistent")
+    parser.add_argument("--stats-json", metavar="FILE", help="Write wall time, peak traced memory and bytes read, written and compressed per pipeline stage to a JSON file")
     
+    return parser
+
+def main():
+    parser = build_arg_parser()
     args = parser.parse_args()
+    if args.worker:
+        return run_worker(args)
+    if not args.input_mbz:
+        parser.error("the following arguments are required: input_mbz")
+    if args.incremental:
+        args.deterministic = True
+
+    # -o -: the archive is the only thing written to stdout, all messages go to stderr
+    output_stream = None
+    if args.output_mbz == '-' and not args.batch:
+        if args.incremental:
+            parser.error("--incremental needs an output file, not -o -")
+        output_stream = sys.stdout.buffer
+    with contextlib.redirect_stdout(sys.stderr) if output_stream else contextlib.nullcontext():
+        exit_code, success = run_main_build(args, output_stream)
+    if output_stream is not None:
+        output_stream.flush()
+    if exit_code is None:
+        exit_code = 0 if success else 1 # A failed build (e.g. rejected by validation) wrote no output
+    return exit_code
+
+def run_main_build(args, output_stream=None):
+    """Runs run_build() with the --verbosity and --stats-json handling of the command line. Returns (exit code, success)."""
+    stats = PipelineStats() if args.stats_json else None
+    log = io.StringIO()
+    exit_code, success = None, False
+    try:
+        # Verbosity 0: keep the output and only show it if the build fails
+        with contextlib.redirect_stdout(log) if args.verbosity == 0 else contextlib.nullcontext():
+            exit_code, success = run_build(args, stats, output_stream)
+    finally:
+        if args.verbosity == 0 and not success:
+            sys.stdout.write(log.getvalue())
+        if stats is not None:
+            stats.close()
+            stats.details['success'] = success
+            try:
+                stats.write_json(args.stats_json)
+            except OSError as e:
+                print(f"Error: Could not write statistics to {args.stats_json}: {e}")
+    if args.verbosity == 0 and success:
+        if args.validate_only:
+            print(f"Valid: {pathlib.Path(args.input_mbz).resolve()}")
+        elif args.batch:
+            print("Batch finished.")
+        else:
+            print("Written to stdout." if output_stream else f"Created {pathlib.Path(args.output_mbz).resolve()}")
+    return exit_code, success
+
+def run_worker(args):
+    """Serves worker requests on stdin/stdout (--worker) until EOF or a shutdown request."""
+    cache = None if args.no_cache else TemplateCache(args.cache_dir, int(args.cache_max_mb * 1024 * 1024))
+    max_memory_bytes = int(args.max_memory_mb * 1024 * 1024) if args.max_memory_mb else None
+    worker = BuildWorker(cache, max_memory_bytes)
+    print("Worker ready, reading JSON-RPC requests from stdin.", file=sys.stderr)
+    try:
+        serve_worker(worker, sys.stdin, sys.stdout)
+    finally:
+        worker.close()
+    return 0
 
-    # Validate date/time options
-    if args.first_submission_date and args.submission_dates:
-        print("Error: Cannot use both --first-submission-date and --submission-dates. Choose one method.")
-        return
-        
-    if args.first_submission_date and not args.num_consecutive_weeks:
-        print("Error: When using --first-submission-date, you must also specify --num-consecutive-weeks")
-        return
-        
-    if args.num_consecutive_weeks and not args.first_submission_date:
-        print("Error: When using --num-consecutive-weeks, you must also specify --first-submission-date")
-        return
-        
-    # If no date options provided, use default assignment count
-    target_assignment_count = args.num_assignments
-    if args.first_submission_date and args.num_consecutive_weeks:
-        target_assignment_count = args.num_consecutive_weeks
-    elif args.submission_dates:
-        target_assignment_count = len(args.submission_dates.split(','))
-    
+def run_build(args, stats=None, output_stream=None):
+    """Runs the build selected by the parsed command line arguments.
+
+    Returns (exit code, success). Stages are recorded in stats (a
+    PipelineStats) if given. A single build is written to output_stream
+    instead of args.output_mbz if given (-o -).
+    """
+    stats = stats or PipelineStats(enabled=False)
     input_path = pathlib.Path(args.input_mbz).resolve()
-    output_path = pathlib.Path(args.output_mbz).resolve()
-    output_filename = output_path.name
 
     if not input_path.is_file():
         print(f"Error: Input file not found at {input_path}")
-        return
+        return None, False
 
-    # Parse target start date if provided
-    target_start_timestamp = None
-    if args.target_start_date:
-        try:
-            # Parse as datetime object and convert to Unix timestamp
-            target_start_dt = datetime.strptime(args.target_start_date, "%Y-%m-%d")
-            target_start_timestamp = int(target_start_dt.timestamp())
-            print(f"  Target start date specified: {args.target_start_date} (Timestamp: {target_start_timestamp})")
-        except ValueError:
-            print(f"Error: Invalid format for --target-start-date '{args.target_start_date}'. Use YYYY-MM-DD.")
-            return
+    max_memory_bytes = int(args.max_memory_mb * 1024 * 1024) if args.max_memory_mb else None
+    cache = None if args.no_cache else TemplateCache(args.cache_dir, int(args.cache_max_mb * 1024 * 1024))
+    stats.details.update(input=str(input_path), input_bytes=input_path.stat().st_size)
 
-    # --- Assignment Data Definition ---
-    if args.first_submission_date or args.submission_dates:
-        # Generate dates based on command line arguments
-        assignment_base_data = generate_assignment_dates(args)
+    if args.validate_only:
+        stats.details.update(mode='validate')
+        stats.start_stage('validate')
+        try:
+            report = validate_backup(input_path, stats)
+        except (OSError, tarfile.TarError) as e:
+            print(f"Error: Could not read {input_path}: {e}")
+            return 1, False
+        print_validation(report)
+        return (0 if report['valid'] else 1), report['valid']
+
+    if args.batch:
+        stats.details.update(mode='batch', manifest=args.batch)
+        stats.start_stage('batch')
+        try:
+            results = run_batch(input_path, args.batch, args, args.jobs, max_memory_bytes, cache, args.concurrency)
+        except (OSError, ValueError, tarfile.TarError) as e:
+            print(f"Error: Batch build failed: {e}")
+            return 1, False
+        success = all(result['success'] for result in results)
+        return (0 if success else 1), success
+
+    stats.details.update(output='-' if output_stream else str(pathlib.Path(args.output_mbz).resolve()))
+    stats.start_stage('plan_assignments')
+    try:
+        plan = plan_build(args)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return None, False
+    stats.details.update(num_assignments=plan['target_assignment_count'])
+
+    if args.incremental:
+        stats.start_stage('check_output')
+        success = build_incrementally(args, file_sha256(input_path),
+                                      lambda: build_single(args, input_path, plan, max_memory_bytes, cache, stats))
     else:
-        # Use default date generation if no specific dates provided
-        assignment_base_data = []
-        now = datetime.now()
-        for i in range(target_assignment_count):
-            due_date = now + timedelta(days=7 * (i + 1))
-            cutoff_date = due_date + timedelta(minutes=args.extra_time)
-            activation_date = now if i == 0 else (now + timedelta(days=7 * i, minutes=args.extra_time))
-            
-            assignment_base_data.append({
-                "name": f"{args.assignment_name_prefix} {i + 1}",
-                "due_ts": int(due_date.timestamp()),
-                "cutoff_ts": int(cutoff_date.timestamp()),
-                "activation_ts": int(activation_date.timestamp())
-            })
-
-    # Use a temporary directory
-    with tempfile.TemporaryDirectory(prefix="moodle_mbz_") as temp_dir:
-        print(f"Using temporary directory: {temp_dir}")
-        temp_path = pathlib.Path(temp_dir)
-
+        success = build_single(args, input_path, plan, max_memory_bytes, cache, stats, output_stream)
+    return None, success
+
+def build_single(args, input_path, plan, max_memory_bytes=None, cache=None, stats=None, output_stream=None):
+    """Builds args.output_mbz from input_path by streaming (--stream), from the template cache or by extracting it.
+
+    plan is the result of plan_build(args). The archive is written to
+    output_stream instead if given. Returns True on success.
+    """
+    stats = stats or PipelineStats(enabled=False)
+    assignment_base_data, target_assignment_count = plan['assignments'], plan['target_assignment_count']
+    target_start_timestamp, fixed_time = plan['target_start_timestamp'], plan['fixed_time']
+    output = output_stream or pathlib.Path(args.output_mbz).resolve()
+    output_name = recorded_output_name(args)
+    verbose = per_file_output(args)
+
+    success = False
+    if args.stream:
+        stats.details.update(mode='stream')
         try:
-            # 1. Extract
-            extract_mbz(input_path, temp_path)
-
-            # 1.5 Delete dotfiles
-            delete_dotfiles(temp_path)
-
-            # 2. Extract existing IDs
-            ids = extract_ids(temp_path)
-            original_assignment_count = len(ids['existing_module_ids'])
-            print(f"Original assignment count: {original_assignment_count}")
-
-            if not ids['section_id'] or not ids['context_id']:
-                 print("Error: Could not extract required section_id or context_id from backup files.")
-                 return
-
-            # 3. Find existing assignment files (sorted)
-            existing_assign_files = find_assign_xml_files(temp_path)
-            if len(existing_assign_files) != original_assignment_count:
-                 print(f"Warning: Mismatch between module IDs in moodle_backup.xml ({original_assignment_count}) and found assign.xml files ({len(existing_assign_files)}). Proceeding cautiously.")
-                 original_assignment_count = min(original_assignment_count, len(existing_assign_files))
-
-            # 4. Read template files (use first existing assignment)
-            assign_template_content = ""
-            inforef_template_content = ""
-            if existing_assign_files:
-                 assign_template_content = existing_assign_files[0].read_text()
-                 inforef_template_path = existing_assign_files[0].parent / "inforef.xml"
-                 if inforef_template_path.is_file():
-                      inforef_template_content = inforef_template_path.read_text()
-                 else:
-                      print(f"Warning: Could not read inforef.xml template from {inforef_template_path}. Cannot create new inforef files.")
-                      return
-            elif target_assignment_count > 0:
-                print("Error: No existing assignments found to use as template, but target count > 0.")
-                return
-
-            # 5. Initialize ID counters and lists for the loop
-            current_module_id = ids['max_module_id']
-            current_activity_id = ids['max_activity_id']
-            current_grade_item_id = ids['max_grade_item_id']
-            current_plugin_config_id = ids['max_plugin_config_id'] + 1 # Start from next available
-            current_context_id = ids['max_context_id']
-            current_grading_area_id = ids['max_grading_area_id']
-            current_sortorder = ids['max_sortorder']
-
-            final_assignment_details = [] # List to hold {name, moduleid} for all final assignments
-            final_module_ids = [] # List to hold all final module IDs in order
-            added_module_ids = [] # List of module IDs added in this run
-
-            # --- 6. Process Assignments (Modify or Add) ---
-            print(f"\nProcessing target of {target_assignment_count} assignments...")
-            for i in range(target_assignment_count):
-                if i >= len(assignment_base_data):
-                    print(f"Warning: Not enough assignment data for index {i}, skipping.")
-                    continue
-                    
-                assignment_info = assignment_base_data[i]
-
-                if i < original_assignment_count:
-                    # Modify existing assignment
-                    module_id = ids['existing_module_ids'][i]
-                    file_path = temp_path / "activities" / f"assign_{module_id}" / "assign.xml"
-                    if file_path.is_file():
-                        modify_assignment(
-                            file_path, 
-                            assignment_info["name"], 
-                            assignment_info["due_ts"], 
-                            assignment_info["cutoff_ts"],
-                            assignment_info.get("activation_ts")
-                        )
-                    else:
-                        print(f"  Warning: Expected file {file_path} not found for modification.")
-
-                    final_module_ids.append(module_id)
-                    final_assignment_details.append({"name": assignment_info["name"], "moduleid": module_id})
-
-                else:
-                    # Add new assignment
-                    current_module_id += 1
-                    current_activity_id += 1
-                    current_grade_item_id += 1
-                    current_context_id += 1
-                    current_grading_area_id += 1
-                    current_sortorder += 1
-
-                    # Ensure templates are available
-                    if not assign_template_content or not inforef_template_content:
-                         print("Error: Missing template content to create new assignment. Stopping.")
-                         break # Stop processing further assignments
-
-                    next_plugin_id = create_new_assignment_files(
-                        temp_path,
-                        assign_template_content,
-                        inforef_template_content,
-                        current_module_id,
-                        current_activity_id,
-                        current_plugin_config_id,
-                        current_grade_item_id,
-                        current_context_id,
-                        current_grading_area_id,
-                        current_sortorder,
-                        assignment_info,
-                        ids['section_id']
-                    )
-                    current_plugin_config_id = next_plugin_id # Update for the next iteration
-                    added_module_ids.append(current_module_id)
-                    final_module_ids.append(current_module_id)
-                    final_assignment_details.append({"name": assignment_info["name"], "moduleid": current_module_id})
-
-            # --- 7. Update Manifest Files ---
-            # Update section.xml
-            section_xml_path = temp_path / "sections" / f"section_{ids['section_id']}" / "section.xml"
-            if not update_section_xml(section_xml_path, final_module_ids, args.section_title):
-                print("Error: Failed to update section.xml. Backup may be invalid.")
-                return
-
-            # Update moodle_backup.xml
-            moodle_backup_xml_path = temp_path / "moodle_backup.xml"
-            new_backup_id = uuid.uuid4().hex # Generate new random backup ID
-            if not update_moodle_backup_xml(
-                moodle_backup_xml_path, 
-                output_filename, 
-                ids['original_backup_id'], 
-                new_backup_id, 
-                final_assignment_details, 
-                ids['section_id'], 
-                added_module_ids, 
-                args.section_title,
-                target_start_timestamp # Pass the new timestamp
-            ):
-                print("Error: Failed to update moodle_backup.xml. Backup may be invalid.")
-                return
-
-            # Truncate log file
-            log_file_path = temp_path / "moodle_backup.log"
-            if log_file_path.exists():
-                 truncate_log_file(log_file_path)
-            else:
-                 print("\nLog file moodle_backup.log not found, skipping truncation.")
-            
-            # 8. Re-pack as tar.gz
-            create_mbz(temp_path, output_path)
+            success = stream_rewrite_mbz(input_path, output, assignment_base_data, target_assignment_count,
+                                         args.section_title, target_start_timestamp, max_memory_bytes,
+                                         args.compression_level, args.compress_threads, verbose, stats, fixed_time,
+                                         output_name, args.validate, args.output_codec, plan['section_layout'])
+        except Exception as e:
+            print(f"\nAn error occurred during the process: {e}")
+            import traceback
+            traceback.print_exc() # Kept for error troubleshooting
+        print("\nScript finished.")
+        return success
 
+    if cache is not None:
+        stats.details.update(mode='cache')
+        try:
+            stats.start_stage('load_template')
+            with MbzEditor.open(input_path, cache, max_memory_bytes, stats, echo=True) as editor:
+                stats.count('bytes_read', input_path.stat().st_size) # Read at least once for its checksum
+                success = editor.build(plan, output, output_name)['success']
         except Exception as e:
             print(f"\nAn error occurred during the process: {e}")
             import traceback
             traceback.print_exc() # Kept for error troubleshooting
-        finally:
-             print(f"Temporary directory {temp_dir} cleaned up.")
+        print("\nScript finished.")
+        return success
+
+    # Without the cache: extract to a temporary directory
+    stats.details.update(mode='extract')
+    if not modify_backup(input_path, output, assignment_base_data, target_assignment_count,
+                         args.section_title, target_start_timestamp, max_memory_bytes,
+                         args.compression_level, args.compress_threads, verbose, stats, fixed_time, output_name,
+                         args.validate, args.output_codec, plan['section_layout']):
+        return False
 
     print("\nScript finished.")
+    return True
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(main()) 
\ No newline at end of file
@@ -1,15 +1,22 @@
 import os
-import subprocess
-import tempfile
+import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import itertools
+import json
 import tarfile
-import filecmp
-import shutil
-import pathlib
+import tempfile
+import time
 import sys
 import re
+import subprocess
+from datetime import datetime, timedelta
+
+import modify_moodle_backup as mmb
 
 # --- Configuration ---
-PYTHON_EXECUTABLE = sys.executable # Use the same python that runs this script
 SCRIPT_TO_TEST = "modify_moodle_backup.py"
 INPUT_MBZ = "moodle-4.5-2024100700.mbz"
 EXPECTED_OUTPUT_MBZ = "test-20250425-3-195959-5-ExamBooklet-Page-20250422.mbz"
@@ -45,160 +52,705 @@ TIMESTAMP_PATTERNS = [
 # --- Helper Functions ---
 
 def run_modifier_script():
-    """Runs the modify_moodle_backup.py script with specified arguments."""
-    command = [PYTHON_EXECUTABLE, SCRIPT_TO_TEST] + TEST_ARGS
-    print(f"Running command: {' '.join(command)}")
+    """Builds the output in-process with the MbzEditor API of modify_moodle_backup.py (same arguments as the CLI)."""
+    print(f"Building in-process: {SCRIPT_TO_TEST} {' '.join(TEST_ARGS)}")
     try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-        print("Script executed successfully.")
-        print("Script Output:")
-        print("---")
-        print(result.stdout)
-        print("---")
-        return True
-    except FileNotFoundError:
-        print(f"Error: Script '{SCRIPT_TO_TEST}' not found.")
-        return False
-    except subprocess.CalledProcessError as e:
-        print(f"Error: Script execution failed with return code {e.returncode}.")
-        print("Stderr:")
-        print("---")
-        print(e.stderr)
-        print("---")
-        print("Stdout:")
-        print("---")
-        print(e.stdout)
-        print("---")
-        return False
+        args = mmb.build_arg_parser().parse_args(TEST_ARGS)
+        with mmb.MbzEditor.open(args.input_mbz) as editor:
+            result = editor.build(editor.plan(args), args.output_mbz)
     except Exception as e:
         print(f"An unexpected error occurred while running the script: {e}")
         return False
-
-def extract_mbz(mbz_path, extract_to):
-    """Extracts a .mbz (tar.gz) file to the specified directory."""
-    print(f"Extracting {mbz_path} to {extract_to}...")
-    if not os.path.exists(mbz_path):
-        print(f"Error: Cannot extract, file not found: {mbz_path}")
-        return False
-    try:
-        with tarfile.open(mbz_path, "r:gz") as tar:
-            # Secure extraction if possible (requires Python 3.12+)
-            if hasattr(tarfile, 'data_filter') and callable(tarfile.data_filter):
-                tar.extractall(path=extract_to, filter='data')
-            else:
-                 tar.extractall(path=extract_to)
-        print(f"Extraction complete for {mbz_path}.")
-        return True
-    except tarfile.ReadError as e:
-        print(f"Error reading archive {mbz_path}: {e}. Is it a valid tar.gz file?")
-        return False
-    except Exception as e:
-        print(f"An unexpected error occurred during extraction: {e}")
+    print("Script Output:")
+    print("---")
+    print(result['log'])
+    print("---")
+    if not result['success']:
+        print(f"Error: Build failed: {result['error']}")
         return False
+    print(f"Script executed successfully ({len(result['assignments'])} assignments, backup ID {result['backup_id']}).")
+    return True
+
+# One pattern for all normalizations: the matching group selects the placeholder
+NORMALIZE_PATTERN = re.compile('|'.join(
+    [f'(?:{pattern})' for pattern in TIMESTAMP_PATTERNS] # Group 0 only: timestamp
+    + [f'({re.escape(EXPECTED_OUTPUT_MBZ)}|{re.escape(ACTUAL_OUTPUT_MBZ_TEMP)})', # Group 1: filename
+       r'<name>(.*?\.mbz)</name>', # Group 2: filename in <name>
+       r'<value>(.*?\.mbz)</value>'] # Group 3: filename in <value>
+))
+NORMALIZED_REPLACEMENTS = (
+    'NORMALIZED_TIMESTAMP',
+    'NORMALIZED_FILENAME',
+    '<name>NORMALIZED_FILENAME</name>',
+    '<value>NORMALIZED_FILENAME</value>',
+)
+IGNORED_MEMBERS = ('.DS_Store',) # macOS metadata files
+SKIPPED_MEMBERS = ('moodle_backup.xml',) # Always has filename differences
+
+def read_archive_members(mbz_path, verbose=True):
+    """Reads all members of a .mbz (tar.gz) stream without extracting it.
+
+    Returns a dictionary of normalized member name -> content (None for
+    directories).
+    """
+    if verbose:
+        print(f"Reading {mbz_path}...")
+    members = {}
+    with tarfile.open(mbz_path, "r|*") as tar:
+        for member in tar:
+            name = mmb.normalize_member_name(member.name)
+            if not name or name.rpartition('/')[2] in IGNORED_MEMBERS:
+                continue
+            members[name] = tar.extractfile(member).read() if member.isfile() else None
+    return members
 
 def normalize_file_content(content):
     """Normalizes file content by replacing timestamp patterns and filenames with placeholders."""
-    # First normalize all timestamps
-    for pattern in TIMESTAMP_PATTERNS:
-        content = re.sub(pattern, 'NORMALIZED_TIMESTAMP', content)
-    
-    # Then normalize filenames - both direct replacements and XML tag contents
-    content = content.replace(EXPECTED_OUTPUT_MBZ, 'NORMALIZED_FILENAME')
-    content = content.replace(ACTUAL_OUTPUT_MBZ_TEMP, 'NORMALIZED_FILENAME')
-    
-    # Handle filename tags using regex with the .mbz extension as anchor
-    # Use HTML-like tag pattern that explicitly specifies tag names
-    # This should catch <name> tags with mbz filenames
-    content = re.sub(r'<name>(.*?\.mbz)</name>', r'<name>NORMALIZED_FILENAME</name>', content)
-    
-    # And also catch <value> tags with mbz filenames
-    content = re.sub(r'<value>(.*?\.mbz)</value>', r'<value>NORMALIZED_FILENAME</value>', content)
-    
-    return content
-
-def files_equal_ignoring_timestamps(file1, file2):
-    """Compares two files, ignoring timestamp differences."""
+    def replace(match):
+        group = next((i for i, value in enumerate(match.groups(), 1) if value is not None), 0)
+        return NORMALIZED_REPLACEMENTS[group]
+    return NORMALIZE_PATTERN.sub(replace, content)
+
+def normalized_digest(data):
+    """Returns the SHA-256 of normalized text content, or of the raw bytes for binary files."""
     try:
-        # Check if files are binary first
-        if not all(os.path.isfile(f) for f in [file1, file2]):
-            return False
+        data = normalize_file_content(data.decode('utf-8')).encode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    return hashlib.sha256(data).hexdigest()
 
-        # Try to read as text first
+def compare_member(name, expected, actual):
+    """Compares the content of one member, ignoring timestamps. Returns None if equal, else a report of the first 3 differing lines."""
+    if normalized_digest(expected) == normalized_digest(actual):
+        return None
+    report = [f"Differing file content: {name}"]
+    if name.endswith('.xml'):
         try:
-            with open(file1, 'r', encoding='utf-8') as f1, open(file2, 'r', encoding='utf-8') as f2:
-                content1 = f1.read()
-                content2 = f2.read()
-                
-                # Normalize content by removing timestamps
-                norm1 = normalize_file_content(content1)
-                norm2 = normalize_file_content(content2)
-                
-                return norm1 == norm2
+            expected_lines = normalize_file_content(expected.decode('utf-8')).splitlines()
+            actual_lines = normalize_file_content(actual.decode('utf-8')).splitlines()
         except UnicodeDecodeError:
-            # Fall back to binary comparison for non-text files
-            with open(file1, 'rb') as f1, open(file2, 'rb') as f2:
-                return f1.read() == f2.read()
-    except Exception as e:
-        print(f"Error comparing files {file1} and {file2}: {e}")
-        return False
+            return report
+        report.append(f"  Detailed diff for {name} (first 3 differences):")
+        differing = [(i, line1, line2) for i, (line1, line2) in enumerate(zip(expected_lines, actual_lines)) if line1 != line2]
+        for i, line1, line2 in differing[:3]:
+            report.append(f"    Line {i+1}:")
+            report.append(f"      Expected: {line1[:80]}")
+            report.append(f"      Actual:   {line2[:80]}")
+    return report
+
+def _compare_member_job(job):
+    return compare_member(*job)
+
+def compare_archives(expected_mbz, actual_mbz, jobs=None):
+    """Compares two .mbz archives member by member, ignoring timestamps. Returns a list of differences.
+
+    Members with identical bytes are equal without normalizing them; the
+    others are normalized and compared by hash in jobs worker processes
+    (default: number of CPUs).
+    """
+    expected, actual = read_archive_members(expected_mbz), read_archive_members(actual_mbz)
+    print(f"Comparing {len(expected)} expected and {len(actual)} actual members")
+    differences = [f"Only in expected: {name}" for name in sorted(set(expected) - set(actual))]
+    differences += [f"Only in actual: {name}" for name in sorted(set(actual) - set(expected))]
 
-def compare_directories(dir1, dir2):
-    """Compares two directories recursively and reports differences, ignoring timestamps."""
-    print(f"Comparing directories: {dir1} and {dir2}")
-    dircmp = filecmp.dircmp(dir1, dir2, ignore=['.DS_Store']) # Ignore macOS metadata files
-    
-    differences = []
-
-    if dircmp.left_only:
-        differences.extend([f"Only in expected ({dir1}): {f}" for f in dircmp.left_only])
-    if dircmp.right_only:
-        differences.extend([f"Only in actual ({dir2}): {f}" for f in dircmp.right_only])
-    
-    # For differing files, use our custom comparison that ignores timestamps
-    for filename in dircmp.diff_files:
-        # Skip moodle_backup.xml as it will always have filename differences
-        if filename == 'moodle_backup.xml':
-            print(f"  Skipping comparison of {filename} (expected to differ)")
+    pending = []
+    for name in sorted(set(expected) & set(actual)):
+        if (expected[name] is None) != (actual[name] is None):
+            differences.append(f"Directory and file: {name}")
+        elif name.rpartition('/')[2] in SKIPPED_MEMBERS:
+            print(f"  Skipping comparison of {name} (expected to differ)")
+        elif expected[name] is not None and expected[name] != actual[name]:
+            pending.append((name, expected[name], actual[name]))
+
+    jobs = jobs or os.cpu_count() or 1
+    if jobs > 1 and len(pending) > 1:
+        with concurrent.futures.ProcessPoolExecutor(min(jobs, len(pending))) as executor:
+            reports = list(executor.map(_compare_member_job, pending))
+    else:
+        reports = [compare_member(*job) for job in pending]
+    for (name, _, _), report in zip(pending, reports):
+        if report is None:
+            print(f"  Files differ but timestamps match: {name}")
             continue
-            
-        file1 = os.path.join(dir1, filename)
-        file2 = os.path.join(dir2, filename)
-        
-        # If files are equal when ignoring timestamps, don't report a difference
-        if files_equal_ignoring_timestamps(file1, file2):
-            print(f"  Files differ but timestamps match: {filename}")
+        differences.append(report[0])
+        for line in report[1:]:
+            print(line)
+    return differences
+
+# --- Test Matrix ---
+
+# Built in-process for every combination of these values, in worker processes.
+# The template has 2 assignments and the section "Booklet".
+TEMPLATE_ASSIGNMENT_COUNT = 2
+TEMPLATE_SECTION_TITLE = "Booklet"
+MATRIX_DATE_MODES = ('weekly', 'dates')
+MATRIX_COUNTS = (1, TEMPLATE_ASSIGNMENT_COUNT, 5) # Below, at and above the template's count
+MATRIX_EXTRA_TIMES = (0, 5, 60)
+MATRIX_SECTION_TITLES = (None, "Exam Booklet (Pages)")
+MATRIX_START_DATES = (None, "2025-04-22")
+MATRIX_FIRST_DATE = "2025-04-25"
+MATRIX_SUBMISSION_TIME = "19:59:59"
+
+def matrix_cases():
+    """Returns (case name, build options) for every combination of the matrix values."""
+    cases = []
+    for mode, count, extra_time, section_title, start_date in itertools.product(
+            MATRIX_DATE_MODES, MATRIX_COUNTS, MATRIX_EXTRA_TIMES, MATRIX_SECTION_TITLES, MATRIX_START_DATES):
+        options = {
+            'submission_time': MATRIX_SUBMISSION_TIME,
+            'extra_time': extra_time,
+            'section_title': section_title,
+            'target_start_date': start_date,
+            'assignment_name_prefix': f"{mode.title()} Page",
+        }
+        if mode == 'weekly':
+            options.update(first_submission_date=MATRIX_FIRST_DATE, num_consecutive_weeks=count)
         else:
-            differences.append(f"Differing file content: {filename}")
-            # Optionally display detailed diff here
-            if filename.endswith('.xml'):
-                try:
-                    with open(file1, 'r', encoding='utf-8') as f1, open(file2, 'r', encoding='utf-8') as f2:
-                        content1 = normalize_file_content(f1.read())
-                        content2 = normalize_file_content(f2.read())
-                        if content1 != content2:
-                            print(f"  Detailed diff for {filename} (first 3 differences):")
-                            content1_lines = content1.splitlines()
-                            content2_lines = content2.splitlines()
-                            diff_count = 0
-                            for i, (line1, line2) in enumerate(zip(content1_lines, content2_lines)):
-                                if line1 != line2 and diff_count < 3:
-                                    print(f"    Line {i+1}:")
-                                    print(f"      Expected: {line1[:80]}")
-                                    print(f"      Actual:   {line2[:80]}")
-                                    diff_count += 1
-                except Exception as e:
-                    print(f"  Error showing diff for {filename}: {e}")
-            
-    for subdir in dircmp.common_dirs:
-        sub_diffs = compare_directories(os.path.join(dir1, subdir), os.path.join(dir2, subdir))
-        if sub_diffs: # Only add if there are differences in the subdirectory
-            differences.extend([f"In subdir '{subdir}': {d}" for d in sub_diffs])
+            # Irregular gaps and blanks around the dates
+            first = datetime.strptime(MATRIX_FIRST_DATE, "%Y-%m-%d")
+            dates = [(first + timedelta(days=3 * i * i)).strftime("%Y-%m-%d") for i in range(count)]
+            options.update(submission_dates=" , ".join(dates))
+        name = (f"{mode}-n{count}-x{extra_time}-{'title' if section_title else 'notitle'}"
+                f"-{'start' if start_date else 'nostart'}")
+        cases.append((name, options))
+    return cases
 
-    return differences
+def expected_schedule(options):
+    """Returns the expected (name, due timestamp, cutoff timestamp) of each assignment, computed from the options alone."""
+    if options.get('first_submission_date'):
+        first = datetime.strptime(f"{options['first_submission_date']} {options['submission_time']}", "%Y-%m-%d %H:%M:%S")
+        due_dates = [first + timedelta(weeks=i) for i in range(options['num_consecutive_weeks'])]
+    else:
+        due_dates = [datetime.strptime(f"{date.strip()} {options['submission_time']}", "%Y-%m-%d %H:%M:%S")
+                     for date in options['submission_dates'].split(',')]
+    return [(f"{options['assignment_name_prefix']} {i + 1}", int(due.timestamp()),
+             int((due + timedelta(minutes=options['extra_time'])).timestamp()))
+            for i, due in enumerate(due_dates)]
+
+def xml_value(text, tag):
+    """Returns the content of the first <tag> element in text, or None."""
+    match = re.search(f'<{tag}>(.*?)</{tag}>', text, re.DOTALL)
+    return match.group(1) if match else None
+
+def check_matrix_output(members, options, output_name, template):
+    """Checks a built archive against the options it was built with. Returns a list of problems."""
+    problems = []
+    backup_xml = members['moodle_backup.xml'].decode('utf-8')
+    section_xml = members['sections/section_1379156/section.xml'].decode('utf-8')
+    schedule = expected_schedule(options)
+
+    sequence = xml_value(section_xml, 'sequence').split(',')
+    activity_ids = re.findall(r'<activity>\s*<moduleid>(\d+)</moduleid>', backup_xml)
+    if len(sequence) != len(schedule):
+        problems.append(f"section sequence has {len(sequence)} modules, expected {len(schedule)}")
+    if activity_ids != sequence:
+        problems.append(f"<activities> lists {activity_ids}, section sequence is {sequence}")
+
+    previous_cutoff = None
+    for module_id, (name, due_ts, cutoff_ts) in zip(sequence, schedule):
+        assign_xml = members.get(f"activities/assign_{module_id}/assign.xml")
+        if assign_xml is None:
+            problems.append(f"activities/assign_{module_id}/assign.xml is missing")
+            continue
+        assign_xml = assign_xml.decode('utf-8')
+        actual = (xml_value(assign_xml, 'name'), xml_value(assign_xml, 'duedate'), xml_value(assign_xml, 'cutoffdate'))
+        if actual != (name, str(due_ts), str(cutoff_ts)):
+            problems.append(f"assign_{module_id}: (name, due, cutoff) is {actual}, expected {(name, str(due_ts), str(cutoff_ts))}")
+        if previous_cutoff is not None and xml_value(assign_xml, 'allowsubmissionsfromdate') != str(previous_cutoff):
+            problems.append(f"assign_{module_id}: opens at {xml_value(assign_xml, 'allowsubmissionsfromdate')}, expected the previous cutoff {previous_cutoff}")
+        previous_cutoff = cutoff_ts
+        for setting in ('included', 'userinfo'):
+            if f"<name>assign_{module_id}_{setting}</name>" not in backup_xml:
+                problems.append(f"moodle_backup.xml has no assign_{module_id}_{setting} setting")
+
+    title = options['section_title']
+    if xml_value(section_xml, 'name') != (title or TEMPLATE_SECTION_TITLE):
+        problems.append(f"section.xml <name> is {xml_value(section_xml, 'name')!r}, expected {title or TEMPLATE_SECTION_TITLE!r}")
+    backup_title = re.search(r'<section>\s*<sectionid>1379156</sectionid>\s*<title>(.*?)</title>', backup_xml)
+    if title and (backup_title is None or backup_title.group(1) != title):
+        problems.append(f"<sections> title is {backup_title and backup_title.group(1)!r}, expected {title!r}")
+    if not title and backup_title.group(1) != TEMPLATE_SECTION_TITLE:
+        problems.append(f"<sections> title changed to {backup_title.group(1)!r} without --section-title")
+
+    start_date = xml_value(backup_xml, 'original_course_startdate')
+    expected_start = (str(int(datetime.strptime(options['target_start_date'], "%Y-%m-%d").timestamp()))
+                      if options['target_start_date'] else template['original_course_startdate'])
+    if start_date != expected_start:
+        problems.append(f"<original_course_startdate> is {start_date}, expected {expected_start}")
+    if xml_value(backup_xml, 'name') != output_name:
+        problems.append(f"<information><name> is {xml_value(backup_xml, 'name')!r}, expected {output_name!r}")
+    return problems
+
+_matrix_editor = None # MbzEditor of INPUT_MBZ in the current matrix worker process
+_matrix_template = None # Values of the unmodified template that the checks compare with
+
+def _init_matrix_worker(input_mbz):
+    global _matrix_editor, _matrix_template
+    _matrix_editor = mmb.MbzEditor.open(input_mbz)
+    backup_xml = read_archive_members(input_mbz, verbose=False)['moodle_backup.xml'].decode('utf-8')
+    _matrix_template = {'original_course_startdate': xml_value(backup_xml, 'original_course_startdate')}
+
+def run_matrix_case(case):
+    """Builds one matrix case in its own temporary workspace. Returns (case name, problems, seconds)."""
+    name, options = case
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix=f"mbz_matrix_{name}_") as workspace:
+        output = os.path.join(workspace, f"{name}.mbz")
+        try:
+            result = _matrix_editor.build(_matrix_editor.plan(**options), output)
+        except Exception as e:
+            return name, [f"build raised {type(e).__name__}: {e}"], time.perf_counter() - started
+        if not result['success']:
+            return name, [f"build failed: {result['error']}"], time.perf_counter() - started
+        members = read_archive_members(output, verbose=False)
+    return name, check_matrix_output(members, options, f"{name}.mbz", _matrix_template), time.perf_counter() - started
+
+def run_matrix(jobs=None):
+    """Builds and checks every matrix case in jobs worker processes (default: number of CPUs). Returns 0 if all pass."""
+    cases = matrix_cases()
+    jobs = jobs or os.cpu_count() or 1
+    print(f"\n--- Test Matrix: {len(cases)} cases in {jobs} worker processes ---")
+    started = time.perf_counter()
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_matrix_worker, initargs=(INPUT_MBZ,)) as executor:
+        for name, problems, seconds in executor.map(run_matrix_case, cases):
+            if problems:
+                failed += 1
+                print(f"  ❌ {name} ({seconds:.2f} s):")
+                for problem in problems:
+                    print(f"      {problem}")
+            else:
+                print(f"  ✅ {name} ({seconds:.2f} s)")
+    print(f"Matrix: {len(cases) - failed} of {len(cases)} cases passed in {time.perf_counter() - started:.1f} s.")
+    return 0 if not failed else 1
+
+# --- Section Layout ---
+
+# --section-layout needs a template with several sections: the bundled
+# template's section plus these, added without assignments.
+TEMPLATE_SECTION_ID = 1379156
+ADDED_SECTIONS = ((1379157, 2, "Second Block"), (1379158, 3, "Third Block")) # (ID, number, title)
+# (layout, number of assignments, expected assignment numbers and title of each section, or None if the build must fail)
+LAYOUT_CASES = (
+    ("1-2=Part A;3-5=Part B", 5, {1379156: ([1, 2], "Part A"), 1379157: ([3, 4, 5], "Part B"), 1379158: ([], "Third Block")}),
+    ("1=Intro;2-3;4-6=Last", 6, {1379156: ([1], "Intro"), 1379157: ([2, 3], "Second Block"), 1379158: ([4, 5, 6], "Last")}),
+    ("1-5", 5, {1379156: ([1, 2, 3, 4, 5], TEMPLATE_SECTION_TITLE), 1379157: ([], "Second Block"), 1379158: ([], "Third Block")}),
+    ("1;2;3;4", 4, None), # More ranges than sections
+)
+# Built with --stream from a template with a forum in its first section, whose members are copied unread
+STREAM_LAYOUT_CASE = ("1-2=Part A;3-5=Part B", 5, {1379156: ([1, 2], "Part A"), 1379157: ([3, 4, 5], "Part B")})
+FORUM_MODULE_ID = 99
+STALE_MODULE_ID = 1999999 # Listed in a <sequence> without being in the backup, as Moodle does for excluded activities
+FORUM_FILE = "files/3f/3f786850e387550fdab836ed7e6dc881de23001b" # A file of the files/ pool
+
+def make_multi_section_template(input_mbz, output_mbz):
+    """Writes a copy of input_mbz with the empty ADDED_SECTIONS after its own section."""
+    with mmb.BackupTree.from_archive(input_mbz) as tree:
+        section_xml = tree.read_text(f"sections/section_{TEMPLATE_SECTION_ID}/section.xml")
+        inforef_xml = tree.read_text(f"sections/section_{TEMPLATE_SECTION_ID}/inforef.xml")
+        backup_xml = tree.read_text("moodle_backup.xml")
+        entry = re.search(r'( *)<section>\s*<sectionid>%d</sectionid>.*?</section>\n' % TEMPLATE_SECTION_ID, backup_xml, re.DOTALL).group(0)
+        settings = re.search(r'( *)<setting>\s*<level>section</level>.*?_userinfo</name>.*?</setting>\n', backup_xml, re.DOTALL).group(0)
+        new_entries, new_settings = "", ""
+        for section_id, number, title in ADDED_SECTIONS:
+            directory = f"sections/section_{section_id}"
+            tree.write_text(f"{directory}/section.xml", re.sub(r'<sequence>.*?</sequence>', '<sequence></sequence>', section_xml)
+                            .replace(f'id="{TEMPLATE_SECTION_ID}"', f'id="{section_id}"')
+                            .replace('<number>1</number>', f'<number>{number}</number>')
+                            .replace(f'<name>{TEMPLATE_SECTION_TITLE}</name>', f'<name>{title}</name>'))
+            tree.write_text(f"{directory}/inforef.xml", inforef_xml)
+            new_entries += entry.replace(str(TEMPLATE_SECTION_ID), str(section_id)).replace(
+                f'<title>{TEMPLATE_SECTION_TITLE}</title>', f'<title>{title}</title>')
+            new_settings += settings.replace(str(TEMPLATE_SECTION_ID), str(section_id))
+        backup_xml = backup_xml.replace(entry, entry + new_entries, 1).replace(settings, settings + new_settings, 1)
+        tree.write_text("moodle_backup.xml", backup_xml)
+        mmb.create_mbz(tree, output_mbz)
+
+def make_forum_template(input_mbz, output_mbz, section_id=TEMPLATE_SECTION_ID):
+    """Writes a copy of input_mbz with a forum at the end of section_id and a file in the files/ pool."""
+    with mmb.BackupTree.from_archive(input_mbz) as tree:
+        section_path = f"sections/section_{section_id}/section.xml"
+        section_xml = tree.read_text(section_path)
+        section_number = xml_value(section_xml, 'number')
+        sequence = [module_id for module_id in xml_value(section_xml, 'sequence').split(',') if module_id]
+        tree.write_text(section_path, section_xml.replace(
+            f"<sequence>{xml_value(section_xml, 'sequence')}</sequence>",
+            f"<sequence>{','.join(sequence + [str(FORUM_MODULE_ID)])}</sequence>"))
+        directory = f"activities/forum_{FORUM_MODULE_ID}"
+        tree.write_text(f"{directory}/module.xml",
+                        f'<?xml version="1.0" encoding="UTF-8"?>\n<module id="{FORUM_MODULE_ID}" version="2024100700">\n'
+                        f'  <modulename>forum</modulename>\n  <sectionid>{section_id}</sectionid>\n'
+                        f'  <sectionnumber>{section_number}</sectionnumber>\n</module>')
+        tree.write_text(f"{directory}/forum.xml",
+                        f'<?xml version="1.0" encoding="UTF-8"?>\n<activity id="1" moduleid="{FORUM_MODULE_ID}" '
+                        f'modulename="forum" contextid="99">\n  <forum id="1">\n    <name>Announcements</name>\n  </forum>\n</activity>')
+        tree.write_bytes(FORUM_FILE, b"forum attachment\n")
+
+        backup_xml = tree.read_text("moodle_backup.xml")
+        entry = re.search(r' *<activity>\s*<moduleid>.*?</activity>\n', backup_xml, re.DOTALL).group(0)
+        assign = re.search(r'activities/(assign_\d+)', entry).group(1)
+        forum_entry = re.sub(r'<moduleid>\d+</moduleid>', f'<moduleid>{FORUM_MODULE_ID}</moduleid>', entry)
+        forum_entry = re.sub(r'<sectionid>\d+</sectionid>', f'<sectionid>{section_id}</sectionid>', forum_entry)
+        forum_entry = re.sub(r'<title>.*?</title>', '<title>Announcements</title>', forum_entry)
+        forum_entry = forum_entry.replace('<modulename>assign</modulename>', '<modulename>forum</modulename>').replace(
+            f"activities/{assign}", directory)
+        # The _included and _userinfo settings of the first assignment, renamed
+        setting_blocks = re.findall(r' *<setting>\s*<level>activity</level>\s*<activity>%s</activity>.*?</setting>\n'
+                                    % assign, backup_xml, re.DOTALL)
+        forum_settings = "".join(block.replace(assign, f"forum_{FORUM_MODULE_ID}") for block in setting_blocks)
+        backup_xml = re.sub(r'( *)</activities>', lambda match: forum_entry + match.group(0), backup_xml, count=1)
+        backup_xml = backup_xml.replace(setting_blocks[-1], setting_blocks[-1] + forum_settings, 1)
+        tree.write_text("moodle_backup.xml", backup_xml)
+        mmb.create_mbz(tree, output_mbz)
+
+def check_layout_output(members, expected):
+    """Checks the sections of a --section-layout build. Returns a list of problems."""
+    problems = []
+    backup_xml = members['moodle_backup.xml'].decode('utf-8')
+    activities = re.findall(r'<activity>\s*<moduleid>(\d+)</moduleid>\s*<sectionid>(\d+)</sectionid>\s*'
+                            r'<modulename>assign</modulename>', backup_xml)
+    module_ids = [module_id for module_id, _ in activities]
+    for section_id, (numbers, title) in expected.items():
+        section_xml = members[f"sections/section_{section_id}/section.xml"].decode('utf-8')
+        expected_modules = [module_ids[number - 1] for number in numbers]
+        sequence = [module_id for module_id in xml_value(section_xml, 'sequence').split(',') if module_id]
+        if sequence != expected_modules:
+            problems.append(f"section {section_id}: sequence is {sequence}, expected {expected_modules}")
+        if xml_value(section_xml, 'name') != title:
+            problems.append(f"section {section_id}: section.xml <name> is {xml_value(section_xml, 'name')!r}, expected {title!r}")
+        backup_title = re.search(r'<sectionid>%d</sectionid>\s*<title>(.*?)</title>' % section_id, backup_xml)
+        if backup_title is None or backup_title.group(1) != title:
+            problems.append(f"section {section_id}: <sections> title is {backup_title and backup_title.group(1)!r}, expected {title!r}")
+        number = xml_value(section_xml, 'number')
+        for module_id in expected_modules:
+            if (module_id, str(section_id)) not in activities:
+                problems.append(f"module {module_id}: <activity><sectionid> is not {section_id}")
+            module_xml = members[f"activities/assign_{module_id}/module.xml"].decode('utf-8')
+            if (xml_value(module_xml, 'sectionid'), xml_value(module_xml, 'sectionnumber')) != (str(section_id), number):
+                problems.append(f"module {module_id}: module.xml is in section {xml_value(module_xml, 'sectionid')} "
+                                f"(number {xml_value(module_xml, 'sectionnumber')}), expected {section_id} ({number})")
+    return problems
+
+def run_section_layout_test():
+    """Builds LAYOUT_CASES from a multi-section copy of the template and checks their sections. Returns 0 if all pass."""
+    print(f"\n--- Section Layout: {len(LAYOUT_CASES)} cases ---")
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix="mbz_layout_") as workspace:
+        template = os.path.join(workspace, "sections.mbz")
+        with contextlib.redirect_stdout(io.StringIO()):
+            make_multi_section_template(INPUT_MBZ, template)
+        with mmb.MbzEditor.open(template) as editor:
+            for layout, count, expected in LAYOUT_CASES:
+                output = os.path.join(workspace, "layout.mbz")
+                plan = editor.plan(num_assignments=count, section_layout=layout)
+                result = editor.build(plan, output)
+                if expected is None:
+                    problems = [] if not result['success'] else ["build succeeded, expected it to fail"]
+                elif not result['success']:
+                    problems = [f"build failed: {result['error']}"]
+                else:
+                    problems = check_layout_output(read_archive_members(output, verbose=False), expected)
+                failed += bool(problems)
+                print(f"  {'❌' if problems else '✅'} {layout} (n={count})")
+                for problem in problems:
+                    print(f"      {problem}")
+        failed += run_stream_layout_case(workspace)
+        failed += run_stale_sequence_case(workspace)
+    try:
+        mmb.plan_build(num_assignments=5, section_layout="2-5")
+        print("  ❌ A layout not starting at 1 was accepted")
+        failed += 1
+    except ValueError:
+        print("  ✅ A layout not starting at 1 is rejected")
+    print(f"Section layout: {'all cases passed' if not failed else f'{failed} case(s) failed'}.")
+    return 0 if not failed else 1
+
+def run_stream_layout_case(workspace):
+    """Builds STREAM_LAYOUT_CASE with stream_rewrite_mbz() (--stream). Returns 1 if it fails, else 0."""
+    layout, count, expected = STREAM_LAYOUT_CASE
+    template = os.path.join(workspace, "sections-forum.mbz")
+    output = os.path.join(workspace, "stream-layout.mbz")
+    plan = mmb.plan_build(num_assignments=count, section_layout=layout)
+    with contextlib.redirect_stdout(io.StringIO()) as log:
+        make_forum_template(os.path.join(workspace, "sections.mbz"), template)
+        success = mmb.stream_rewrite_mbz(template, output, plan['assignments'], plan['target_assignment_count'],
+                                         section_layout=plan['section_layout'])
+    if not success:
+        problems = ["build failed"] + log.getvalue().splitlines()[-5:]
+    else:
+        members = read_archive_members(output, verbose=False)
+        problems = check_layout_output(members, expected)
+        if FORUM_FILE not in members or f"activities/forum_{FORUM_MODULE_ID}/module.xml" not in members:
+            problems.append("forum or files/ members were not copied")
+    print(f"  {'❌' if problems else '✅'} {layout} (n={count}, --stream, with a forum)")
+    for problem in problems:
+        print(f"      {problem}")
+    return 1 if problems else 0
+
+def run_stale_sequence_case(workspace):
+    """Builds the first LAYOUT_CASES layout with a stale module in the untouched section. Returns 1 if it fails, else 0."""
+    layout, count, expected = LAYOUT_CASES[0]
+    template = os.path.join(workspace, "sections-stale.mbz")
+    section_id = ADDED_SECTIONS[-1][0]
+    with mmb.BackupTree.from_archive(os.path.join(workspace, "sections.mbz")) as tree:
+        section_path = f"sections/section_{section_id}/section.xml"
+        tree.write_text(section_path, tree.read_text(section_path).replace(
+            "<sequence></sequence>", f"<sequence>{STALE_MODULE_ID}</sequence>"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            mmb.create_mbz(tree, template)
+    output = os.path.join(workspace, "stale.mbz")
+    with mmb.MbzEditor.open(template) as editor:
+        result = editor.build(editor.plan(num_assignments=count, section_layout=layout), output)
+    if not result['success']:
+        problems = [f"build failed: {result['error']}"]
+    else:
+        members = read_archive_members(output, verbose=False)
+        problems = check_layout_output(members, {key: value for key, value in expected.items() if key != section_id})
+        sequence = xml_value(members[f"sections/section_{section_id}/section.xml"].decode('utf-8'), 'sequence')
+        if sequence != str(STALE_MODULE_ID):
+            problems.append(f"section {section_id}: sequence changed to {sequence!r}")
+        if not any(str(STALE_MODULE_ID) in warning for warning in result['validation']['warnings']):
+            problems.append(f"no warning about module {STALE_MODULE_ID}")
+    print(f"  {'❌' if problems else '✅'} {layout} (n={count}, stale module {STALE_MODULE_ID} in section {section_id})")
+    for problem in problems:
+        print(f"      {problem}")
+    return 1 if problems else 0
+
+# --- Stream Mode ---
+
+# --stream must give the same backup as building from the parsed template
+# (the default) and as extracting it (--no-cache), also for templates with
+# members that --stream copies unread. Deterministic builds of all three
+# must be byte-identical archives.
+STREAM_CASES = (
+    {'num_assignments': 1},
+    {'num_assignments': 5, 'section_title': "Exam Booklet (Pages)", 'extra_time': 5},
+)
+STREAM_START_DATE = "2025-04-22"
+
+def build_all_modes(template, workspace, options):
+    """Builds options from template in every mode. Returns {mode: output path}, or raises RuntimeError if a build fails."""
+    outputs = {mode: os.path.join(workspace, mode, "stream-test.mbz") for mode in ('default', 'stream', 'no-cache')}
+    with contextlib.redirect_stdout(io.StringIO()) as log:
+        plan = mmb.plan_build(deterministic=True, target_start_date=STREAM_START_DATE, **options)
+        with mmb.MbzEditor.open(template) as editor:
+            built = {'default': editor.build(plan, outputs['default'])['success']}
+        built['stream'] = mmb.stream_rewrite_mbz(template, outputs['stream'], plan['assignments'],
+                                                 plan['target_assignment_count'], options.get('section_title'),
+                                                 plan['target_start_timestamp'], fixed_time=plan['fixed_time'])
+        built['no-cache'] = mmb.modify_backup(template, outputs['no-cache'], plan['assignments'],
+                                              plan['target_assignment_count'], options.get('section_title'),
+                                              plan['target_start_timestamp'], fixed_time=plan['fixed_time'])
+    failed = [mode for mode, success in built.items() if not success]
+    if failed:
+        raise RuntimeError(f"{', '.join(failed)} build failed: {log.getvalue().splitlines()[-3:]}")
+    return outputs
+
+def run_stream_test():
+    """Compares --stream builds of STREAM_CASES with the other modes on a template with a forum. Returns 0 if all match."""
+    print(f"\n--- Stream Mode: {len(STREAM_CASES)} cases ---")
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix="mbz_stream_") as workspace:
+        template = os.path.join(workspace, "forum.mbz")
+        with contextlib.redirect_stdout(io.StringIO()):
+            make_forum_template(INPUT_MBZ, template)
+        for options in STREAM_CASES:
+            try:
+                outputs = build_all_modes(template, workspace, options)
+                members = {mode: read_archive_members(output, verbose=False) for mode, output in outputs.items()}
+                problems = [f"{FORUM_FILE} was not copied"] if FORUM_FILE not in members['stream'] else []
+                for mode in ('default', 'no-cache'):
+                    with tarfile.open(outputs[mode]) as expected, tarfile.open(outputs['stream']) as actual:
+                        if expected.getnames() != actual.getnames():
+                            problems.append(f"the member order differs from the {mode} build")
+                    with open(outputs[mode], 'rb') as expected, open(outputs['stream'], 'rb') as actual:
+                        if expected.read() != actual.read():
+                            problems.append(f"the archive is not byte-identical to the {mode} build")
+                    for name in sorted(set(members[mode]) ^ set(members['stream'])):
+                        problems.append(f"{name} is only in the {'stream' if name in members['stream'] else mode} build")
+                    problems += [f"{name} differs from the {mode} build" for name in sorted(set(members[mode]) & set(members['stream']))
+                                 if members[mode][name] != members['stream'][name]]
+            except Exception as e:
+                problems = [f"{type(e).__name__}: {e}"]
+            failed += bool(problems)
+            print(f"  {'❌' if problems else '✅'} {options}")
+            for problem in problems:
+                print(f"      {problem}")
+    print(f"Stream mode: {'all cases passed' if not failed else f'{failed} case(s) failed'}.")
+    return 0 if not failed else 1
+
+# --- Worker Params ---
+
+# (validate params, expected JSON-RPC error code or None if the request must succeed)
+WORKER_PARAM_CASES = (
+    ({'num_assignments': "3"}, None),
+    ({'num_assignments': "abc"}, mmb.RPC_INVALID_PARAMS),
+    ({'section_title': ["Exam Booklet"]}, mmb.RPC_INVALID_PARAMS),
+    ({'deterministic': "yes"}, mmb.RPC_INVALID_PARAMS),
+    ({'compression_level': 12}, mmb.RPC_INVALID_PARAMS),
+    ({'unknown_option': 1}, mmb.RPC_INVALID_PARAMS),
+)
+
+def run_worker_params_test():
+    """Sends WORKER_PARAM_CASES to a BuildWorker and checks the error codes. Returns 0 if all match."""
+    print(f"\n--- Worker Params: {len(WORKER_PARAM_CASES)} cases ---")
+    worker = mmb.BuildWorker()
+    failed = 0
+    for params, expected_code in WORKER_PARAM_CASES:
+        request = json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'validate', 'params': params})
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = worker.handle(request)
+        code = response['error']['code'] if 'error' in response else None
+        failed += code != expected_code
+        print(f"  {'❌' if code != expected_code else '✅'} {params}: {response.get('error', 'ok')}")
+    worker.close()
+    print(f"Worker params: {'all cases passed' if not failed else f'{failed} case(s) failed'}.")
+    return 0 if not failed else 1
+
+def run_worker_cache_test():
+    """Generates from template A, then B, then A again in a worker whose cache fits one template. Returns 0 if all succeed."""
+    print("\n--- Worker Cache Eviction ---")
+    problems = []
+    with tempfile.TemporaryDirectory(prefix="mbz_worker_cache_") as workspace:
+        templates = [os.path.abspath(INPUT_MBZ), os.path.join(workspace, "forum.mbz")]
+        cache = mmb.TemplateCache(os.path.join(workspace, "cache"))
+        worker = mmb.BuildWorker(cache)
+        with contextlib.redirect_stdout(io.StringIO()):
+            make_forum_template(INPUT_MBZ, templates[1])
+            mmb.MbzEditor.open(templates[0], cache).close() # A is cached, so the worker loads it from the cache
+            # Room for one entry only: caching B evicts A while A's editor is still open
+            cache.max_bytes = sum(path.stat().st_size for path in cache.cache_dir.glob('*/*')) * 3 // 2
+            for step, template in enumerate(templates + templates[:1]):
+                params = {'template': template, 'output': os.path.join(workspace, f"out-{step}.mbz"), 'num_assignments': 2}
+                response = worker.handle(json.dumps({'jsonrpc': '2.0', 'id': step, 'method': 'generate', 'params': params}))
+                if 'error' in response or not response['result']['success']:
+                    problems.append(f"generate {step} from {os.path.basename(template)}: {response.get('error') or response['result']['error']}")
+        worker.close()
+        if len(list(cache.cache_dir.iterdir())) != 1:
+            problems.append(f"the cache holds {len(list(cache.cache_dir.iterdir()))} entries, expected 1 after evicting")
+    for problem in problems:
+        print(f"  ❌ {problem}")
+    print(f"Worker cache eviction: {'passed' if not problems else 'failed'}.")
+    return 0 if not problems else 1
+
+# --- Failed Writes ---
+
+def run_failed_write_test():
+    """Fails the archive write of MbzEditor.build() and modify_backup(). Returns 0 if neither leaves a file behind."""
+    print("\n--- Failed Writes ---")
+    problems = []
+    write_to_tar = mmb.BackupTree.write_to_tar
+
+    def write_then_fail(tree, tar):
+        """Writes the members, then fails like a full disk before the archive is complete."""
+        write_to_tar(tree, tar)
+        raise OSError(28, "No space left on device")
+
+    with tempfile.TemporaryDirectory(prefix="mbz_failed_write_") as workspace:
+        outputs = {mode: os.path.join(workspace, f"{mode}.mbz") for mode in ('editor', 'no-cache')}
+        mmb.BackupTree.write_to_tar = write_then_fail
+        try:
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                with mmb.MbzEditor.open(INPUT_MBZ) as editor:
+                    try:
+                        editor.build(editor.plan(num_assignments=3), outputs['editor'])
+                        problems.append("MbzEditor.build() did not raise")
+                    except OSError:
+                        pass
+                plan = mmb.plan_build(num_assignments=3)
+                if mmb.modify_backup(INPUT_MBZ, outputs['no-cache'], plan['assignments'], plan['target_assignment_count']):
+                    problems.append("modify_backup() succeeded")
+        finally:
+            mmb.BackupTree.write_to_tar = write_to_tar
+        problems += [f"the {mode} build left {os.path.basename(output)} behind"
+                     for mode, output in outputs.items() if os.path.exists(output)]
+    for problem in problems:
+        print(f"  ❌ {problem}")
+    print(f"Failed writes: {'passed' if not problems else 'failed'}.")
+    return 0 if not problems else 1
+
+# --- Command Line ---
+
+# The other tests build in-process; these run the script itself to cover
+# argument parsing and the dispatch of main(). The single builds are
+# deterministic, so all of them must write the same archive.
+CLI_BUILD_ARGS = ["-n", "3", "--target-start-date", "2025-04-22", "--deterministic", "--output-name", "cli.mbz",
+                  "--verbosity", "0"]
+CLI_BUILDS = (("default", []), ("stream", ["--stream"]), ("no-cache", ["--no-cache"]), ("stdout", None))
+
+def run_cli(args, workspace, stdin=None):
+    """Runs modify_moodle_backup.py with args in workspace (using a cache there). Returns the CompletedProcess."""
+    command = [sys.executable, os.path.abspath(SCRIPT_TO_TEST)] + args + ["--cache-dir", os.path.join(workspace, "cache")]
+    return subprocess.run(command, cwd=workspace, input=stdin, capture_output=True)
+
+def run_cli_test():
+    """Runs single builds, -o -, --validate, --batch and --worker through the command line. Returns 0 if all pass."""
+    print("\n--- Command Line ---")
+    problems = []
+    template = os.path.abspath(INPUT_MBZ)
+    with tempfile.TemporaryDirectory(prefix="mbz_cli_") as workspace:
+        archives = {}
+        for mode, mode_args in CLI_BUILDS:
+            output = os.path.join(workspace, f"{mode}.mbz")
+            result = run_cli([template, "-o", "-" if mode_args is None else output] + CLI_BUILD_ARGS + (mode_args or []),
+                             workspace)
+            if mode_args is None:
+                archives[mode] = result.stdout if result.returncode == 0 else b""
+            elif os.path.exists(output):
+                with open(output, 'rb') as f:
+                    archives[mode] = f.read()
+            if not archives.get(mode):
+                problems.append(f"{mode} build failed: {result.stdout.decode(errors='replace')[-300:]}")
+        if len(set(archives.values())) > 1:
+            problems.append(f"the builds differ: {', '.join(f'{mode} {len(data)} bytes' for mode, data in archives.items())}")
+
+        # More layout ranges than sections: the build fails, exits with 1 and writes nothing
+        failed_output = os.path.join(workspace, "failed.mbz")
+        result = run_cli([template, "-o", failed_output, "-n", "2", "--section-layout", "1;2"], workspace)
+        if result.returncode != 1 or os.path.exists(failed_output):
+            problems.append(f"a failed build exited with {result.returncode}, output written: {os.path.exists(failed_output)}")
+
+        result = run_cli([os.path.join(workspace, "stream.mbz"), "--validate"], workspace)
+        if result.returncode != 0:
+            problems.append(f"--validate of the stream build exited with {result.returncode}")
+
+        with open(os.path.join(workspace, "manifest.csv"), 'w') as f:
+            f.write("output,num_assignments,section_title\nbatch-a.mbz,2,Block A\nbatch-b.mbz,4,\n")
+        result = run_cli([template, "--batch", "manifest.csv", "--jobs", "1", "--verbosity", "0"], workspace)
+        missing = [name for name in ("batch-a.mbz", "batch-b.mbz") if not os.path.exists(os.path.join(workspace, name))]
+        if result.returncode != 0 or missing:
+            problems.append(f"--batch exited with {result.returncode}, missing outputs: {missing}")
+
+        requests = [{'jsonrpc': '2.0', 'id': 1, 'method': 'validate', 'params': {'template': template, 'num_assignments': 2}},
+                    {'jsonrpc': '2.0', 'id': 2, 'method': 'shutdown'}]
+        result = run_cli(["--worker"], workspace, "".join(json.dumps(request) + "\n" for request in requests).encode())
+        responses = [json.loads(line) for line in result.stdout.decode().splitlines() if line.strip()]
+        if [response.get('result', {}).get('target_assignment_count') for response in responses[:1]] != [2]:
+            problems.append(f"--worker answered {responses}")
+    for problem in problems:
+        print(f"  ❌ {problem}")
+    print(f"Command line: {'all checks passed' if not problems else f'{len(problems)} check(s) failed'}.")
+    return 0 if not problems else 1
 
 # --- Main Test Logic ---
 
 def main():
+    parser = argparse.ArgumentParser(description="End-to-end tests of modify_moodle_backup.py.")
+    parser.add_argument("--matrix-only", action="store_true", help="Only run the test matrix, not the comparison with the expected output")
+    parser.add_argument("--jobs", type=int, help="Worker processes for the test matrix (default: number of CPUs)")
+    args = parser.parse_args()
+    if not os.path.exists(INPUT_MBZ):
+        print(f"Error: Input file '{INPUT_MBZ}' not found.")
+        return 1
+    golden_result = 0 if args.matrix_only else run_golden_test()
+    matrix_result = run_matrix(args.jobs)
+    layout_result = run_section_layout_test()
+    stream_result = run_stream_test()
+    worker_result = run_worker_params_test() or run_worker_cache_test()
+    return run_failed_write_test() or run_cli_test() or worker_result or stream_result or layout_result or matrix_result or golden_result
+
+def run_golden_test():
+    """Builds TEST_ARGS and compares the result with EXPECTED_OUTPUT_MBZ. Returns 0 if they match."""
     print("Starting Moodle Backup Modifier E2E Test...")
 
     # Basic checks
@@ -230,29 +782,18 @@ def main():
          print(f"Test FAILED: Script finished but did not produce output file: {ACTUAL_OUTPUT_MBZ_TEMP}")
          return 1
 
-    # 2. Create temporary directories for extraction
-    expected_extract_dir = tempfile.mkdtemp(prefix="mbz_expected_")
-    actual_extract_dir = tempfile.mkdtemp(prefix="mbz_actual_")
-    print(f"Created temporary directories:\n  Expected: {expected_extract_dir}\n  Actual:   {actual_extract_dir}")
-
     test_passed = False
     try:
-        # 3. Extract both MBZ files
-        print("\n--- Extraction Phase ---")
-        if not extract_mbz(EXPECTED_OUTPUT_MBZ, expected_extract_dir):
-            print("Test FAILED: Could not extract expected MBZ.")
-            return 1 # Stop early if extraction fails
-
-        if not extract_mbz(ACTUAL_OUTPUT_MBZ_TEMP, actual_extract_dir):
-            print("Test FAILED: Could not extract actual MBZ generated by the script.")
-            return 1 # Stop early if extraction fails
-
-        # 4. Compare the extracted contents
+        # 2. Compare the archives member by member
         print("\n--- Comparison Phase ---")
         print("Note: Ignoring timestamp differences in files")
-        differences = compare_directories(expected_extract_dir, actual_extract_dir)
+        try:
+            differences = compare_archives(EXPECTED_OUTPUT_MBZ, ACTUAL_OUTPUT_MBZ_TEMP)
+        except tarfile.ReadError as e:
+            print(f"Test FAILED: Could not read archive: {e}. Is it a valid tar.gz file?")
+            return 1
 
-        # 5. Report results
+        # 3. Report results
         print("\n--- Test Result ---")
         if not differences:
             print("✅ Test PASSED: Generated content matches expected content (ignoring timestamps).")
@@ -264,18 +805,8 @@ def main():
             test_passed = False
 
     finally:
-        # 6. Cleanup
+        # 4. Cleanup
         print("\n--- Cleanup Phase ---")
-        try:
-            print(f"Removing temporary directory: {expected_extract_dir}")
-            shutil.rmtree(expected_extract_dir)
-        except Exception as e:
-            print(f"Warning: Could not remove temporary directory {expected_extract_dir}: {e}")
-        try:
-            print(f"Removing temporary directory: {actual_extract_dir}")
-            shutil.rmtree(actual_extract_dir)
-        except Exception as e:
-            print(f"Warning: Could not remove temporary directory {actual_extract_dir}: {e}")
         try:
             print(f"Removing temporary output file: {ACTUAL_OUTPUT_MBZ_TEMP}")
             if os.path.exists(ACTUAL_OUTPUT_MBZ_TEMP):